@@ -1,29 +1,201 @@
 import contextlib
+import datetime
+import email.utils
+import gzip
+import hmac
+import itertools
 import json
 import logging
+import math
 import os
+import random
+import signal
+import struct
+import sys
+import urllib.parse
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import jsonschema
-import sqlalchemy as sa
+import tornado.gen
+import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
 import tornado.log
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
+from tornado.concurrent import run_on_executor
 
-from ipythonblocks import BlockGrid
+import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 from twiggy import log
 
 # local imports
 from . import dbinterface as dbi
+from . import colorize
+from . import images
+from . import metrics
 from . import postvalidate
-from .colorize import colorize
+from . import render
+from .cache import ByteLRUCache, DiskCache
+from .dbpool import make_engine
+from .ratelimit import TokenBucketLimiter
+from .render import RENDERER_VERSION
+from .singleflight import SingleFlight
 from .twiggy_setup import twiggy_setup
 
 tornado.options.define('port', default=80, type=int)
 tornado.options.define('db_url', type=str)
+tornado.options.define(
+    'db_read_urls', type=str, multiple=True,
+    help='Comma separated read replica URLs to spread grid reads over')
+tornado.options.define(
+    'production', default=False, type=bool,
+    help='Run forked worker processes with debug features turned off')
+tornado.options.define(
+    'processes', default=0, type=int,
+    help='Worker processes in production mode (0: one per CPU)')
+tornado.options.define(
+    'shutdown_grace', default=10, type=float,
+    help='Seconds a worker keeps serving open requests after SIGTERM')
+tornado.options.define(
+    'db_pool_size', default=5, type=int,
+    help='Number of persistent connections in the database pool')
+tornado.options.define(
+    'db_max_overflow', default=10, type=int,
+    help='Connections allowed beyond db_pool_size under load')
+tornado.options.define(
+    'db_pool_timeout', default=30, type=float,
+    help='Seconds to wait for a free database connection')
+tornado.options.define(
+    'db_pool_recycle', default=3600, type=int,
+    help='Seconds after which database connections are replaced (-1: never)')
+tornado.options.define(
+    'db_pool_pre_ping', default=True, type=bool,
+    help='Test database connections as they are taken from the pool')
+tornado.options.define(
+    'db_statement_timeout', default=30000, type=int,
+    help='Milliseconds Postgres may spend on one statement (0: no limit)')
+tornado.options.define(
+    'db_workers', type=int,
+    help='Threads running database calls '
+         '(default: db_pool_size + db_max_overflow per database)')
+tornado.options.define(
+    'max_grid_width', default=1000, type=int,
+    help='Widest grid that may be posted')
+tornado.options.define(
+    'max_grid_height', default=1000, type=int,
+    help='Tallest grid that may be posted')
+tornado.options.define(
+    'max_batch_grids', default=1000, type=int,
+    help='Most grids that may be posted to /post/batch at once')
+tornado.options.define(
+    'max_post_bytes', type=int,
+    help='Largest /post body accepted '
+         '(default: room for the largest grid allowed plus 1 MB)')
+tornado.options.define(
+    'max_batch_bytes', type=int,
+    help='Largest /post/batch body accepted '
+         '(default: max_batch_grids of the largest posts, up to 100 MB)')
+tornado.options.define(
+    'post_rate', default=0.0, type=float,
+    help='Posts per second allowed from each client address on average '
+         '(0: no limit, the default, since classrooms share one address)')
+tornado.options.define(
+    'post_burst', default=30, type=int,
+    help='Posts each client may make at once before post_rate applies')
+tornado.options.define(
+    'max_posts_in_flight', type=int,
+    help='Posts handled at once before more are turned away '
+         '(default: db_pool_size + db_max_overflow)')
+tornado.options.define(
+    'render_on_post', default=True, type=bool,
+    help='Render grids to HTML when they are posted and store the result, '
+         'except grids drawn on a canvas or streamed')
+tornado.options.define(
+    'canvas_grid_cells', default=10000, type=int,
+    help='Draw grids with more blocks than this on a canvas in the browser '
+         'instead of sending them as an HTML table (0: never)')
+tornado.options.define(
+    'stream_grid_cells', default=250000, type=int,
+    help='Send pages of grids with more blocks than this a few rows at a '
+         'time as they are rendered instead of all at once (0: never)')
+tornado.options.define(
+    'pack_grids', default=False, type=bool,
+    help='Store posted grid blocks in packed binary form instead of JSON')
+tornado.options.define(
+    'grid_max_age', default=365 * 24 * 60 * 60, type=int,
+    help='Seconds browsers and proxies may cache public grids')
+tornado.options.define(
+    'secret_grid_max_age', default=24 * 60 * 60, type=int,
+    help='Seconds browsers may privately cache secret grids')
+tornado.options.define(
+    'page_cache_bytes', default=64 * 1024 * 1024, type=int,
+    help='Memory budget for cached rendered grid pages (0 disables)')
+tornado.options.define(
+    'code_cache_bytes', default=16 * 1024 * 1024, type=int,
+    help='Memory budget for cached highlighted code cells (0 disables)')
+tornado.options.define(
+    'image_cache_bytes', default=64 * 1024 * 1024, type=int,
+    help='Memory budget for cached grid images (0 disables)')
+tornado.options.define(
+    'disk_cache_dir', type=str,
+    help='Directory for a cache of grid pages and JSON shared by the '
+         'processes on a host and kept across restarts (default: none)')
+tornado.options.define(
+    'disk_cache_bytes', default=1024 * 1024 * 1024, type=int,
+    help='Disk budget for the disk_cache_dir cache')
+tornado.options.define(
+    'disk_cache_workers', default=4, type=int,
+    help='Threads reading and writing the disk_cache_dir cache')
+tornado.options.define(
+    'listing_page_size', default=48, type=int,
+    help='Grids per page of the gallery and /api/grids')
+tornado.options.define(
+    'listing_max_page_size', default=500, type=int,
+    help='Most grids /api/grids will return in one page')
+tornado.options.define(
+    'metrics', default=False, type=bool,
+    help='Serve request and database metrics at /metrics')
+tornado.options.define(
+    'metrics_token', type=str,
+    help='Require "Authorization: Bearer <token>" to read /metrics')
 log = log.name(__name__)
 
+# characters of grid JSON sent per write when serving /get
+JSON_CHUNK_SIZE = 64 * 1024
+
+# bytes sent per write when serving from the disk cache
+DISK_CHUNK_SIZE = 64 * 1024
+# the grid's creation time, as a POSIX timestamp,
+# stored ahead of each response in the disk cache
+DISK_HEADER = struct.Struct('<d')
+
+# Bump this whenever grid.html or anything else on grid pages besides
+# the grid's own HTML changes so that cached pages are invalidated.
+PAGE_VERSION = '1'
+
+# stands in for the grid in a page template that's split
+# around it to stream a large grid's rows in between
+GRID_MARKER = '<!-- grid -->'
+
+# generous bytes of posted JSON per block, e.g. "[255, 255, 255, 20], "
+POST_BYTES_PER_BLOCK = 32
+# room in a post for everything but the blocks
+POST_EXTRA_BYTES = 1024 * 1024
+# most /post/batch accepts by default, which is tornado's own limit
+BATCH_MAX_DEFAULT_BYTES = 100 * 1024 * 1024
+# seconds clients are asked to wait when too many posts are in flight
+OVERLOADED_RETRY_AFTER = 1
+
+# times crashed workers are started again before giving up,
+# as tornado.process.fork_processes does
+MAX_WORKER_RESTARTS = 100
+# seconds between checks for open requests while shutting down
+SHUTDOWN_POLL_INTERVAL = 0.1
+
 
 def configure_tornado_logging():
     fh = logging.StreamHandler()
@@ -49,9 +221,21 @@ class AboutHandler(tornado.web.StaticFileHandler):
 
 
 class DBAccessHandler(tornado.web.RequestHandler):
+    @property
+    def executor(self):
+        return self.application.executor
+
     @contextlib.contextmanager
-    def session_context(self):
-        session = self.application.session_factory()
+    def session_context(self, pool_stats=None):
+        """
+        A session on the primary database, or on the database of
+        `pool_stats` if given, that's committed when the block exits.
+
+        """
+        pool_stats = pool_stats or self.application.pool_stats
+        # check out the connection up front so waiting for it is measured
+        connection = pool_stats.connect()
+        session = self.application.session_factory(bind=connection)
         try:
             yield session
             session.commit()
@@ -60,10 +244,366 @@ class DBAccessHandler(tornado.web.RequestHandler):
             raise
         finally:
             session.close()
+            connection.close()
+
+    @run_on_executor
+    def run_in_session(self, func, *args, **kwargs):
+        """
+        Call ``func(session, *args, **kwargs)`` on the database thread pool
+        so the IOLoop isn't blocked while waiting on Postgres.
+        Yields the return value of `func`.
+
+        """
+        with self.session_context() as session:
+            return func(session, *args, **kwargs)
+
+    @run_on_executor
+    def run_in_read_session(self, func, *args, **kwargs):
+        """
+        Like `run_in_session`, but on one of the read replicas if
+        there are any.
+
+        If `func` returns None from the replica, which happens when the
+        replica hasn't caught up with a grid that was just posted, or the
+        replica fails, `func` is called again on the primary.
+
+        """
+        replica = self.application.next_read_replica()
+        if replica is not None:
+            try:
+                with self.session_context(replica) as session:
+                    result = func(session, *args, **kwargs)
+                if result is not None:
+                    return result
+                reason = 'miss'
+            except sa.exc.DBAPIError as e:
+                # includes trying to save a re-rendered grid,
+                # which replicas don't allow
+                log.fields(error=str(e).splitlines()[0]).debug(
+                    'read replica failed, retrying on primary')
+                reason = 'error'
+            metrics.READ_RETRIES.inc(reason=reason)
+
+        with self.session_context() as session:
+            return func(session, *args, **kwargs)
+
+
+def grid_url(hash_id, secret):
+    """
+    The public URL of a stored grid.
+
+    """
+    if secret:
+        url = 'http://www.ipythonblocks.org/secret/{}'
+    else:
+        url = 'http://www.ipythonblocks.org/{}'
+
+    return url.format(hash_id)
+
+
+def raw_path(hash_id, secret):
+    """
+    The path of a stored grid's blocks packed for static/gridcanvas.js.
+
+    """
+    if secret:
+        return '/raw/secret/{}'.format(hash_id)
+    return '/raw/{}'.format(hash_id)
+
+
+def image_url(hash_id, secret, kind='png'):
+    """
+    The public URL of an image of a stored grid.
+
+    """
+    if secret:
+        url = 'http://www.ipythonblocks.org/{}/secret/{}'
+    else:
+        url = 'http://www.ipythonblocks.org/{}/{}'
+
+    return url.format(kind, hash_id)
+
+
+class GridCacheMixin:
+    """
+    HTTP caching for handlers serving a single stored grid.
+
+    Grids can't change after they're posted, so the ETag is built from
+    the hash ID and the version of the response alone and conditional
+    requests can be answered before going to the database.
+    Handlers using this must have a ``secret`` attribute.
+
+    """
+    def set_grid_cache_headers(self, hash_id, version=RENDERER_VERSION):
+        """
+        Set ETag and Cache-Control headers for the grid `hash_id`
+        as drawn by `version` of the code making the response.
+        Returns True if the client's copy is current and a
+        304 has been set as the response status.
+
+        """
+        options = tornado.options.options
+        kind = 'secret' if self.secret else 'public'
+
+        self.set_header(
+            'Etag', '"{}-{}-{}"'.format(kind, hash_id, version))
+        if self.secret:
+            self.set_header(
+                'Cache-Control',
+                'private, max-age={}'.format(options.secret_grid_max_age))
+        else:
+            self.set_header(
+                'Cache-Control',
+                'public, max-age={}, immutable'.format(options.grid_max_age))
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    def set_last_modified(self, created_at):
+        """
+        Set the Last-Modified header to the grid's `created_at`.
+        Returns True if the request's If-Modified-Since is no older than
+        that and a 304 has been set as the response status.
+
+        """
+        self.set_header('Last-Modified', created_at)
+
+        ims = self.request.headers.get('If-Modified-Since')
+        if ims and 'If-None-Match' not in self.request.headers:
+            date_tuple = email.utils.parsedate(ims)
+            if date_tuple is not None:
+                since = datetime.datetime(*date_tuple[:6])
+                created = created_at.astimezone(datetime.timezone.utc)
+                created = created.replace(tzinfo=None, microsecond=0)
+                if created <= since:
+                    self.set_status(304)
+                    return True
+        return False
+
+    def finish_grid(self, body, created_at):
+        """
+        Finish the response with `body`, or with a 304 if the request's
+        If-Modified-Since is no older than the grid's `created_at`.
+
+        """
+        if self.set_last_modified(created_at):
+            self.finish()
+        else:
+            self.finish(body)
+
+    @tornado.gen.coroutine
+    def finish_from_disk(self, key):
+        """
+        Finish the response with the body stored under `key` in the
+        disk cache, a piece at a time. Yields whether it was there.
+        The disk is only touched from the application's disk_executor.
+
+        """
+        disk_cache = self.application.disk_cache
+        if disk_cache is None:
+            return False
+
+        disk_executor = self.application.disk_executor
+        data = yield disk_executor.submit(disk_cache.get, key)
+        if data is None:
+            return False
+
+        with data:
+            start = DISK_HEADER.size + DISK_CHUNK_SIZE
+            chunk = yield disk_executor.submit(_read_from_disk, data, 0, start)
+            timestamp, = DISK_HEADER.unpack_from(chunk)
+            created_at = datetime.datetime.fromtimestamp(
+                timestamp, datetime.timezone.utc)
+            if self.set_last_modified(created_at):
+                self.finish()
+                return True
+
+            self.write(chunk[DISK_HEADER.size:])
+            for start in range(start, len(data), DISK_CHUNK_SIZE):
+                yield self.flush()
+                chunk = yield disk_executor.submit(
+                    _read_from_disk, data, start, start + DISK_CHUNK_SIZE)
+                self.write(chunk)
+
+        self.finish()
+        return True
+
+    def save_to_disk(self, key, body, created_at):
+        """
+        Store a response `body` for the grid under `key` in the disk
+        cache, in the background.
+
+        """
+        disk_cache = self.application.disk_cache
+        if disk_cache is not None:
+            self.application.disk_executor.submit(
+                _save_to_disk, disk_cache, key, body, created_at)
+
+
+def _read_from_disk(data, start, stop):
+    # reading the mmap can page in the file, so it's done off the IOLoop
+    return data[start:stop]
+
+
+def _save_to_disk(disk_cache, key, body, created_at):
+    try:
+        disk_cache.set(
+            key, DISK_HEADER.pack(created_at.timestamp()) + body)
+    except OSError as e:
+        log.fields(error=str(e)).warning('could not write to disk cache')
+
+
+def max_post_bytes():
+    """
+    Largest /post body accepted, from the max_post_bytes option
+    or else the largest grid allowed.
+
+    """
+    options = tornado.options.options
+    if options.max_post_bytes is not None:
+        return options.max_post_bytes
+    return (options.max_grid_width * options.max_grid_height *
+            POST_BYTES_PER_BLOCK + POST_EXTRA_BYTES)
+
+
+def max_batch_bytes():
+    """
+    Largest /post/batch body accepted, from the max_batch_bytes option
+    or else room for max_batch_grids of the largest posts, but never
+    more than tornado would accept anyway.
 
+    """
+    options = tornado.options.options
+    if options.max_batch_bytes is not None:
+        return options.max_batch_bytes
+    return min(options.max_batch_grids * max_post_bytes(),
+               BATCH_MAX_DEFAULT_BYTES)
 
-class PostHandler(DBAccessHandler):
+
+def max_rendered_cells(canvas_cells=None):
+    """
+    Largest grid, in blocks, whose page is sent as a table rendered all
+    at once, or None for no limit. Bigger grids are drawn on a canvas or
+    streamed a chunk of rows at a time.
+
+    Parameters
+    ----------
+    canvas_cells : int, optional
+        Grids bigger than this are drawn on a canvas, 0 for never.
+        Defaults to the canvas_grid_cells option.
+
+    """
+    options = tornado.options.options
+    if canvas_cells is None:
+        canvas_cells = options.canvas_grid_cells
+    return min(
+        filter(None, [canvas_cells, options.stream_grid_cells]), default=None)
+
+
+class PostAdmissionMixin:
+    """
+    Admission control for handlers storing posted grids, done as soon
+    as the request headers arrive and before any of the body is read.
+
+    Posts with bodies bigger than `max_body_bytes` are turned away with
+    a 413. The headers can't say how big a grid is, so the limit is
+    derived from the largest grid allowed. A grid's width and height are
+    checked once the body has been parsed. Clients posting
+    faster than their rate limit are turned away with a 429, and posts
+    beyond the limit on posts in flight at once with a 503, both with a
+    Retry-After header. Handlers using this must be
+    decorated with `tornado.web.stream_request_body` and call
+    `read_body` before using ``self.request.body``.
+
+    """
+    _admitted = False
+
+    def max_body_bytes(self):
+        """
+        Largest body accepted, or None for tornado's limit.
+
+        """
+        return None
+
+    def reject(self, status, reason, retry_after, message):
+        # not send_error, which would clear the Retry-After header
+        metrics.POST_REJECTIONS.inc(reason=reason)
+        log.fields(client=self.request.remote_ip, reason=reason).info(
+            'turning away post')
+        self.set_status(status)
+        self.set_header('Retry-After', str(math.ceil(retry_after)))
+        self.finish(message)
+
+    def prepare(self):
+        application = self.application
+
+        max_bytes = self.max_body_bytes()
+        if max_bytes is not None:
+            # also stops tornado reading the body of a rejected post,
+            # and limits bodies sent without a Content-Length
+            self.request.connection.set_max_body_size(max_bytes)
+            try:
+                length = int(self.request.headers.get('Content-Length', 0))
+            except ValueError:
+                raise tornado.web.HTTPError(
+                    400, 'Content-Length must be an integer.')
+            if length > max_bytes:
+                metrics.POST_REJECTIONS.inc(reason='too_large')
+                raise tornado.web.HTTPError(
+                    413, 'Posts may be at most {} bytes.'.format(max_bytes))
+
+        if application.post_limiter is not None:
+            wait = application.post_limiter.take(self.request.remote_ip)
+            if wait:
+                self.reject(429, 'rate_limited', wait,
+                            'Too many posts, slow down.')
+                return
+
+        if application.posts_in_flight >= application.max_posts_in_flight:
+            self.reject(503, 'overloaded', OVERLOADED_RETRY_AFTER,
+                        'Too busy to take posts right now.')
+            return
+
+        application.posts_in_flight += 1
+        self._admitted = True
+        self._chunks = []
+
+    def data_received(self, chunk):
+        if self._admitted:
+            self._chunks.append(chunk)
+
+    def read_body(self):
+        """
+        Put the body received into ``self.request.body``.
+
+        """
+        self.request.body = b''.join(self._chunks)
+        self._chunks = []
+
+    def release(self):
+        if self._admitted:
+            self._admitted = False
+            self.application.posts_in_flight -= 1
+
+    def on_finish(self):
+        self.release()
+        super().on_finish()
+
+    def on_connection_close(self):
+        self.release()
+        super().on_connection_close()
+
+
+@tornado.web.stream_request_body
+class PostHandler(PostAdmissionMixin, DBAccessHandler):
+    def max_body_bytes(self):
+        return max_post_bytes()
+
+    @tornado.gen.coroutine
     def post(self):
+        self.read_body()
         try:
             req_data = json.loads(self.request.body)
         except ValueError:
@@ -71,42 +611,162 @@ class PostHandler(DBAccessHandler):
             raise tornado.web.HTTPError(400, 'Unable to load request JSON.')
 
         try:
-            jsonschema.validate(req_data, postvalidate.schema)
+            with metrics.STAGE_SECONDS.time(stage='validate'):
+                postvalidate.validate(
+                    req_data,
+                    max_width=tornado.options.options.max_grid_width,
+                    max_height=tornado.options.options.max_grid_height)
         except jsonschema.ValidationError:
             log.debug('Post JSON validation failed.')
             raise tornado.web.HTTPError(400, 'Post JSON validation failed.')
 
-        with self.session_context() as session:
-            hash_id = dbi.store_grid_entry(session, req_data)
+        hash_id = yield self.run_in_session(
+            dbi.store_grid_entry, req_data,
+            rendered=tornado.options.options.render_on_post,
+            packed=tornado.options.options.pack_grids,
+            max_rendered_cells=max_rendered_cells())
 
-        if req_data['secret']:
-            url = 'http://www.ipythonblocks.org/secret/{}'
-        else:
-            url = 'http://www.ipythonblocks.org/{}'
+        self.write({'url': grid_url(hash_id, req_data['secret'])})
+
+
+@tornado.web.stream_request_body
+class PostBatchHandler(PostAdmissionMixin, DBAccessHandler):
+    """
+    Store many grids in one request. The body is either a JSON array of
+    grid posts or newline-delimited JSON with one post per line.
+
+    Responds with a "results" list holding either the "url" of each grid
+    or the "error" that kept it from being stored, in the order posted.
 
-        url = url.format(hash_id)
+    """
+    def max_body_bytes(self):
+        return max_batch_bytes()
 
-        self.write({'url': url})
+    def load_batch(self):
+        """
+        Decode the request body into a list of posts.
+        Lines of newline-delimited JSON that can't be decoded are
+        returned as None so they can be reported individually.
 
+        """
+        try:
+            body = self.request.body.decode('utf-8')
+            if body.lstrip().startswith('['):
+                return json.loads(body)
+        except ValueError:
+            log.debug('Unable to load request JSON.')
+            raise tornado.web.HTTPError(400, 'Unable to load request JSON.')
+
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+
+    @tornado.gen.coroutine
+    def post(self):
+        options = tornado.options.options
+
+        self.read_body()
+        items = self.load_batch()
+        if not items or len(items) > options.max_batch_grids:
+            raise tornado.web.HTTPError(
+                400, 'Batches must have 1 to {} grids.'.format(
+                    options.max_batch_grids))
+
+        results = [None] * len(items)
+        valid = []
+        for i, req_data in enumerate(items):
+            if req_data is None:
+                results[i] = {'error': 'Unable to load request JSON.'}
+                continue
+
+            try:
+                postvalidate.validate(
+                    req_data,
+                    max_width=options.max_grid_width,
+                    max_height=options.max_grid_height)
+            except jsonschema.ValidationError as e:
+                results[i] = {
+                    'error': 'Post JSON validation failed: {}'.format(
+                        e.message)}
+                continue
+
+            valid.append(i)
+
+        log.fields(grids=len(items), valid=len(valid)).debug('storing batch')
+
+        if valid:
+            hash_ids = yield self.run_in_session(
+                dbi.store_grid_entries, [items[i] for i in valid],
+                rendered=options.render_on_post,
+                packed=options.pack_grids,
+                max_rendered_cells=max_rendered_cells())
+
+            for i, hash_id in zip(valid, hash_ids):
+                results[i] = {'url': grid_url(hash_id, items[i]['secret'])}
+
+        self.write({'results': results})
 
-class GetGridSpecHandler(DBAccessHandler):
+
+class GetGridSpecHandler(GridCacheMixin, DBAccessHandler):
     def initialize(self, secret):
         self.secret = secret
 
+    @tornado.gen.coroutine
     def get(self, hash_id):
-        with self.session_context() as session:
-            grid_spec = dbi.get_grid_entry(session, hash_id, self.secret)
+        if self.set_grid_cache_headers(hash_id):
+            return
+
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        disk_key = ('json', self.secret, hash_id)
+        if (yield self.finish_from_disk(disk_key)):
+            return
+
+        # concurrent requests for the same grid share one lookup
+        result = yield self.application.single_flight.do(
+            (self.secret, hash_id, 'json'),
+            lambda: self.load_json(hash_id, disk_key), kind='json')
+
+        if not result:
+            raise tornado.web.HTTPError(404, 'Grid not found.')
+
+        grid_json, created_at = result
+        if self.set_last_modified(created_at):
+            return
+
+        # the JSON comes from Postgres ready to send, so pass it along
+        # in pieces rather than decoding and encoding it again
+        for start in range(0, len(grid_json), JSON_CHUNK_SIZE):
+            if start:
+                yield self.flush()
+            self.write(grid_json[start:start + JSON_CHUNK_SIZE])
+
+    @tornado.gen.coroutine
+    def load_json(self, hash_id, disk_key):
+        """
+        Get grid `hash_id` as JSON and save it to the disk cache.
+        Yields the JSON and the grid's creation time, or None if
+        there's no such grid.
 
-            if not grid_spec:
-                raise tornado.web.HTTPError(404, 'Grid not found.')
+        """
+        result = yield self.run_in_read_session(
+            dbi.get_grid_json, hash_id, self.secret)
 
-            self.write(grid_spec.grid_data)
+        if result:
+            grid_json, created_at = result
+            self.save_to_disk(disk_key, grid_json.encode('utf-8'), created_at)
+        return result
 
 
 class RandomHandler(DBAccessHandler):
+    @tornado.gen.coroutine
     def get(self):
-        with self.session_context() as session:
-            hash_id = dbi.get_random_hash_id(session)
+        hash_id = yield self.run_in_read_session(dbi.get_random_hash_id)
         log.info('redirecting to url /{0}', hash_id)
         self.redirect('/' + hash_id, status=303)
 
@@ -122,35 +782,475 @@ class ErrorHandler(DBAccessHandler):
             super().send_error(status_code, **kwargs)
 
 
-class RenderGridHandler(ErrorHandler):
+class RenderGridHandler(GridCacheMixin, ErrorHandler):
+    """
+    Serve the page for a stored grid.
+
+    Grids with more than canvas_grid_cells blocks are drawn in the
+    browser by static/gridcanvas.js, unless the HTML table is asked for
+    with ``?view=table``. Tables of grids with more than
+    stream_grid_cells blocks are sent a chunk of rows at a time.
+
+    """
     def initialize(self, secret):
         self.secret = secret
 
     @tornado.web.removeslash
+    @tornado.gen.coroutine
     def get(self, hash_id):
-        with self.session_context() as session:
-            grid_spec = dbi.get_grid_entry(session, hash_id, secret=self.secret)
+        # grids bigger than this are drawn on a canvas, 0 for never
+        self.canvas_cells = (
+            tornado.options.options.canvas_grid_cells
+            if self.get_argument('view', None) != 'table' else 0)
+
+        if self.set_grid_cache_headers(hash_id, version=self.page_version()):
+            return
+
+        # grids never change once stored so a rendered page can be
+        # served again without touching the database
+        cache_key = (self.secret, hash_id, self.canvas_cells)
+        cached = self.application.page_cache.get(cache_key)
+        if cached is None:
+            if (yield self.finish_from_disk(self.disk_key(hash_id))):
+                return
 
-            if not grid_spec:
+            # concurrent requests for the same grid share one render
+            loaded = yield self.application.single_flight.do(
+                cache_key + ('page',),
+                lambda: self.load_page(hash_id, cache_key), kind='page')
+
+            if loaded is None:
                 self.send_error(404)
                 return
 
-            gd = grid_spec.grid_data
-            grid = BlockGrid(gd['width'], gd['height'], lines_on=gd['lines_on'])
-            grid._load_simple_grid(gd['blocks'])
-            grid_html = grid._repr_html_()
+            page, grid_spec = loaded
+            if page is None:
+                yield self.stream_page(hash_id, grid_spec)
+                return
+            cached = (page, grid_spec.created_at)
+
+        self.finish_grid(*cached)
+
+    @tornado.gen.coroutine
+    def load_page(self, hash_id, cache_key):
+        """
+        Render the page for grid `hash_id` and add it to the page cache.
+        Yields the page and the grid, or None if there's no such grid.
+        The page is None for grids too big to render all at once.
+
+        """
+        options = tornado.options.options
+        canvas_cells = self.canvas_cells
+        max_cells = max_rendered_cells(canvas_cells)
+
+        grid_spec = yield self.run_in_read_session(
+            dbi.get_rendered_grid_entry, hash_id, secret=self.secret,
+            max_cells=max_cells)
+
+        if not grid_spec:
+            return None
+
+        if dbi.exceeds_cells(grid_spec, canvas_cells):
+            page = self.render_page(
+                hash_id,
+                raw_url=raw_path(hash_id, self.secret),
+                code_cells=self.code_html(grid_spec))
+        elif dbi.exceeds_cells(grid_spec, options.stream_grid_cells):
+            return None, grid_spec
+        else:
+            page = self.render_page(
+                hash_id,
+                grid_html=grid_spec.grid_html,
+                code_cells=grid_spec.code_html)
+
+        self.application.page_cache.set(
+            cache_key, (page, grid_spec.created_at), size=len(page))
+        self.save_to_disk(self.disk_key(hash_id), page, grid_spec.created_at)
+        return page, grid_spec
+
+    def page_version(self):
+        """
+        Version of the page sent for the grid, which depends on how
+        the grid is drawn as well as on the page around it.
+
+        """
+        view = (
+            'canvas{}'.format(self.canvas_cells) if self.canvas_cells
+            else 'table')
+        return '{}.{}-{}'.format(RENDERER_VERSION, PAGE_VERSION, view)
+
+    def disk_key(self, hash_id):
+        return ('page', self.secret, hash_id, self.page_version())
+
+    def render_page(self, hash_id, grid_html=None, raw_url=None,
+                    code_cells=()):
+        with metrics.STAGE_SECONDS.time(stage='template_render'):
+            return self.render_string(
+                'grid.html',
+                grid_html=grid_html,
+                raw_url=raw_url,
+                code_cells=code_cells,
+                image_url=image_url(hash_id, self.secret))
+
+    def code_html(self, grid_spec):
+        """
+        The grid's code cells as HTML. The stored HTML isn't brought up
+        to date for grids that aren't rendered as a whole.
+
+        """
+        if grid_spec.render_version == RENDERER_VERSION:
+            return grid_spec.code_html
+        with metrics.STAGE_SECONDS.time(stage='colorize'):
+            return colorize.colorize_cells(grid_spec.code_cells or [])
+
+    @run_on_executor
+    def render_rows(self, rows):
+        with metrics.STAGE_SECONDS.time(stage='grid_render'):
+            return ''.join(itertools.islice(rows, render.CHUNK_ROWS))
+
+    @tornado.gen.coroutine
+    def stream_page(self, hash_id, grid_spec):
+        """
+        Send the page for a grid too big to render all at once,
+        rendering and flushing its table a chunk of rows at a time.
+        The page is never cached.
+
+        """
+        if self.set_last_modified(grid_spec.created_at):
+            self.finish()
+            return
+
+        result = yield self.run_in_read_session(
+            dbi.get_grid_data, hash_id, secret=self.secret)
+        if not result:
+            self.send_error(404)
+            return
+
+        grid_data, _ = result
+        head, tail = self.render_page(
+            hash_id,
+            grid_html=GRID_MARKER,
+            code_cells=self.code_html(grid_spec)).split(
+                GRID_MARKER.encode('utf-8'))
+
+        self.write(head)
+        self.write(render.table_head(grid_data['lines_on']))
+
+        rows = render.iter_grid_rows(grid_data)
+        try:
+            while True:
+                chunk = yield self.render_rows(rows)
+                if not chunk:
+                    break
+                self.write(chunk)
+                # wait for slow clients rather than buffering the page
+                yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            log.fields(hash_id=hash_id).debug('client left mid-stream')
+            return
+
+        self.write(render.table_tail())
+        self.finish(tail)
+
+
+class ImageHandler(GridCacheMixin, ErrorHandler):
+    """
+    Serve a grid drawn as a PNG, SVG, or thumbnail PNG.
+
+    """
+    def initialize(self, secret, kind):
+        self.secret = secret
+        self.kind = kind
+
+    @run_on_executor
+    def encode(self, grid_data):
+        with metrics.STAGE_SECONDS.time(stage='image_encode'):
+            return images.encode(grid_data, self.kind)
+
+    @tornado.gen.coroutine
+    def get(self, hash_id):
+        if self.set_grid_cache_headers(hash_id, version=images.IMAGE_VERSION):
+            return
+
+        cache_key = (self.secret, hash_id, self.kind)
+        cached = self.application.image_cache.get(cache_key)
+        if cached is None:
+            # concurrent requests for the same image share one encode
+            cached = yield self.application.single_flight.do(
+                cache_key, lambda: self.load_image(hash_id), kind=self.kind)
+
+        if cached is None:
+            self.send_error(404)
+            return
+
+        self.set_header('Content-Type', images.CONTENT_TYPES[self.kind])
+        self.finish_image(*cached)
+
+    def finish_image(self, image, created_at):
+        self.finish_grid(image, created_at)
+
+    @tornado.gen.coroutine
+    def load_image(self, hash_id):
+        """
+        Draw grid `hash_id` and add the image to the image cache.
+        Yields the image and the grid's creation time, or None if
+        there's no such grid.
+
+        """
+        result = yield self.run_in_read_session(
+            dbi.get_grid_data, hash_id, secret=self.secret)
+
+        if not result:
+            return None
+
+        grid_data, created_at = result
+        image = yield self.encode(grid_data)
+
+        result = (image, created_at)
+        self.application.image_cache.set(
+            (self.secret, hash_id, self.kind), result, size=len(image))
+        return result
+
+
+class RawGridHandler(ImageHandler):
+    """
+    Serve a grid's blocks packed for static/gridcanvas.js.
+
+    They're cached gzip compressed and sent that way to clients that
+    accept it, with the browser undoing the compression before the
+    script sees them. Tornado's gzip support adds the Vary header.
+
+    """
+    def finish_image(self, image, created_at):
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+        else:
+            image = gzip.decompress(image)
+        self.finish_grid(image, created_at)
+
+
+class GridListHandler(DBAccessHandler):
+    """
+    List public grids newest first as JSON, a page at a time.
+    Each page includes a ``next`` URL for the page after it, or null on
+    the last page.
+
+    """
+    # seconds pages may be cached, the first page changes with
+    # every new grid but later pages stay put
+    FIRST_PAGE_MAX_AGE = 60
+    PAGE_MAX_AGE = 60 * 60
+
+    @tornado.gen.coroutine
+    def load_page(self, limit):
+        """
+        Yields the grids for this page and the cursor for the next one.
+
+        """
+        cursor = self.get_argument('cursor', None)
+        try:
+            grids, next_cursor = yield self.run_in_read_session(
+                dbi.list_public_grids, limit, cursor)
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Invalid cursor.')
+
+        max_age = self.PAGE_MAX_AGE if cursor else self.FIRST_PAGE_MAX_AGE
+        self.set_header('Cache-Control', 'public, max-age={}'.format(max_age))
+
+        return grids, next_cursor
+
+    def page_url(self, cursor, **arguments):
+        if cursor is None:
+            return None
+        return '{}?{}'.format(
+            self.request.path,
+            urllib.parse.urlencode(dict(arguments, cursor=cursor)))
+
+    @tornado.gen.coroutine
+    def get(self):
+        options = tornado.options.options
+        try:
+            limit = int(self.get_argument('limit', options.listing_page_size))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= options.listing_max_page_size:
+            raise tornado.web.HTTPError(
+                400, 'limit must be 1 to {}.'.format(
+                    options.listing_max_page_size))
+
+        grids, next_cursor = yield self.load_page(limit)
+        for grid in grids:
+            grid['url'] = grid_url(grid['hash_id'], secret=False)
+            grid['thumb_url'] = image_url(
+                grid['hash_id'], secret=False, kind='thumb')
+            grid['created_at'] = grid['created_at'].isoformat()
+
+        self.write({
+            'grids': grids,
+            'next': self.page_url(next_cursor, limit=limit),
+        })
+
+
+class GalleryHandler(GridListHandler):
+    """
+    Show thumbnails of public grids newest first, a page at a time.
+
+    """
+    @tornado.gen.coroutine
+    def get(self):
+        grids, next_cursor = yield self.load_page(
+            tornado.options.options.listing_page_size)
+        self.render(
+            'gallery.html', grids=grids, next_url=self.page_url(next_cursor))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Serve this process's metrics in the Prometheus text format.
+
+    """
+    def get(self):
+        token = tornado.options.options.metrics_token
+        if token:
+            auth = self.request.headers.get('Authorization', '')
+            if not hmac.compare_digest(auth, 'Bearer ' + token):
+                raise tornado.web.HTTPError(403)
+
+        application = self.application
+        metrics.record_cache_stats('page', application.page_cache.stats())
+        metrics.record_cache_stats('code', colorize.CODE_CACHE.stats())
+        metrics.POSTS_IN_FLIGHT.set(application.posts_in_flight)
+        metrics.record_cache_stats('image', application.image_cache.stats())
+        if application.disk_cache is not None:
+            metrics.record_cache_stats('disk', application.disk_cache.stats())
+        metrics.record_pool_stats('primary', application.pool_stats.stats())
+        for i, stats in enumerate(application.read_pool_stats):
+            metrics.record_pool_stats('replica{}'.format(i), stats.stats())
+
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.REGISTRY.exposition())
+
+
+class ResponseSizeTransform(tornado.web.OutputTransform):
+    """
+    Count the bytes of response body sent for a request, after any
+    compression, as ``request.response_bytes``.
+
+    """
+    def __init__(self, request):
+        self.request = request
+        request.response_bytes = 0
 
-            code_cells = grid_spec.code_cells or []
-            code_cells = [colorize(c) for c in code_cells]
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        self.request.response_bytes += len(chunk)
+        return status_code, headers, chunk
 
-            self.render('grid.html', grid_html=grid_html, code_cells=code_cells)
+    def transform_chunk(self, chunk, finishing):
+        self.request.response_bytes += len(chunk)
+        return chunk
 
 
 class AppWithSession(tornado.web.Application):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.engine = sa.create_engine(tornado.options.options.db_url)
-        self.session_factory = sessionmaker(bind=self.engine)
+        options = tornado.options.options
+        # after compression so sizes are what went over the wire
+        self.add_transform(ResponseSizeTransform)
+        # requests being handled, which a shutting down worker waits for.
+        # Weak so requests whose connection closed before they finished
+        # don't count.
+        self.open_requests = weakref.WeakSet()
+
+        def engine_for(url):
+            return make_engine(
+                url,
+                pool_size=options.db_pool_size,
+                max_overflow=options.db_max_overflow,
+                pool_timeout=options.db_pool_timeout,
+                pool_recycle=options.db_pool_recycle,
+                pre_ping=options.db_pool_pre_ping,
+                statement_timeout=options.db_statement_timeout)
+
+        self.engine, self.pool_stats = engine_for(options.db_url)
+        # grid rows are handed back to handlers after their session
+        # has been closed on a worker thread, so don't expire them on commit
+        self.session_factory = sessionmaker(
+            bind=self.engine, expire_on_commit=False)
+
+        self.read_pool_stats = [
+            engine_for(url)[1] for url in options.db_read_urls or []]
+        self._read_turns = itertools.count()
+
+        # one thread per connection the pools can hand out
+        workers = (
+            options.db_workers or
+            (options.db_pool_size + options.db_max_overflow) *
+            (1 + len(self.read_pool_stats)))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.post_limiter = (
+            TokenBucketLimiter(options.post_rate, options.post_burst)
+            if options.post_rate > 0 else None)
+        self.posts_in_flight = 0
+        self.max_posts_in_flight = (
+            options.max_posts_in_flight or
+            options.db_pool_size + options.db_max_overflow)
+
+        self.page_cache = ByteLRUCache(options.page_cache_bytes)
+        self.single_flight = SingleFlight()
+        self.image_cache = ByteLRUCache(options.image_cache_bytes)
+        self.disk_cache = (
+            DiskCache(options.disk_cache_dir, options.disk_cache_bytes)
+            if options.disk_cache_dir else None)
+        # kept apart from the database threads so disk I/O doesn't
+        # hold up queries
+        self.disk_executor = ThreadPoolExecutor(
+            max_workers=options.disk_cache_workers)
+        colorize.CODE_CACHE.max_bytes = options.code_cache_bytes
+
+    def next_read_replica(self):
+        """
+        Return the `dbpool.PoolStats` of the read replica to use next,
+        taking turns between them, or None if there are no replicas.
+
+        """
+        if not self.read_pool_stats:
+            return None
+        turn = next(self._read_turns)
+        return self.read_pool_stats[turn % len(self.read_pool_stats)]
+
+    def find_handler(self, request, **kwargs):
+        self.open_requests.add(request)
+        return super().find_handler(request, **kwargs)
+
+    def log_request(self, handler):
+        super().log_request(handler)
+        self.open_requests.discard(handler.request)
+
+        request = handler.request
+        name = type(handler).__name__
+        status = handler.get_status()
+        metrics.REQUESTS.inc(
+            handler=name, method=request.method, status=status)
+        metrics.REQUEST_SECONDS.observe(
+            request.request_time(), handler=name, status=status)
+        # the body of a streamed request that was turned away is
+        # still the future tornado reads it into
+        if isinstance(request.body, bytes) and request.body:
+            metrics.REQUEST_BYTES.observe(len(request.body), handler=name)
+        metrics.RESPONSE_BYTES.observe(
+            getattr(request, 'response_bytes', 0), handler=name)
+
+    def shutdown(self):
+        """
+        Release the application's threads and database connections.
+
+        """
+        self.executor.shutdown(wait=True)
+        self.disk_executor.shutdown(wait=True)
+        self.engine.dispose()
+        for stats in self.read_pool_stats:
+            stats.engine.dispose()
 
 
 SETTINGS = {
@@ -161,18 +1261,160 @@ SETTINGS = {
 }
 
 
-def make_application():
-    return AppWithSession(handlers=[
+def make_application(**settings):
+    """
+    Make the application. Keyword arguments override the
+    application settings in `SETTINGS`.
+
+    """
+    handlers = [
         (r'/()', MainHandler, {'path': SETTINGS['template_path']}),
         (r'/(about)', AboutHandler, {'path': SETTINGS['template_path']}),
         (r'/random', RandomHandler),
+        (r'/gallery', GalleryHandler),
+        (r'/api/grids', GridListHandler),
         (r'/post', PostHandler),
+        (r'/post/batch', PostBatchHandler),
         (r'/get/(\w{6}\w*)', GetGridSpecHandler, {'secret': False}),
         (r'/get/secret/(\w{6}\w*)', GetGridSpecHandler, {'secret': True}),
+        (r'/png/(\w{6}\w*)', ImageHandler, {'secret': False, 'kind': 'png'}),
+        (r'/png/secret/(\w{6}\w*)', ImageHandler,
+         {'secret': True, 'kind': 'png'}),
+        (r'/svg/(\w{6}\w*)', ImageHandler, {'secret': False, 'kind': 'svg'}),
+        (r'/svg/secret/(\w{6}\w*)', ImageHandler,
+         {'secret': True, 'kind': 'svg'}),
+        (r'/thumb/(\w{6}\w*)', ImageHandler,
+         {'secret': False, 'kind': 'thumb'}),
+        (r'/thumb/secret/(\w{6}\w*)', ImageHandler,
+         {'secret': True, 'kind': 'thumb'}),
+        (r'/raw/(\w{6}\w*)', RawGridHandler,
+         {'secret': False, 'kind': 'raw'}),
+        (r'/raw/secret/(\w{6}\w*)', RawGridHandler,
+         {'secret': True, 'kind': 'raw'}),
         (r'/(\w{6}\w*)/*', RenderGridHandler, {'secret': False}),
         (r'/secret/(\w{6}\w*)/*', RenderGridHandler, {'secret': True}),
         (r'/.*', ErrorHandler)
-    ], **SETTINGS)
+    ]
+    if tornado.options.options.metrics:
+        handlers.insert(0, (r'/metrics', MetricsHandler))
+
+    return AppWithSession(handlers=handlers, **dict(SETTINGS, **settings))
+
+
+def run_development(port):
+    """
+    Serve from this process with debug features such as autoreload on.
+
+    """
+    application = make_application()
+    application.listen(port)
+    tornado.ioloop.IOLoop.instance().start()
+
+
+def fork_workers(processes):
+    """
+    Fork `processes` worker processes, one per CPU if 0, and return the
+    worker's task ID in each worker.
+
+    This works like tornado.process.fork_processes, restarting workers
+    that crash, but the parent also passes SIGTERM on to the workers so
+    a supervisor need only signal the parent. The parent exits once
+    every worker has.
+
+    """
+    if processes <= 0:
+        processes = tornado.process.cpu_count()
+
+    workers = {}
+    stopping = False
+
+    def start_worker(task_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # or every worker would pick the same "random" grids
+            random.seed()
+            return task_id
+        workers[pid] = task_id
+        return None
+
+    def stop_workers(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    for task_id in range(processes):
+        if start_worker(task_id) is not None:
+            return task_id
+
+    restarts = 0
+    while workers:
+        pid, status = os.wait()
+        task_id = workers.pop(pid, None)
+        if task_id is None:
+            continue
+
+        llog = log.fields(task_id=task_id, pid=pid)
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            llog.info('worker exited')
+            continue
+        llog.fields(status=status).warning('worker died')
+        if stopping:
+            continue
+
+        restarts += 1
+        if restarts > MAX_WORKER_RESTARTS:
+            raise RuntimeError('Too many worker restarts, giving up')
+        if start_worker(task_id) is not None:
+            return task_id
+
+    sys.exit(0)
+
+
+def run_production(port, processes, shutdown_grace):
+    """
+    Fork `processes` workers sharing one listening socket.
+
+    Each worker makes its own application after the fork so that none of
+    them share database connections. On SIGTERM, sent to the parent or
+    to the workers themselves, a worker stops accepting connections and
+    exits once its open requests have finished, or `shutdown_grace`
+    seconds have passed.
+
+    """
+    sockets = tornado.netutil.bind_sockets(port)
+    task_id = fork_workers(processes)
+
+    # from here on this is a worker process
+    application = make_application(debug=False)
+    server = tornado.httpserver.HTTPServer(application, xheaders=True)
+    server.add_sockets(sockets)
+    io_loop = tornado.ioloop.IOLoop.current()
+
+    def shutdown():
+        log.fields(task_id=task_id).info('shutting down')
+        server.stop()
+        stop_when_idle(io_loop.time() + shutdown_grace)
+
+    def stop_when_idle(deadline):
+        if not application.open_requests or io_loop.time() >= deadline:
+            io_loop.stop()
+        else:
+            io_loop.call_later(
+                SHUTDOWN_POLL_INTERVAL, stop_when_idle, deadline)
+
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: io_loop.add_callback_from_signal(shutdown))
+
+    io_loop.start()
+    application.shutdown()
 
 
 if __name__ == '__main__':
@@ -180,7 +1422,10 @@ if __name__ == '__main__':
     configure_tornado_logging()
     twiggy_setup()
 
-    log.fields(port=tornado.options.options.port).info('starting server')
-    application = make_application()
-    application.listen(tornado.options.options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    options = tornado.options.options
+    log.fields(port=options.port, production=options.production).info(
+        'starting server')
+    if options.production:
+        run_production(options.port, options.processes, options.shutdown_grace)
+    else:
+        run_development(options.port)
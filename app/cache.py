@@ -0,0 +1,285 @@
+"""In-process and on-disk caches for rendered grid output"""
+import collections
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+
+class ByteLRUCache:
+    """
+    A least-recently-used cache bounded by the total size of its values.
+
+    Values are normally ``bytes`` and sized with ``len``, but any object
+    can be stored by passing its size explicitly to `set`.
+    When adding a value pushes the total size over ``max_bytes`` the
+    least recently used entries are evicted until it fits again.
+    Values larger than the whole budget are never stored.
+
+    The cache is safe to share between threads.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Budget for the summed length of all cached values.
+        A budget of zero disables the cache.
+
+    Attributes
+    ----------
+    hits, misses, evictions : int
+        Running counters of cache behavior.
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        """
+        Return the value stored under `key`, or None if it isn't cached.
+
+        """
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=None):
+        """
+        Store `value` under `key`, evicting old entries as needed.
+
+        Parameters
+        ----------
+        key : hashable
+        value : object
+        size : int, optional
+            Size of `value` in bytes. Defaults to ``len(value)``.
+
+        """
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+            self._data[key] = (value, size)
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+        Return a dict of the cache's counters and current size.
+
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._data),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+class DiskCache:
+    """
+    A least-recently-used cache of bytes kept in files under a directory.
+    Every process using the same directory shares it, and it survives
+    restarts.
+
+    Values are written to a temporary file and renamed into place, so
+    they're never seen half written, and read with mmap, so processes
+    share the operating system's copy of them. A file's modification
+    time marks its last use. Each process adds up what it writes, and
+    when the directory may be past ``max_bytes`` it is scanned and the
+    least recently used files deleted.
+
+    The cache is safe to share between threads.
+
+    Parameters
+    ----------
+    path : str
+        Directory for the cache, created if it doesn't exist.
+    max_bytes : int
+        Budget for the size of all cached files, which may be briefly
+        exceeded while other processes write.
+
+    Attributes
+    ----------
+    hits, misses, evictions : int
+        Running counters of this process's use of the cache.
+
+    """
+    # reads mark a file used at most this often, in seconds
+    TOUCH_INTERVAL = 60
+    # temporary files left behind by crashed writers are deleted once
+    # they're this old, in seconds
+    TEMP_MAX_AGE = 60 * 60
+    TEMP_PREFIX = '.tmp'
+    # evicting frees space down to this fraction of the budget so it
+    # isn't needed again on the next write
+    EVICT_TO = 0.9
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries = 0
+        self._bytes = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.evict()
+
+    def _filename(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def get(self, key):
+        """
+        Return the value stored under `key` as a read-only mmap,
+        or None if it isn't cached. Close the mmap when done with it.
+
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # ValueError is mmap refusing an empty file,
+            # which can only have been left by something else
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if time.time() - stat.st_mtime > self.TOUCH_INTERVAL:
+            try:
+                os.utime(filename)
+            except OSError:
+                # evicted by someone else in the meantime
+                pass
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def set(self, key, value):
+        """
+        Store the bytes `value` under `key`,
+        evicting old entries if the cache may be full.
+
+        """
+        size = len(value)
+        if not size or size > self.max_bytes:
+            return
+
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.path, prefix=self.TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(temp, filename)
+        except:
+            os.unlink(temp)
+            raise
+
+        with self._lock:
+            self._entries += 1
+            self._bytes += size
+            full = self._bytes > self.max_bytes
+
+        if full:
+            self.evict()
+
+    def evict(self):
+        """
+        Scan the cache directory and delete the least recently used
+        files until it's within ``EVICT_TO`` of the budget.
+
+        """
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.path):
+            try:
+                if entry.is_dir():
+                    for item in os.scandir(entry.path):
+                        stat = item.stat()
+                        files.append((stat.st_mtime, stat.st_size, item.path))
+                elif (entry.name.startswith(self.TEMP_PREFIX) and
+                        now - entry.stat().st_mtime > self.TEMP_MAX_AGE):
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                # removed by another process while scanning
+                continue
+
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * self.EVICT_TO
+        evicted = 0
+        for _, size, filename in files:
+            if total <= target:
+                break
+            try:
+                os.unlink(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._entries = len(files) - evicted
+            self._bytes = total
+            self.evictions += evicted
+
+    def stats(self):
+        """
+        Return a dict of the cache's counters and size as of the last
+        scan plus what this process has written since.
+
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': self._entries,
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+        }
@@ -1,13 +1,61 @@
+import hashlib
+
 from pygments import highlight
 from pygments.lexers import PythonLexer
 from pygments.formatters import HtmlFormatter
 
+from .cache import ByteLRUCache
+
 CSS_CLASS = 'ipb-code'
 
+# Neither of these keeps any per-call state so they're built once
+# and shared by every call, including calls from worker threads.
+_LEXER = PythonLexer()
+_FORMATTER = HtmlFormatter(cssclass=CSS_CLASS)
+
+# Highlighted HTML keyed by a hash of the source code.
+# The app resizes this from its code_cache_bytes option.
+CODE_CACHE = ByteLRUCache(16 * 1024 * 1024)
+
+
+def _code_key(code):
+    return hashlib.sha1(code.encode('utf-8', 'surrogatepass')).digest()
+
 
 def colorize(code):
     """
     Turn a code block into HTML.
 
     """
-    return highlight(code, PythonLexer(), HtmlFormatter(cssclass=CSS_CLASS))
+    return colorize_cells([code])[0]
+
+
+def colorize_cells(cells):
+    """
+    Turn a list of code blocks into HTML, such as all the code cells
+    posted with a grid. Cells that have been highlighted before, or that
+    are repeated in `cells`, are only highlighted once.
+
+    Parameters
+    ----------
+    cells : list of str
+
+    Returns
+    -------
+    html : list of str
+
+    """
+    keys = [_code_key(c) for c in cells]
+    found = {}
+
+    for key, code in zip(keys, cells):
+        if key in found:
+            continue
+
+        html = CODE_CACHE.get(key)
+        if html is None:
+            html = highlight(code, _LEXER, _FORMATTER)
+            CODE_CACHE.set(key, html)
+        found[key] = html
+
+    return [found[key] for key in keys]
@@ -1,17 +1,37 @@
+import datetime
 import functools
+import hashlib
+import json
 import os
 import random
 
 import sqlalchemy as sa
 from hashids import Hashids
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import defer
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import NoResultFound
 from twiggy import log
 
+from . import gridpack
+from . import metrics
 from . import models
+from . import render
 
 log = log.name(__name__)
 
 HASH_MIN_LENGTH = 6
 
+# how many ids in the public id range to try before settling for
+# the next id above a random point
+RANDOM_ATTEMPTS = 10
+
+# the keys of a posted grid that are stored as they are, anything
+# else a client sends is ignored so it can't set e.g. grid_html
+POSTED_COLUMNS = (
+    'python_version', 'ipb_version', 'ipb_class', 'code_cells', 'secret',
+    'grid_data')
+
 
 @functools.lru_cache(maxsize=2)
 def get_hashids(secret):
@@ -76,32 +96,191 @@ def decode_hash_id(hash_id, secret):
         return dec[0]
 
 
-def store_grid_entry(session, grid_spec):
+def content_hash(grid_spec):
+    """
+    Hash the parts of a posted grid that determine what's displayed,
+    so that identical posts can share a single stored grid.
+
+    Parameters
+    ----------
+    grid_spec : dict
+
+    Returns
+    -------
+    digest : str
+
+    """
+    content = {
+        key: grid_spec[key]
+        for key in ('grid_data', 'code_cells', 'ipb_class', 'secret')}
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _grid_values(grid_spec, digest, rendered, packed, max_rendered_cells):
+    """
+    Column values for inserting a new grid.
+    Only the keys in `POSTED_COLUMNS` are taken from `grid_spec`.
+
+    """
+    values = dict(
+        {key: grid_spec[key] for key in POSTED_COLUMNS},
+        content_hash=digest,
+        width=grid_spec['grid_data']['width'],
+        height=grid_spec['grid_data']['height'])
+    if packed:
+        values['grid_blob'] = blob = gridpack.pack(grid_spec['grid_data'])
+        if blob is not None:
+            values['grid_data'] = {
+                k: v for k, v in grid_spec['grid_data'].items()
+                if k != 'blocks'}
+    if rendered:
+        too_big = (
+            max_rendered_cells and
+            values['width'] * values['height'] > max_rendered_cells)
+        if too_big:
+            # left unrendered, but with the same columns as the other
+            # grids in a batch so they make one multi-row insert
+            values.update(grid_html=sa.null(), code_html=sa.null(),
+                          render_version=sa.null())
+        else:
+            values.update(render.render_columns(
+                grid_spec['grid_data'], grid_spec['code_cells']))
+    return values
+
+
+def _ids_by_hash(session, table, digests):
+    return dict(session.query(table.content_hash, table.id).filter(
+        table.content_hash.in_(digests)))
+
+
+def store_grid_entries(session, grid_specs, rendered=False, packed=False,
+                       max_rendered_cells=None):
+    """
+    Add many grid specs to the database with one insert per table and
+    return the grids' unique IDs in the same order.
+    Grids identical to one already stored, or to another in `grid_specs`,
+    get the ID of that grid instead of being added again.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+    grid_specs : list of dict
+    rendered : bool, optional
+        Whether to also render the grids and their code cells to HTML
+        and store that with the grids.
+    packed : bool, optional
+        Whether to store the grids' blocks in the compact format
+        from app.gridpack instead of as JSON.
+    max_rendered_cells : int, optional
+        Grids with more blocks than this aren't rendered even if
+        `rendered` is True, their pages are drawn some other way.
+        None or 0 for no limit.
+
+    Returns
+    -------
+    hash_ids : list of str
+
+    """
+    digests = [content_hash(spec) for spec in grid_specs]
+    hash_ids = [None] * len(grid_specs)
+
+    for secret, table in ((False, models.PublicGrid),
+                          (True, models.SecretGrid)):
+        # unique new grids for this table, keyed by content hash
+        specs = {
+            digest: spec for digest, spec in zip(digests, grid_specs)
+            if spec['secret'] == secret}
+        if not specs:
+            continue
+
+        llog = log.fields(secret=secret, count=len(specs))
+        llog.debug('storing grids')
+
+        ids = _ids_by_hash(session, table, specs)
+        new = [digest for digest in specs if digest not in ids]
+
+        if new:
+            # If identical grids are being stored at the same time this
+            # waits for them and then skips them, in which case we look
+            # up their IDs afterward.
+            inserted = session.execute(
+                insert(table.__table__).values([
+                    _grid_values(
+                        specs[digest], digest, rendered, packed,
+                        max_rendered_cells)
+                    for digest in new]).on_conflict_do_nothing(
+                        index_elements=['content_hash']).returning(
+                            table.__table__.c.content_hash,
+                            table.__table__.c.id))
+            ids.update((row.content_hash, row.id) for row in inserted)
+
+            missing = [digest for digest in new if digest not in ids]
+            if missing:
+                ids.update(_ids_by_hash(session, table, missing))
+
+        llog.fields(new=len(new)).debug('grids stored')
+
+        for i, digest in enumerate(digests):
+            if grid_specs[i]['secret'] == secret:
+                hash_ids[i] = encode_grid_id(ids[digest], secret)
+
+    return hash_ids
+
+
+def store_grid_entry(session, grid_spec, rendered=False, packed=False,
+                     max_rendered_cells=None):
     """
     Add a grid spec to the database and return the grid's unique ID.
+    If an identical grid has already been stored the existing grid's
+    ID is returned instead of adding a new one.
 
     Parameters
     ----------
     session : sqlalchemy.orm.session.Session
     grid_spec : dict
+    rendered : bool, optional
+        Whether to also render the grid and its code cells to HTML
+        and store that with the grid.
+    packed : bool, optional
+        Whether to store the grid's blocks in the compact format
+        from app.gridpack instead of as JSON.
+    max_rendered_cells : int, optional
+        The grid isn't rendered if it has more blocks than this.
+        None or 0 for no limit.
 
     Returns
     -------
     hash_id : str
 
     """
-    llog = log.fields(secret=grid_spec['secret'])
-    llog.debug('storing grid')
+    hash_id, = store_grid_entries(
+        session, [grid_spec], rendered=rendered, packed=packed,
+        max_rendered_cells=max_rendered_cells)
+    return hash_id
 
-    table = models.SecretGrid if grid_spec['secret'] else models.PublicGrid
-    new_grid = table(**grid_spec)
-    session.add(new_grid)
-    session.flush()
-    hash_id = encode_grid_id(new_grid.id, grid_spec['secret'])
 
-    llog.fields(grid_id=new_grid.id, hash_id=hash_id).debug('grid stored')
+def load_grid_data(grid_spec):
+    """
+    Get a grid entry's grid data including its blocks, unpacking them
+    if they were stored in packed form and adding them to the rest of
+    the grid data.
+    Packed blocks are returned as a read-only array instead of lists.
 
-    return hash_id
+    Parameters
+    ----------
+    grid_spec : PublicGrid or SecretGrid
+
+    Returns
+    -------
+    grid_data : dict
+
+    """
+    if grid_spec.grid_blob is not None:
+        # keys other than the packed ones are still kept in grid_data
+        return dict(
+            grid_spec.grid_data, **gridpack.unpack(grid_spec.grid_blob))
+    return grid_spec.grid_data
 
 
 def get_grid_entry(session, hash_id, secret=False):
@@ -135,10 +314,275 @@ def get_grid_entry(session, hash_id, secret=False):
     return grid_spec
 
 
+def get_grid_json(session, hash_id, secret=False):
+    """
+    Get a grid's data as JSON text, straight from the database for
+    grids stored as JSON so it's never decoded into Python objects.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+    hash_id : str
+    secret : bool, optional
+        Whether this is a secret grid.
+
+    Returns
+    -------
+    grid_json : str
+    created_at : datetime.datetime
+        Will be None instead of a tuple if no matching grid was found.
+
+    """
+    grid_id = decode_hash_id(hash_id, secret)
+    llog = log.fields(grid_id=grid_id, hash_id=hash_id, secret=secret)
+    if not grid_id:
+        llog.debug('cannot decrypt hash')
+        return
+
+    llog.debug('pulling grid JSON from database')
+    table = models.SecretGrid if secret else models.PublicGrid
+    row = session.query(
+        sa.cast(table.grid_data, sa.Text), table.grid_blob,
+        table.created_at).filter(table.id == grid_id).one_or_none()
+
+    if row is None:
+        return
+
+    grid_json, grid_blob, created_at = row
+    if grid_blob is not None:
+        grid_data = dict(json.loads(grid_json), **gridpack.unpack(grid_blob))
+        grid_data['blocks'] = grid_data['blocks'].tolist()
+        grid_json = json.dumps(grid_data)
+
+    return grid_json, created_at
+
+
+def get_grid_data(session, hash_id, secret=False):
+    """
+    Get just a grid's data, without its code cells or rendered HTML.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+    hash_id : str
+    secret : bool, optional
+        Whether this is a secret grid.
+
+    Returns
+    -------
+    grid_data : dict
+    created_at : datetime.datetime
+        Will be None instead of a tuple if no matching grid was found.
+
+    """
+    grid_id = decode_hash_id(hash_id, secret)
+    llog = log.fields(grid_id=grid_id, hash_id=hash_id, secret=secret)
+    if not grid_id:
+        llog.debug('cannot decrypt hash')
+        return
+
+    llog.debug('pulling grid data from database')
+    table = models.SecretGrid if secret else models.PublicGrid
+    row = session.query(
+        table.grid_data, table.grid_blob, table.created_at).filter(
+            table.id == grid_id).one_or_none()
+
+    if row is None:
+        return
+
+    return load_grid_data(row), row.created_at
+
+
+def exceeds_cells(grid_spec, max_cells):
+    """
+    Whether a stored grid has more than `max_cells` blocks.
+    Grids stored before their dimensions were recorded never do.
+
+    Parameters
+    ----------
+    grid_spec : PublicGrid or SecretGrid
+    max_cells : int or None
+        None or 0 for no limit.
+
+    Returns
+    -------
+    exceeds : bool
+
+    """
+    if not max_cells:
+        return False
+    return (grid_spec.width or 0) * (grid_spec.height or 0) > max_cells
+
+
+def get_rendered_grid_entry(session, hash_id, secret=False, max_cells=None):
+    """
+    Get a specific grid entry with up to date rendered HTML.
+
+    The grid's data is only loaded from the database if its stored
+    rendering is missing or was made by an older renderer, in which case
+    the grid is rendered again and the result saved with the grid.
+    The returned grid's ``grid_data`` and ``grid_blob`` attributes
+    should not be used.
+
+    Grids with more than `max_cells` blocks are left for the caller to
+    draw some other way. Their stored HTML is never read and they
+    aren't rendered again when stale.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+    hash_id : str
+    secret : bool, optional
+        Whether this is a secret grid.
+    max_cells : int, optional
+        Largest grid, in blocks, to return rendered.
+
+    Returns
+    -------
+    grid_spec : PublicGrid or SecretGrid
+        Will be None if no matching grid was found.
+
+    """
+    grid_id = decode_hash_id(hash_id, secret)
+    llog = log.fields(grid_id=grid_id, hash_id=hash_id, secret=secret)
+    if not grid_id:
+        llog.debug('cannot decrypt hash')
+        return
+
+    llog.debug('pulling rendered grid from database')
+    table = models.SecretGrid if secret else models.PublicGrid
+    grid_html = table.grid_html
+    if max_cells:
+        # the same test as exceeds_cells, done in the query so that
+        # large renderings don't leave the database
+        grid_html = sa.case(
+            [(table.width * table.height > max_cells, sa.null())],
+            else_=table.grid_html)
+
+    with metrics.STAGE_SECONDS.time(stage='db_fetch'):
+        row = session.query(table, grid_html).options(
+            defer(table.grid_data), defer(table.grid_blob),
+            defer(table.grid_html)).filter(
+                table.id == grid_id).one_or_none()
+
+    if row is None:
+        return
+
+    grid_spec, grid_html = row
+    if exceeds_cells(grid_spec, max_cells):
+        return grid_spec
+
+    set_committed_value(grid_spec, 'grid_html', grid_html)
+
+    if grid_spec.render_version != render.RENDERER_VERSION:
+        llog.fields(render_version=grid_spec.render_version).debug(
+            'rendering stale grid')
+        for key, value in render.render_columns(
+                load_grid_data(grid_spec), grid_spec.code_cells).items():
+            setattr(grid_spec, key, value)
+
+    return grid_spec
+
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def encode_cursor(created_at, grid_id):
+    """
+    Make an opaque cursor marking a position in the public grid listing.
+
+    """
+    micros = (created_at - _EPOCH) // datetime.timedelta(microseconds=1)
+    return get_hashids(secret=False).encrypt(micros, grid_id)
+
+
+def decode_cursor(cursor):
+    """
+    Get back the (created_at, grid_id) from a cursor made by
+    `encode_cursor`, or None if it isn't a valid cursor.
+
+    """
+    hashids = get_hashids(secret=False)
+    decoded = hashids.decrypt(cursor)
+    # decrypt doesn't reject every string that isn't a real cursor
+    if len(decoded) != 2 or hashids.encrypt(*decoded) != cursor:
+        return
+
+    micros, grid_id = decoded
+    return _EPOCH + datetime.timedelta(microseconds=micros), grid_id
+
+
+def list_public_grids(session, limit, cursor=None):
+    """
+    List public grids, newest first, a page at a time.
+
+    Pages are found by seeking past the (created_at, id) of the last
+    grid on the previous page using the index on those columns, so
+    later pages are as quick to get as the first. Only small columns
+    are read, never the grids themselves.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+    limit : int
+        Most grids to return.
+    cursor : str, optional
+        The `next_cursor` returned with the previous page.
+
+    Returns
+    -------
+    grids : list of dict
+        With keys hash_id, width, height, ipb_class, and created_at.
+    next_cursor : str
+        Will be None if this is the last page.
+
+    Raises
+    ------
+    ValueError
+        If `cursor` is not a valid cursor.
+
+    """
+    table = models.PublicGrid
+    query = session.query(
+        table.id, table.width, table.height, table.ipb_class,
+        table.created_at)
+
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        if position is None:
+            raise ValueError('Invalid cursor {!r}.'.format(cursor))
+        query = query.filter(
+            sa.tuple_(table.created_at, table.id) < sa.tuple_(*position))
+
+    rows = query.order_by(
+        table.created_at.desc(), table.id.desc()).limit(limit + 1).all()
+
+    grids = [{
+        'hash_id': encode_grid_id(row.id, secret=False),
+        'width': row.width,
+        'height': row.height,
+        'ipb_class': row.ipb_class,
+        'created_at': row.created_at,
+    } for row in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last.created_at, last.id)
+
+    return grids, next_cursor
+
+
 def get_random_hash_id(session):
     """
     Get a random, non-secret grid id.
 
+    Random ids are drawn from the range of existing public ids and
+    looked up by primary key until one exists, so every grid is equally
+    likely and the cost doesn't grow with the size of the table.
+    If the id range is too sparse to get a hit in `RANDOM_ATTEMPTS` tries
+    the next existing id above a random point is used instead.
+
     Parameters
     ----------
     session : sqlalchemy.orm.session.Session
@@ -148,6 +592,24 @@ def get_random_hash_id(session):
     hash_id : str
 
     """
-    grid = session.query(
-        models.PublicGrid).order_by(sa.func.random()).limit(1).one()
-    return encode_grid_id(grid.id, secret=False)
+    table = models.PublicGrid
+    min_id, max_id = session.query(
+        sa.func.min(table.id), sa.func.max(table.id)).one()
+    if min_id is None:
+        raise NoResultFound('No public grids to choose from.')
+
+    for attempt in range(1, RANDOM_ATTEMPTS + 1):
+        grid_id = session.query(table.id).filter(
+            table.id == random.randint(min_id, max_id)).scalar()
+        if grid_id is not None:
+            metrics.RANDOM_LOOKUPS.observe(attempt)
+            return encode_grid_id(grid_id, secret=False)
+
+    metrics.RANDOM_LOOKUPS.observe(RANDOM_ATTEMPTS + 1)
+    metrics.RANDOM_FALLBACKS.inc()
+    log.fields(min_id=min_id, max_id=max_id).debug(
+        'random id sampling missed, using next id')
+    grid_id = session.query(table.id).filter(
+        table.id >= random.randint(min_id, max_id)).order_by(
+            table.id).limit(1).scalar()
+    return encode_grid_id(grid_id, secret=False)
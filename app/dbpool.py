@@ -0,0 +1,181 @@
+"""Database engine creation with a tuned, instrumented connection pool"""
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from twiggy import log
+
+log = log.name(__name__)
+
+# log connection checkouts that wait at least this many seconds
+SLOW_CHECKOUT = 1.0
+
+
+class PoolStats:
+    """
+    Counters describing how an engine's connection pool is being used.
+    Checkouts are recorded by `connect`, which should be used instead of
+    ``engine.connect`` so that waiting for a connection is measured.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+
+    Attributes
+    ----------
+    checkouts : int
+        Connections handed out by `connect`.
+    checkout_seconds : float
+        Total time spent waiting in `connect`.
+    max_checkout_seconds : float
+        Longest single wait in `connect`.
+    timeouts : int
+        Times `connect` gave up waiting for a free connection.
+    disconnects : int
+        Stale connections found and replaced by the checkout ping.
+
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.checkouts = 0
+        self.checkout_seconds = 0.0
+        self.max_checkout_seconds = 0.0
+        self.timeouts = 0
+        self.disconnects = 0
+
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        Check a connection out of the engine's pool,
+        recording how long that took.
+
+        Returns
+        -------
+        connection : sqlalchemy.engine.Connection
+
+        """
+        start = time.perf_counter()
+        try:
+            connection = self.engine.connect()
+        except sa.exc.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            log.fields(**self.pool_status()).warning(
+                'timed out waiting for a database connection')
+            raise
+
+        wait = time.perf_counter() - start
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_seconds += wait
+            self.max_checkout_seconds = max(self.max_checkout_seconds, wait)
+
+        if wait >= SLOW_CHECKOUT:
+            log.fields(wait=wait, **self.pool_status()).info(
+                'slow database connection checkout')
+
+        return connection
+
+    def record_disconnect(self):
+        with self._lock:
+            self.disconnects += 1
+
+    def pool_status(self):
+        """
+        Return a dict describing the pool's current connections.
+
+        """
+        pool = self.engine.pool
+        return {
+            'size': pool.size(),
+            'in_use': pool.checkedout(),
+            'idle': pool.checkedin(),
+            'overflow': max(0, pool.overflow()),
+        }
+
+    def stats(self):
+        """
+        Return a dict of the pool's counters and current connections.
+
+        """
+        stats = {
+            'checkouts': self.checkouts,
+            'checkout_seconds': self.checkout_seconds,
+            'max_checkout_seconds': self.max_checkout_seconds,
+            'timeouts': self.timeouts,
+            'disconnects': self.disconnects,
+        }
+        stats.update(self.pool_status())
+        return stats
+
+
+def _add_pre_ping(engine, stats):
+    """
+    Test connections as they're checked out of the pool so that ones the
+    server has closed are replaced instead of failing a request.
+
+    """
+    @event.listens_for(engine, 'checkout')
+    def ping_connection(dbapi_connection, connection_record, proxy):
+        try:
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+        except Exception:
+            stats.record_disconnect()
+            log.debug('replacing stale database connection')
+            # tells the pool to reconnect and try the checkout again
+            raise sa.exc.DisconnectionError()
+
+
+def make_engine(url, pool_size=5, max_overflow=10, pool_timeout=30,
+                pool_recycle=-1, pre_ping=True, statement_timeout=0):
+    """
+    Create a database engine and the stats that instrument its pool.
+
+    Parameters
+    ----------
+    url : str
+    pool_size : int, optional
+        Connections kept open in the pool.
+    max_overflow : int, optional
+        Connections that may be opened beyond `pool_size` under load.
+    pool_timeout : float, optional
+        Seconds to wait for a free connection before giving up.
+    pool_recycle : int, optional
+        Seconds after which connections are replaced. -1 to never replace.
+    pre_ping : bool, optional
+        Whether to test connections when they're checked out of the pool.
+    statement_timeout : int, optional
+        Milliseconds Postgres may spend on one statement. 0 for no limit.
+
+    Returns
+    -------
+    engine : sqlalchemy.engine.Engine
+    stats : PoolStats
+
+    """
+    connect_args = {}
+    if statement_timeout:
+        connect_args['options'] = '-c statement_timeout={:d}'.format(
+            statement_timeout)
+
+    engine = sa.create_engine(
+        url,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        connect_args=connect_args)
+    stats = PoolStats(engine)
+
+    if pre_ping:
+        _add_pre_ping(engine, stats)
+
+    return engine, stats
@@ -0,0 +1,112 @@
+"""
+Compact binary storage for grid blocks.
+
+A packed grid is a fixed size header followed by the grid's blocks as
+a row-major (height, width, 4) array of unsigned integers in the
+smallest type that holds them, optionally zlib compressed.
+
+Header fields, little-endian:
+
+- magic bytes ``IPB1``
+- width, height : uint32
+- lines_on : uint8
+- item size of the block array in bytes (1, 2, or 4) : uint8
+- compression (0 for none, 1 for zlib) : uint8
+
+"""
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b'IPB1'
+HEADER = struct.Struct('<4sIIBBB')
+
+NO_COMPRESSION = 0
+ZLIB = 1
+
+_DTYPES = {1: np.dtype('<u1'), 2: np.dtype('<u2'), 4: np.dtype('<u4')}
+
+
+def pack(grid_data, compress=True):
+    """
+    Pack grid data into bytes.
+
+    Parameters
+    ----------
+    grid_data : dict
+        Grid data with ``lines_on``, ``width``, ``height``,
+        and ``blocks`` keys, as posted.
+    compress : bool, optional
+        Whether to zlib compress the block array.
+
+    Returns
+    -------
+    blob : bytes
+        Will be None if some block value is negative or too big to pack,
+        or the blocks aren't a (height, width, 4) array.
+
+    """
+    try:
+        arr = np.asarray(grid_data['blocks'], dtype=np.int64)
+    except (OverflowError, ValueError, TypeError):
+        # ValueError is ragged rows, TypeError values that aren't numbers
+        return
+
+    if arr.shape != (grid_data['height'], grid_data['width'], 4):
+        return
+
+    high = arr.max()
+    if arr.min() < 0 or high > np.iinfo(np.uint32).max:
+        return
+
+    for itemsize, dtype in sorted(_DTYPES.items()):
+        if high <= np.iinfo(dtype).max:
+            break
+
+    data = arr.astype(dtype).tobytes()
+    compression = NO_COMPRESSION
+    if compress:
+        data = zlib.compress(data)
+        compression = ZLIB
+
+    header = HEADER.pack(
+        MAGIC, grid_data['width'], grid_data['height'],
+        int(grid_data['lines_on']), itemsize, compression)
+    return header + data
+
+
+def unpack(blob):
+    """
+    Unpack a grid packed by `pack`.
+
+    Uncompressed blocks are returned as a read-only view of `blob`
+    without being copied.
+
+    Parameters
+    ----------
+    blob : bytes or memoryview
+
+    Returns
+    -------
+    grid_data : dict
+        Grid data with ``lines_on``, ``width``, and ``height`` keys
+        and ``blocks`` as a (height, width, 4) array.
+
+    """
+    magic, width, height, lines_on, itemsize, compression = \
+        HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError('Not a packed grid.')
+
+    data = memoryview(blob)[HEADER.size:]
+    if compression == ZLIB:
+        data = zlib.decompress(data)
+
+    blocks = np.frombuffer(data, dtype=_DTYPES[itemsize])
+    return {
+        'lines_on': bool(lines_on),
+        'width': width,
+        'height': height,
+        'blocks': blocks.reshape(height, width, 4)
+    }
@@ -0,0 +1,261 @@
+"""
+Draw stored grids as PNG and SVG images straight from their block data.
+
+Pixels are laid out with NumPy, one block's color repeated over its
+square plus optional grid lines, and PNGs are encoded with zlib alone.
+Thumbnails average blocks down to fit a small square.
+
+Grids can also be packed raw, one RGB triple per block, for
+static/gridcanvas.js to draw in the browser.
+
+"""
+import gzip
+import struct
+import zlib
+
+import numpy as np
+
+from .render import _as_block_array
+
+# Bump this whenever the images drawn for grids change so that
+# cached copies held by browsers and proxies are invalidated.
+IMAGE_VERSION = '1'
+
+# blocks are shrunk, or averaged together, so images are never wider
+# or taller than this many pixels
+MAX_IMAGE_SIDE = 2048
+THUMB_SIDE = 200
+
+# width of grid lines in pixels when a grid has lines_on
+LINE_WIDTH = 1
+LINE_COLOR = (255, 255, 255)
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'thumb': 'image/png',
+    'raw': 'application/octet-stream',
+}
+
+# header of the raw format, little-endian: magic, width, height,
+# block size, lines_on. Must match static/gridcanvas.js.
+RAW_HEADER = struct.Struct('<4sIIHB')
+RAW_MAGIC = b'IPBR'
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG filter type that stores each row as its difference from the
+# row above, which turns the repeated rows of a block into zeros
+_PNG_FILTER_UP = 2
+
+
+def _block_colors(grid_data):
+    """
+    Get the grid's colors as a (height, width, 3) uint8 array and the
+    side length of its blocks in pixels.
+
+    """
+    colors, sizes = _as_block_array(grid_data)
+    block = int(min(sizes.max(), MAX_IMAGE_SIDE))
+    return colors.astype(np.uint8), block
+
+
+def _shrink(colors, max_side):
+    """
+    Average squares of blocks together so that neither side of
+    `colors` is longer than `max_side`.
+
+    """
+    height, width, _ = colors.shape
+    factor = -(-max(height, width) // max_side)
+    if factor <= 1:
+        return colors
+
+    # repeat the edge blocks to fill out the last squares
+    pad_h = -height % factor
+    pad_w = -width % factor
+    padded = np.pad(colors, ((0, pad_h), (0, pad_w), (0, 0)), mode='edge')
+    squares = padded.reshape(
+        padded.shape[0] // factor, factor,
+        padded.shape[1] // factor, factor, 3)
+    return squares.mean(axis=(1, 3)).round().astype(np.uint8)
+
+
+def _layout(colors, block, lines_on, max_side=MAX_IMAGE_SIDE):
+    """
+    Choose the block size and line width to draw `colors` with so the
+    image fits in `max_side`, averaging blocks together if even one
+    pixel per block is too big.
+
+    Returns the (possibly shrunk) colors, block size, and line width.
+
+    """
+    line = LINE_WIDTH if lines_on else 0
+    colors = _shrink(colors, max_side)
+    blocks = max(colors.shape[:2])
+
+    if blocks * (block + line) + line > max_side:
+        block = max(1, (max_side - line) // blocks - line)
+    if blocks * (block + line) + line > max_side:
+        # no room for lines between one pixel blocks
+        line = 0
+
+    return colors, block, line
+
+
+def grid_pixels(colors, block, line):
+    """
+    Draw blocks of `colors` as a (height, width, 3) uint8 array of
+    pixels, with `block` pixels per block and `line` pixels of
+    `LINE_COLOR` around each block.
+
+    """
+    pitch = block + line
+
+    def block_index(n_blocks):
+        # the block each pixel along one axis belongs to,
+        # or -1 for pixels on grid lines
+        pixels = np.arange(n_blocks * pitch + line)
+        offset = pixels - line
+        index = offset // pitch
+        index[(offset < 0) | (offset % pitch >= block)] = -1
+        return index
+
+    rows = block_index(colors.shape[0])
+    cols = block_index(colors.shape[1])
+
+    pixels = np.empty((len(rows), len(cols), 3), dtype=np.uint8)
+    pixels[...] = LINE_COLOR
+    in_rows = rows >= 0
+    in_cols = cols >= 0
+    pixels[np.ix_(in_rows, in_cols)] = colors[np.ix_(
+        rows[in_rows], cols[in_cols])]
+    return pixels
+
+
+def _png_chunk(tag, data):
+    return b''.join([
+        struct.pack('>I', len(data)),
+        tag,
+        data,
+        struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)])
+
+
+def encode_png(pixels):
+    """
+    Encode a (height, width, 3) uint8 array as an RGB PNG.
+
+    """
+    height, width, _ = pixels.shape
+    rows = pixels.reshape(height, width * 3)
+
+    raw = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 0] = _PNG_FILTER_UP
+    raw[0, 1:] = rows[0]
+    # uint8 arithmetic wraps around the same way the PNG filter does
+    raw[1:, 1:] = rows[1:] - rows[:-1]
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b''.join([
+        _PNG_SIGNATURE,
+        _png_chunk(b'IHDR', header),
+        _png_chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+        _png_chunk(b'IEND', b'')])
+
+
+def encode_svg(colors, block, line):
+    """
+    Draw blocks of `colors` as SVG, with one rectangle per run of
+    same colored blocks in each row and grid lines drawn over them.
+
+    """
+    height, width, _ = colors.shape
+    pitch = block + line
+    img_width = width * pitch + line
+    img_height = height * pitch + line
+
+    # where a new run of colors starts in each row
+    starts = np.ones((height, width), dtype=bool)
+    starts[:, 1:] = (colors[:, 1:] != colors[:, :-1]).any(axis=2)
+    run_rows, run_starts = np.nonzero(starts)
+    last_in_row = np.append(run_rows[1:] != run_rows[:-1], True)
+    run_ends = np.where(last_in_row, width, np.append(run_starts[1:], width))
+
+    run_colors = colors[run_rows, run_starts].astype(np.uint32)
+    uniq, inverse = np.unique(
+        run_colors[:, 0] << 16 | run_colors[:, 1] << 8 | run_colors[:, 2],
+        return_inverse=True)
+    fills = ['#{:06x}'.format(c) for c in uniq.tolist()]
+
+    parts = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" '
+        'viewBox="0 0 {0} {1}" shape-rendering="crispEdges">'.format(
+            img_width, img_height)]
+    parts.extend(
+        '<rect x="{}" y="{}" width="{}" height="{}" fill="{}"/>'.format(
+            line + start * pitch, line + row * pitch,
+            (end - start) * pitch - line, block, fills[i])
+        for row, start, end, i in zip(
+            run_rows.tolist(), run_starts.tolist(), run_ends.tolist(),
+            inverse.tolist()))
+
+    if line:
+        # lines run through the middle of the gaps between blocks
+        path = ''.join(
+            'M{} 0V{}'.format(i * pitch + line / 2, img_height)
+            for i in range(width + 1))
+        path += ''.join(
+            'M0 {}H{}'.format(i * pitch + line / 2, img_width)
+            for i in range(height + 1))
+        parts.append(
+            '<path d="{}" stroke="rgb({},{},{})" stroke-width="{}"/>'.format(
+                path, *LINE_COLOR, line))
+
+    parts.append('</svg>')
+    return ''.join(parts).encode('utf-8')
+
+
+def encode_raw(colors, block, lines_on):
+    """
+    Pack blocks of `colors` for drawing in the browser: a header
+    followed by the RGB of each block, row by row, gzip compressed
+    so it can be sent as is to clients accepting gzip.
+
+    """
+    height, width, _ = colors.shape
+    header = RAW_HEADER.pack(RAW_MAGIC, width, height, block, int(lines_on))
+    return gzip.compress(header + colors.tobytes(), compresslevel=6)
+
+
+def encode(grid_data, kind):
+    """
+    Draw a grid as an image.
+
+    Parameters
+    ----------
+    grid_data : dict
+    kind : {'png', 'svg', 'thumb', 'raw'}
+        A full size PNG or SVG, a PNG thumbnail fitting in
+        `THUMB_SIDE` pixels without grid lines, or the raw blocks
+        (see `encode_raw`).
+
+    Returns
+    -------
+    image : bytes
+
+    """
+    colors, block = _block_colors(grid_data)
+
+    if kind == 'raw':
+        return encode_raw(colors, block, grid_data['lines_on'])
+    elif kind == 'thumb':
+        colors = _shrink(colors, THUMB_SIDE)
+        block = max(1, THUMB_SIDE // max(colors.shape[:2]))
+        return encode_png(grid_pixels(colors, block, 0))
+
+    colors, block, line = _layout(colors, block, grid_data['lines_on'])
+    if kind == 'png':
+        return encode_png(grid_pixels(colors, block, line))
+    elif kind == 'svg':
+        return encode_svg(colors, block, line)
+    else:
+        raise ValueError('Unknown image kind {!r}.'.format(kind))
@@ -0,0 +1,301 @@
+"""
+Request and stage metrics kept in process memory and exposed in the
+Prometheus text format, without needing any external service.
+
+Metrics are defined at module level and registered in `REGISTRY`.
+Each worker process keeps its own values.
+
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 256 bytes to 64 MB in powers of 4
+BYTE_BUCKETS = tuple(256 * 4 ** i for i in range(10))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return (str(value).replace('\\', r'\\')
+                .replace('"', r'\"').replace('\n', r'\n'))
+
+    return '{' + ','.join(
+        '{}="{}"'.format(k, escape(v)) for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base class for metrics with a value per combination of labels.
+
+    Parameters
+    ----------
+    name : str
+    help : str
+    labelnames : sequence of str, optional
+
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} takes labels {}, got {}.'.format(
+                self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _labels(self, key):
+        return list(zip(self.labelnames, key))
+
+    def samples(self):
+        """
+        Yield (name, labels, value) for every sample of this metric,
+        where labels is a list of (label name, value) pairs.
+
+        """
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, self._labels(key), value
+
+    def exposition(self):
+        """
+        Return this metric in the Prometheus text format.
+
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend(
+            '{}{} {}'.format(name, _format_labels(labels), _format_value(v))
+            for name, labels, v in self.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """
+        Set the count directly, for counts kept by another object.
+
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Counts of observed values in cumulative buckets,
+    plus their sum and count.
+
+    Parameters
+    ----------
+    name : str
+    help : str
+    labelnames : sequence of str, optional
+    buckets : sequence of float, optional
+        Upper bounds of the buckets, in increasing order.
+
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds taken by the body of a ``with`` block.
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(
+                (key, (list(counts), total))
+                for key, (counts, total) in self._values.items())
+
+        bounds = self.buckets + (float('inf'),)
+        for key, (counts, total) in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       labels + [('le', _format_value(bound))],
+                       cumulative)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+    def exposition(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, labels, v in self.samples():
+            # bucket bounds are already formatted
+            lines.append('{}{} {}'.format(
+                name, _format_labels(labels), _format_value(v)))
+        return '\n'.join(lines) + '\n'
+
+
+class Registry:
+    """
+    A collection of metrics to expose together.
+
+    """
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """
+        Return all registered metrics in the Prometheus text format.
+
+        """
+        return ''.join(m.exposition() for m in self._metrics)
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'ipborg_requests_total', 'HTTP requests served.',
+    ['handler', 'method', 'status']))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'ipborg_request_seconds', 'Time to serve HTTP requests.',
+    ['handler', 'status']))
+REQUEST_BYTES = REGISTRY.register(Histogram(
+    'ipborg_request_body_bytes', 'Size of HTTP request bodies.',
+    ['handler'], buckets=BYTE_BUCKETS))
+RESPONSE_BYTES = REGISTRY.register(Histogram(
+    'ipborg_response_body_bytes',
+    'Size of HTTP response bodies as sent, after compression.',
+    ['handler'], buckets=BYTE_BUCKETS))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'ipborg_stage_seconds',
+    'Time spent in stages of handling a request: db_fetch, grid_render, '
+    'colorize, template_render, image_encode, and validate.',
+    ['stage']))
+RANDOM_LOOKUPS = REGISTRY.register(Histogram(
+    'ipborg_random_lookups',
+    'Primary key lookups made to pick a random grid.',
+    buckets=(1, 2, 3, 5, 10)))
+RANDOM_FALLBACKS = REGISTRY.register(Counter(
+    'ipborg_random_fallbacks_total',
+    'Random grid picks that fell back to the next id above a random point.'))
+
+CACHE_EVENTS = REGISTRY.register(Counter(
+    'ipborg_cache_events_total', 'Cache hits, misses, and evictions.',
+    ['cache', 'event']))
+CACHE_BYTES = REGISTRY.register(Gauge(
+    'ipborg_cache_bytes', 'Size of cached values.', ['cache']))
+CACHE_ENTRIES = REGISTRY.register(Gauge(
+    'ipborg_cache_entries', 'Number of cached values.', ['cache']))
+
+POOL_EVENTS = REGISTRY.register(Counter(
+    'ipborg_db_pool_events_total',
+    'Database connection checkouts, checkout timeouts, '
+    'and stale connections replaced.',
+    ['engine', 'event']))
+POOL_CHECKOUT_SECONDS = REGISTRY.register(Counter(
+    'ipborg_db_pool_checkout_seconds_total',
+    'Total time spent waiting for database connections.', ['engine']))
+POOL_CONNECTIONS = REGISTRY.register(Gauge(
+    'ipborg_db_pool_connections',
+    'Database connections by state: in_use, idle, and overflow.',
+    ['engine', 'state']))
+
+READ_RETRIES = REGISTRY.register(Counter(
+    'ipborg_db_read_retries_total',
+    'Reads retried on the primary database after a read replica '
+    'found nothing (miss) or failed (error).',
+    ['reason']))
+
+SINGLE_FLIGHT = REGISTRY.register(Counter(
+    'ipborg_single_flight_total',
+    'Lookups that went to the database (leader) or waited for an '
+    'identical lookup already in flight (follower).',
+    ['kind', 'role']))
+
+POST_REJECTIONS = REGISTRY.register(Counter(
+    'ipborg_post_rejections_total',
+    'Posts turned away before reading their body: too_large, '
+    'rate_limited, or overloaded.',
+    ['reason']))
+POSTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'ipborg_posts_in_flight', 'Posts being handled right now.'))
+
+
+def record_cache_stats(cache_name, stats):
+    """
+    Copy the stats of a `cache.ByteLRUCache` or `cache.DiskCache`
+    into the cache metrics.
+
+    """
+    for event in ('hits', 'misses', 'evictions'):
+        CACHE_EVENTS.set(stats[event], cache=cache_name, event=event)
+    CACHE_BYTES.set(stats['bytes'], cache=cache_name)
+    CACHE_ENTRIES.set(stats['entries'], cache=cache_name)
+
+
+def record_pool_stats(engine_name, stats):
+    """
+    Copy the stats of a `dbpool.PoolStats` into the pool metrics.
+
+    """
+    for event in ('checkouts', 'timeouts', 'disconnects'):
+        POOL_EVENTS.set(stats[event], engine=engine_name, event=event)
+    POOL_CHECKOUT_SECONDS.set(stats['checkout_seconds'], engine=engine_name)
+    for state in ('in_use', 'idle', 'overflow'):
+        POOL_CONNECTIONS.set(stats[state], engine=engine_name, state=state)
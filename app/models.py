@@ -14,8 +14,21 @@ class CommonColumnsMixin:
     ipb_version = sa.Column(sa.Text, nullable=False)
     python_version = sa.Column(pg.JSONB, nullable=False)
     grid_data = sa.Column(pg.JSONB, nullable=False)
+    # blocks packed by app.gridpack, when present grid_data
+    # holds everything except the blocks
+    grid_blob = sa.Column(pg.BYTEA)
     code_cells = sa.Column(pg.JSONB)
     ipb_class = sa.Column(sa.Text, nullable=False)
+    # copied out of grid_data so listings don't have to read it
+    width = sa.Column(sa.Integer)
+    height = sa.Column(sa.Integer)
+    # hash of the posted content, see dbinterface.content_hash
+    content_hash = sa.Column(sa.Text, unique=True)
+    # HTML for the grid and its code cells saved at write time,
+    # stamped with the app.render.RENDERER_VERSION that made them
+    grid_html = sa.Column(sa.Text)
+    code_html = sa.Column(pg.JSONB)
+    render_version = sa.Column(sa.Text)
     created_at = sa.Column(
         sa.DateTime(timezone=True), nullable=False,
         server_default=sa.text('NOW()'))
@@ -24,6 +37,10 @@ class CommonColumnsMixin:
 class PublicGrid(CommonColumnsMixin, Base):
     """Table to hold public grids (discoverable via "random")"""
     __tablename__ = 'public_grids'
+    # for paging through the gallery newest first
+    __table_args__ = (
+        sa.Index('public_grids_created_at_id_idx', 'created_at', 'id'),
+        CommonColumnsMixin.__table_args__)
 
     # no-op column, but put it here anyway
     secret = sa.Column(sa.Boolean, nullable=False, default=False)
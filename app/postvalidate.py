@@ -1,3 +1,17 @@
+"""
+Validation of posted grids.
+
+`schema` describes a valid post in full, but walking every block of a
+large grid with a generic JSON Schema validator is slow. `validate` checks
+everything except the contents of ``grid_data.blocks`` with a validator
+compiled once from `schema`, then checks the blocks in bulk.
+
+"""
+import copy
+import itertools
+
+import jsonschema
+
 schema = {
     '$schema': 'http://json-schema.org/draft-04/schema#',
     'title': 'Grid Post Schema',
@@ -75,3 +89,88 @@ schema = {
     'required': ['python_version', 'ipb_version', 'ipb_class', 'code_cells',
                  'secret', 'grid_data']
 }
+
+# The same as schema except grid_data.blocks is only required to be a
+# non-empty array. Its contents are checked by check_blocks.
+envelope_schema = copy.deepcopy(schema)
+envelope_schema['properties']['grid_data']['properties']['blocks'] = {
+    'description': 'Block colors and sizes in nested lists.',
+    'type': 'array',
+    'minItems': 1
+}
+
+_ENVELOPE_VALIDATOR = jsonschema.Draft4Validator(envelope_schema)
+
+
+def check_blocks(blocks, width, height):
+    """
+    Check grid blocks against `schema`, and that they have the stated
+    width and height, which `schema` can't express.
+
+    This works on all of the blocks at once with ``map`` and ``set``
+    instead of visiting each of them from Python.
+
+    Parameters
+    ----------
+    blocks : list
+        Rows of blocks as decoded from JSON.
+    width, height : int
+
+    Raises
+    ------
+    jsonschema.ValidationError
+
+    """
+    if set(map(type, blocks)) != {list}:
+        raise jsonschema.ValidationError('Grid rows must be arrays.')
+    if len(blocks) != height:
+        raise jsonschema.ValidationError(
+            'Grid has {} rows, expected {}.'.format(len(blocks), height))
+    if set(map(len, blocks)) != {width}:
+        raise jsonschema.ValidationError(
+            'Every grid row must have {} blocks.'.format(width))
+
+    cells = list(itertools.chain.from_iterable(blocks))
+    if set(map(type, cells)) != {list}:
+        raise jsonschema.ValidationError('Blocks must be arrays.')
+    if set(map(len, cells)) != {4}:
+        raise jsonschema.ValidationError('Blocks must have 4 items.')
+
+    values = list(itertools.chain.from_iterable(cells))
+    # checking exact types excludes bools, which JSON Schema doesn't
+    # consider integers
+    if set(map(type, values)) != {int}:
+        raise jsonschema.ValidationError('Block items must be integers.')
+    if min(values) < 0:
+        raise jsonschema.ValidationError('Block items must not be negative.')
+
+
+def validate(req_data, max_width=None, max_height=None):
+    """
+    Validate a decoded grid post.
+
+    Parameters
+    ----------
+    req_data : object
+        Decoded JSON from the body of a post.
+    max_width, max_height : int, optional
+        Largest grid dimensions allowed. No limit if not given.
+
+    Raises
+    ------
+    jsonschema.ValidationError
+
+    """
+    _ENVELOPE_VALIDATOR.validate(req_data)
+
+    gd = req_data['grid_data']
+    width, height = gd['width'], gd['height']
+    if max_width is not None and width > max_width:
+        raise jsonschema.ValidationError(
+            'Grid width {} is over the limit of {}.'.format(width, max_width))
+    if max_height is not None and height > max_height:
+        raise jsonschema.ValidationError(
+            'Grid height {} is over the limit of {}.'.format(
+                height, max_height))
+
+    check_blocks(gd['blocks'], width, height)
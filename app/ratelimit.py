@@ -0,0 +1,65 @@
+"""
+Per-client rate limiting with token buckets.
+
+"""
+import collections
+import time
+
+
+class TokenBucketLimiter:
+    """
+    Allow each client `rate` actions per second on average, with bursts
+    of up to `burst` actions at once.
+
+    Only for use from the IOLoop thread.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added to each client's bucket per second.
+    burst : int
+        Most tokens a bucket holds.
+    max_clients : int, optional
+        Buckets kept at most. The least recently seen clients are
+        forgotten beyond this, which gives them a full bucket again.
+
+    """
+    def __init__(self, rate, burst, max_clients=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+
+        # client: (tokens, time of last update)
+        self._buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, client, now=None):
+        """
+        Take a token from `client`'s bucket if there is one.
+
+        Returns
+        -------
+        wait : float
+            0 if a token was taken, otherwise the seconds until
+            one will be available.
+
+        """
+        if now is None:
+            now = time.monotonic()
+
+        tokens, last = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / self.rate
+
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+
+        return wait
@@ -0,0 +1,238 @@
+"""
+Turn stored grid data into the same HTML as ipythonblocks'
+``BlockGrid._repr_html_``, without building a Block object per cell.
+
+Every cell of the output table is assembled from a handful of
+strings looked up in tables built once per grid: one per row, one per
+column, one per distinct color, and one per distinct block size.
+The lookups are done with NumPy fancy indexing so the only Python-level
+loop is over chunks of rows.
+
+"""
+import uuid
+
+import numpy as np
+
+from . import metrics
+from .colorize import colorize_cells
+
+# Bump this whenever the HTML generated for grid pages changes so that
+# cached copies held by browsers and proxies are invalidated.
+RENDERER_VERSION = '1'
+
+# must match ipythonblocks' _TABLE, _TR, and _TD templates
+_TABLE = ('<style type="text/css">'
+          'table.blockgrid {{border: none;}}'
+          ' .blockgrid tr {{border: none;}}'
+          ' .blockgrid td {{padding: 0px;}}'
+          ' #blocks{0} td {{border: {1}px solid white;}}'
+          '</style>'
+          '<table id="blocks{0}" class="blockgrid"><tbody>{2}</tbody></table>')
+_TABLE_HEAD, _TABLE_TAIL = _TABLE.split('{2}')
+
+# pieces of a <td> in the order they appear in each cell
+_ROW_PIECE = '<td title="Index: [{0}, '
+_COL_PIECE = '{0}]&#10;Color: ('
+_COLOR_TITLE_PIECE = '{0})" style="width: '
+_SIZE_PIECE = '{0}px; height: {0}px;background-color: rgb('
+_COLOR_STYLE_PIECE = '{0});"></td>'
+
+# BlockGrid clamps colors to [0, 255] and sizes to at least 1
+_SMALLEST_BLOCK = 1
+
+# color and size of the blocks in a new BlockGrid
+_DEFAULT_BLOCK = (0, 0, 0, 20)
+
+# rows rendered per batch, which bounds the size of intermediate arrays
+CHUNK_ROWS = 64
+
+
+def _as_block_array(grid_data):
+    """
+    Get the grid's blocks as a (height, width, 4) array with
+    colors and sizes clamped the same way BlockGrid clamps them.
+
+    Block data that doesn't match the grid's stated shape is cut down
+    or filled out with BlockGrid's default blocks.
+
+    """
+    shape = (grid_data['height'], grid_data['width'], 4)
+    blocks = grid_data['blocks']
+    try:
+        arr = np.asarray(blocks, dtype=np.int64)
+    except OverflowError:
+        # someone posted a number too big for int64, fall back to
+        # Python ints so they still come out right
+        arr = np.asarray(blocks, dtype=object)
+    except ValueError:
+        # ragged rows
+        arr = None
+
+    if arr is None or arr.shape != shape:
+        arr = _fit_blocks(blocks, shape)
+
+    colors = np.clip(arr[..., :3], 0, 255).astype(np.int64)
+    sizes = np.maximum(arr[..., 3], _SMALLEST_BLOCK)
+    return colors, sizes
+
+
+def _fit_blocks(blocks, shape):
+    """
+    Copy blocks that fall inside `shape` into an array of default blocks.
+
+    """
+    height, width, _ = shape
+    arr = np.empty(shape, dtype=object)
+    arr[...] = _DEFAULT_BLOCK
+
+    for r, row in enumerate(blocks[:height]):
+        for c, block in enumerate(row[:width]):
+            arr[r, c, :len(block[:4])] = list(block[:4])
+
+    try:
+        return arr.astype(np.int64)
+    except OverflowError:
+        return arr
+
+
+def _lookup(values, *fmts):
+    """
+    Map an array of values to formatted strings, formatting each
+    distinct value only once per format.
+
+    Returns one object array of strings with the same shape as `values`
+    for each of `fmts`, which are callables taking a single value.
+
+    """
+    uniq, inverse = np.unique(values, return_inverse=True)
+    inverse = inverse.reshape(values.shape)
+    uniq = uniq.tolist()
+    return [np.array([fmt(v) for v in uniq], dtype=object)[inverse]
+            for fmt in fmts]
+
+
+def _rgb(key):
+    return '{}, {}, {}'.format(key >> 16, (key >> 8) & 255, key & 255)
+
+
+def iter_grid_rows(grid_data):
+    """
+    Yield the HTML for the grid's table one ``<tr>`` at a time.
+
+    Parameters
+    ----------
+    grid_data : dict
+        Stored grid data with ``width``, ``height``, and ``blocks`` keys.
+        ``blocks`` may be nested lists or an array.
+
+    """
+    colors, sizes = _as_block_array(grid_data)
+    height, width = sizes.shape
+
+    col_pieces = np.array(
+        [_COL_PIECE.format(c) for c in range(width)], dtype=object)
+
+    for start in range(0, height, CHUNK_ROWS):
+        stop = min(start + CHUNK_ROWS, height)
+        chunk_colors = colors[start:stop]
+
+        # pack each color into one integer so they can be looked up at once
+        color_keys = (
+            (chunk_colors[..., 0] << 16) |
+            (chunk_colors[..., 1] << 8) |
+            chunk_colors[..., 2])
+        color_titles, color_styles = _lookup(
+            color_keys,
+            lambda k: _COLOR_TITLE_PIECE.format(_rgb(k)),
+            lambda k: _COLOR_STYLE_PIECE.format(_rgb(k)))
+        size_pieces, = _lookup(sizes[start:stop], _SIZE_PIECE.format)
+
+        pieces = np.empty((stop - start, width, 5), dtype=object)
+        pieces[..., 0] = np.array(
+            [_ROW_PIECE.format(r) for r in range(start, stop)],
+            dtype=object)[:, np.newaxis]
+        pieces[..., 1] = col_pieces
+        pieces[..., 2] = color_titles
+        pieces[..., 3] = size_pieces
+        pieces[..., 4] = color_styles
+
+        for row in pieces.reshape(stop - start, -1):
+            yield '<tr>' + ''.join(row) + '</tr>'
+
+
+def table_head(lines_on, table_id=None):
+    """
+    HTML that comes before the grid rows, including the grid's style block.
+
+    Parameters
+    ----------
+    lines_on : bool
+    table_id : str, optional
+        Used to scope the style block to this table.
+        A random UUID is used if not given, as BlockGrid does.
+
+    """
+    if table_id is None:
+        table_id = uuid.uuid4()
+    return _TABLE_HEAD.format(table_id, int(lines_on))
+
+
+def table_tail():
+    """
+    HTML that comes after the grid rows.
+
+    """
+    return _TABLE_TAIL
+
+
+def render_grid_html(grid_data, table_id=None):
+    """
+    Render stored grid data to HTML identical to
+    ``BlockGrid._repr_html_``.
+
+    Parameters
+    ----------
+    grid_data : dict
+        Stored grid data with ``lines_on``, ``width``, ``height``,
+        and ``blocks`` keys.
+    table_id : str, optional
+        ID used for the table element.
+        A random UUID is used if not given, as BlockGrid does.
+
+    Returns
+    -------
+    html : str
+
+    """
+    return ''.join((
+        table_head(grid_data['lines_on'], table_id),
+        ''.join(iter_grid_rows(grid_data)),
+        table_tail()))
+
+
+def render_columns(grid_data, code_cells):
+    """
+    Render a grid and its code cells for storage alongside the grid.
+
+    Parameters
+    ----------
+    grid_data : dict
+    code_cells : list of str or None
+
+    Returns
+    -------
+    columns : dict
+        Values for the ``grid_html``, ``code_html``, and
+        ``render_version`` columns of a grid table.
+
+    """
+    with metrics.STAGE_SECONDS.time(stage='grid_render'):
+        grid_html = render_grid_html(grid_data)
+    with metrics.STAGE_SECONDS.time(stage='colorize'):
+        code_html = colorize_cells(code_cells or [])
+
+    return {
+        'grid_html': grid_html,
+        'code_html': code_html,
+        'render_version': RENDERER_VERSION
+    }
@@ -0,0 +1,63 @@
+"""
+Coalescing of concurrent identical work, so that when many requests for
+the same grid arrive together only one of them goes to the database.
+
+"""
+import tornado.gen
+
+from . import metrics
+
+
+@tornado.gen.coroutine
+def _call(func):
+    # a coroutine's future is resolved on the IOLoop thread even when
+    # func returns one resolved on a worker thread
+    result = yield func()
+    return result
+
+
+class SingleFlight:
+    """
+    Share one call's result between everyone asking for the same key
+    while that call is in flight.
+
+    Only for use from the IOLoop thread.
+
+    """
+    def __init__(self):
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, func, kind):
+        """
+        Start ``func()`` unless a call for `key` is already in flight,
+        and return the future of the call that is.
+
+        Parameters
+        ----------
+        key : hashable
+        func : callable
+            Takes no arguments and returns something a coroutine can
+            yield, such as a future. Its result or exception is shared
+            by every caller that asks for `key` before it finishes.
+        kind : str
+            What's being fetched, for the metrics.
+
+        Returns
+        -------
+        future : tornado.concurrent.Future
+
+        """
+        future = self._flights.get(key)
+        if future is not None:
+            metrics.SINGLE_FLIGHT.inc(kind=kind, role='follower')
+            return future
+
+        metrics.SINGLE_FLIGHT.inc(kind=kind, role='leader')
+        future = _call(func)
+        if not future.done():
+            self._flights[key] = future
+            future.add_done_callback(lambda f: self._flights.pop(key, None))
+        return future
@@ -0,0 +1,90 @@
+// Draw grids onto <canvas class="ipb-canvas" data-src="/raw/..."> elements
+// from the packed blocks served by /raw. See encode_raw in app/images.py
+// for the format.
+(function () {
+  'use strict';
+
+  var MAGIC = 'IPBR';
+  var HEADER_SIZE = 15;
+  // largest canvas side drawn, blocks are made smaller to fit
+  var MAX_SIDE = 4096;
+  var LINE_COLOR = 'rgb(255, 255, 255)';
+
+  // Choose the block size and line width so the canvas fits in MAX_SIDE,
+  // the same way _layout in app/images.py does for PNGs.
+  function layout(blocks, block, line) {
+    if (blocks * (block + line) + line > MAX_SIDE) {
+      block = Math.max(1, Math.floor((MAX_SIDE - line) / blocks) - line);
+    }
+    if (blocks * (block + line) + line > MAX_SIDE) {
+      line = 0;
+    }
+    return {block: block, line: line};
+  }
+
+  function draw(canvas, buffer) {
+    var view = new DataView(buffer);
+    var magic = String.fromCharCode(
+      view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+    if (magic !== MAGIC) {
+      throw new Error('not a packed grid');
+    }
+
+    var width = view.getUint32(4, true);
+    var height = view.getUint32(8, true);
+    var size = layout(
+      Math.max(width, height), view.getUint16(12, true),
+      view.getUint8(14) ? 1 : 0);
+    var rgb = new Uint8Array(buffer, HEADER_SIZE, width * height * 3);
+
+    // one pixel per block, scaled up onto the page's canvas
+    var blocks = document.createElement('canvas');
+    blocks.width = width;
+    blocks.height = height;
+    var blocksContext = blocks.getContext('2d');
+    var pixels = blocksContext.createImageData(width, height);
+    for (var i = 0, j = 0; i < rgb.length; i += 3, j += 4) {
+      pixels.data[j] = rgb[i];
+      pixels.data[j + 1] = rgb[i + 1];
+      pixels.data[j + 2] = rgb[i + 2];
+      pixels.data[j + 3] = 255;
+    }
+    blocksContext.putImageData(pixels, 0, 0);
+
+    var pitch = size.block + size.line;
+    canvas.width = width * pitch + size.line;
+    canvas.height = height * pitch + size.line;
+    var context = canvas.getContext('2d');
+    context.imageSmoothingEnabled = false;
+    context.drawImage(
+      blocks, size.line, size.line, width * pitch, height * pitch);
+
+    if (size.line) {
+      // lines cover the last pixels of each block's pitch
+      context.fillStyle = LINE_COLOR;
+      for (var x = 0; x <= width; x++) {
+        context.fillRect(x * pitch, 0, size.line, canvas.height);
+      }
+      for (var y = 0; y <= height; y++) {
+        context.fillRect(0, y * pitch, canvas.width, size.line);
+      }
+    }
+  }
+
+  function load(canvas) {
+    var request = new XMLHttpRequest();
+    request.open('GET', canvas.getAttribute('data-src'));
+    request.responseType = 'arraybuffer';
+    request.onload = function () {
+      if (request.status === 200) {
+        draw(canvas, request.response);
+      }
+    };
+    request.send();
+  }
+
+  var canvases = document.querySelectorAll('canvas.ipb-canvas');
+  for (var i = 0; i < canvases.length; i++) {
+    load(canvases[i]);
+  }
+})();
@@ -1,10 +1,21 @@
+import gzip
 import json
 import os
+import re
+import signal
+import socket
+import subprocess
+import sys
 import tempfile
+import threading
+import time
+from unittest import mock
 
 import pytest
 import sqlalchemy as sa
 import testing.postgresql
+import tornado.gen
+import tornado.iostream
 import tornado.options
 import tornado.testing
 from sqlalchemy.orm import sessionmaker
@@ -128,6 +139,63 @@ class TestPostGrid(UtilBase):
             assert getattr(grid_spec, key) == value
 
 
+class TestPostBatch(UtilBase):
+    app_url = '/post/batch'
+    method = 'POST'
+
+    def batch(self):
+        secret = request()
+        secret['secret'] = True
+        invalid = request()
+        invalid['grid_data']['width'] = 3
+        other = request()
+        other['code_cells'] = None
+        return [request(), secret, invalid, other, request()]
+
+    def check_results(self, response):
+        assert response.code == 200
+        results = json.loads(response.body)['results']
+
+        assert len(results) == 5
+        assert results[0] == {'url': 'http://www.ipythonblocks.org/bizkiL'}
+        assert results[1] == {
+            'url': 'http://www.ipythonblocks.org/secret/MiXoi4'}
+        assert 'error' in results[2]
+        assert results[3]['url'] != results[0]['url']
+        assert results[4] == results[0]
+        return results
+
+    def test_json_array(self):
+        response = self.get_response(json.dumps(self.batch()))
+        results = self.check_results(response)
+
+        hash_id = results[3]['url'].split('/')[-1]
+        assert dbi.get_grid_entry(self.session, hash_id).code_cells is None
+
+    def test_ndjson(self):
+        body = '\n'.join(json.dumps(r) for r in self.batch())
+        response = self.get_response(body + '\n{"asdf"}\n')
+
+        assert response.code == 200
+        results = json.loads(response.body)['results']
+        assert len(results) == 6
+        assert 'error' in results[5]
+
+    def test_json_failure(self):
+        response = self.get_response('[{"asdf"}')
+        assert response.code == 400
+
+    def test_empty_batch(self):
+        response = self.get_response('[]')
+        assert response.code == 400
+
+    def test_all_invalid(self):
+        response = self.get_response('[{"asdf": 5}]')
+
+        assert response.code == 200
+        assert 'error' in json.loads(response.body)['results'][0]
+
+
 class TestGetGrid(UtilBase):
     method = 'GET'
 
@@ -161,6 +229,54 @@ class TestGetGrid(UtilBase):
         assert body == json.loads(json.dumps(req['grid_data']))
 
 
+    def test_get_grid_packed(self):
+        hash_id = dbi.store_grid_entry(self.session, request(), packed=True)
+        self.session.commit()
+        self.app_url = '/get/{}'.format(hash_id)
+
+        response = self.get_response()
+        assert response.code == 200
+
+        body = json.loads(response.body)
+        assert body == json.loads(json.dumps(request()['grid_data']))
+
+    def test_get_grid_cache_headers(self):
+        hash_id = self.save_grid(False)
+        self.app_url = '/get/{}'.format(hash_id)
+
+        response = self.get_response()
+        assert response.code == 200
+        assert 'immutable' in response.headers['Cache-Control']
+        assert response.headers['Cache-Control'].startswith('public')
+        assert hash_id in response.headers['Etag']
+        assert 'Last-Modified' in response.headers
+
+    def test_get_grid_not_modified(self):
+        hash_id = self.save_grid(False)
+        url = '/get/{}'.format(hash_id)
+        etag = self.fetch(url).headers['Etag']
+
+        with mock.patch.object(dbi, 'get_grid_json') as get_grid_json:
+            response = self.fetch(url, headers={'If-None-Match': etag})
+
+        assert response.code == 304
+        assert not response.body
+        assert not get_grid_json.called
+
+    def test_get_grid_chunked(self):
+        hash_id = self.save_grid(False)
+        self.app_url = '/get/{}'.format(hash_id)
+
+        with mock.patch.object(app, 'JSON_CHUNK_SIZE', 10):
+            response = self.get_response()
+
+        assert response.code == 200
+        assert 'application/json' in response.headers['Content-Type']
+
+        body = json.loads(response.body)
+        assert body == json.loads(json.dumps(request()['grid_data']))
+
+
 class TestRandomHandler(UtilBase):
     def test_random(self):
         grid_id = self.save_grid(False)
@@ -173,6 +289,25 @@ class TestRandomHandler(UtilBase):
         assert response.code == 303
         assert response.headers['Location'] == '/{}'.format(grid_id)
 
+    def test_random_off_ioloop_thread(self):
+        self.save_grid(False)
+        threads = []
+        get_random_hash_id = dbi.get_random_hash_id
+
+        def record_thread(session):
+            threads.append(threading.current_thread())
+            return get_random_hash_id(session)
+
+        with mock.patch.object(dbi, 'get_random_hash_id', record_thread):
+            self.http_client.fetch(
+                self.get_url('/random'), self.stop,
+                method='GET', follow_redirects=False)
+            response = self.wait()
+
+        assert response.code == 303
+        assert threads
+        assert threads[0] is not threading.current_thread()
+
 
 class TestRenderGrid(UtilBase):
     method = 'GET'
@@ -185,6 +320,7 @@ class TestRenderGrid(UtilBase):
         assert response.code == 200
         assert b'<table' in response.body
         assert b'asdf' in response.body
+        assert app.image_url(hash_id, False).encode() in response.body
 
     def test_render_secret(self):
         hash_id = self.save_grid(True)
@@ -194,3 +330,635 @@ class TestRenderGrid(UtilBase):
         assert response.code == 200
         assert b'<table' in response.body
         assert b'asdf' in response.body
+
+    def test_render_cached(self):
+        hash_id = self.save_grid(False)
+        self.app_url = '/{}'.format(hash_id)
+
+        first = self.get_response()
+        second = self.get_response()
+
+        assert second.code == 200
+        assert second.body == first.body
+
+        stats = self._app.page_cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+
+    def test_render_404_not_cached(self):
+        self.app_url = '/asdfasdf'
+        response = self.get_response()
+
+        assert response.code == 404
+        assert len(self._app.page_cache) == 0
+
+    def test_render_cache_headers_secret(self):
+        hash_id = self.save_grid(True)
+        self.app_url = '/secret/{}'.format(hash_id)
+
+        response = self.get_response()
+        assert response.code == 200
+        assert response.headers['Cache-Control'].startswith('private')
+        assert 'secret' in response.headers['Etag']
+
+    def test_render_not_modified(self):
+        hash_id = self.save_grid(False)
+        url = '/{}'.format(hash_id)
+        first = self.fetch(url)
+
+        response = self.fetch(
+            url, headers={'If-None-Match': first.headers['Etag']})
+        assert response.code == 304
+
+        response = self.fetch(
+            url, headers={'If-Modified-Since': first.headers['Last-Modified']})
+        assert response.code == 304
+
+
+class TestStreamRender(UtilBase):
+    method = 'GET'
+
+    def teardown_method(self, method):
+        tornado.options.options.stream_grid_cells = 250000
+        super().teardown_method(method)
+
+    def test_streamed_page_matches(self):
+        hash_id = self.save_grid(False)
+        self.app_url = '/{}'.format(hash_id)
+
+        whole = self.get_response()
+        self._app.page_cache = app.ByteLRUCache(0)
+        tornado.options.options.stream_grid_cells = 3
+        streamed = self.get_response()
+
+        assert streamed.code == 200
+        assert streamed.headers['Transfer-Encoding'] == 'chunked'
+        assert 'Etag' in streamed.headers
+
+        def without_ids(body):
+            return re.sub(rb'blocks[0-9a-f-]+', b'', body)
+
+        assert without_ids(streamed.body) == without_ids(whole.body)
+
+    def test_streamed_not_cached(self):
+        tornado.options.options.stream_grid_cells = 3
+        hash_id = self.save_grid(False)
+        self.app_url = '/{}'.format(hash_id)
+
+        assert self.get_response().code == 200
+        assert len(self._app.page_cache) == 0
+
+    def test_streamed_not_modified(self):
+        tornado.options.options.stream_grid_cells = 3
+        hash_id = self.save_grid(False)
+        first = self.fetch('/' + hash_id)
+
+        response = self.fetch('/' + hash_id, headers={
+            'If-Modified-Since': first.headers['Last-Modified']})
+        assert response.code == 304
+
+
+class TestImages(UtilBase):
+    method = 'GET'
+
+    def test_images(self):
+        hash_id = self.save_grid(False)
+
+        for kind, content_type in [('png', 'image/png'),
+                                   ('svg', 'image/svg+xml'),
+                                   ('thumb', 'image/png')]:
+            self.app_url = '/{}/{}'.format(kind, hash_id)
+
+            response = self.get_response()
+            assert response.code == 200
+            assert response.headers['Content-Type'] == content_type
+            assert 'immutable' in response.headers['Cache-Control']
+            assert (self._app.image_cache.get((False, hash_id, kind))[0] ==
+                    response.body)
+
+            response = self.fetch(
+                self.app_url,
+                headers={'If-None-Match': response.headers['Etag']})
+            assert response.code == 304
+
+    def test_image_secret(self):
+        hash_id = self.save_grid(True)
+        self.app_url = '/png/secret/{}'.format(hash_id)
+
+        response = self.get_response()
+        assert response.code == 200
+        assert response.body.startswith(b'\x89PNG')
+        assert 'private' in response.headers['Cache-Control']
+
+        self.app_url = '/png/{}'.format(hash_id)
+        assert self.get_response().code == 404
+
+    def test_returns_404(self):
+        self.app_url = '/png/asdfasdf'
+        response = self.get_response()
+        assert response.code == 404
+
+
+class TestCanvas(UtilBase):
+    method = 'GET'
+
+    def setup_method(self, method):
+        super().setup_method(method)
+        tornado.options.options.canvas_grid_cells = 3
+
+    def teardown_method(self, method):
+        tornado.options.options.canvas_grid_cells = 10000
+        super().teardown_method(method)
+
+    def test_canvas_page(self):
+        hash_id = self.save_grid(False)
+        self.app_url = '/{}'.format(hash_id)
+
+        response = self.get_response()
+        assert response.code == 200
+        assert b'<table' not in response.body
+        assert b'data-src="/raw/' + hash_id.encode() in response.body
+        assert b'gridcanvas.js' in response.body
+        assert b'href="?view=table"' in response.body
+        assert b'asdf' in response.body
+
+    def test_table_view(self):
+        hash_id = self.save_grid(False)
+        self.app_url = '/{}?view=table'.format(hash_id)
+
+        response = self.get_response()
+        assert response.code == 200
+        assert b'<table' in response.body
+        assert b'<canvas' not in response.body
+
+    def test_etag_depends_on_view(self):
+        hash_id = self.save_grid(False)
+        url = '/{}'.format(hash_id)
+        canvas = self.fetch(url).headers['Etag']
+        table = self.fetch(url + '?view=table').headers['Etag']
+        assert canvas != table
+
+        tornado.options.options.canvas_grid_cells = 4
+        assert self.fetch(url).headers['Etag'] not in (canvas, table)
+
+        response = self.fetch(
+            url + '?view=table', headers={'If-None-Match': canvas})
+        assert response.code == 200
+
+    def test_posted_grid_not_rendered(self):
+        response = self.fetch(
+            '/post', method='POST', body=json.dumps(request()))
+        hash_id = json.loads(response.body)['url'].split('/')[-1]
+        assert dbi.get_grid_entry(self.session, hash_id).grid_html is None
+
+        response = self.fetch('/{}?view=table'.format(hash_id))
+        assert response.code == 200
+        assert b'<table' in response.body
+
+    def test_small_grid_is_table(self):
+        tornado.options.options.canvas_grid_cells = 4
+        hash_id = self.save_grid(False)
+        self.app_url = '/{}'.format(hash_id)
+
+        assert b'<table' in self.get_response().body
+
+    def test_raw(self):
+        hash_id = self.save_grid(True)
+        self.app_url = '/raw/secret/{}'.format(hash_id)
+
+        response = self.fetch(
+            self.app_url, headers={'Accept-Encoding': 'gzip'},
+            decompress_response=False)
+        assert response.code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Content-Type'] == 'application/octet-stream'
+        raw = gzip.decompress(response.body)
+
+        response = self.fetch(
+            self.app_url, headers={'Accept-Encoding': 'identity'},
+            decompress_response=False)
+        assert 'Content-Encoding' not in response.headers
+        assert response.body == raw
+
+        width, height = app.images.RAW_HEADER.unpack_from(raw)[1:3]
+        assert (width, height) == (2, 2)
+        assert len(raw) == app.images.RAW_HEADER.size + 2 * 2 * 3
+
+
+class TestDiskCache(UtilBase):
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        tornado.options.options.disk_cache_dir = self.cache_dir.name
+
+    def teardown_method(self, method):
+        tornado.options.options.disk_cache_dir = None
+        self.cache_dir.cleanup()
+        super().teardown_method(method)
+
+    def wait_for_disk(self, entries):
+        # the disk cache is written in the background
+        for _ in range(100):
+            if self._app.disk_cache.stats()['entries'] >= entries:
+                return
+            time.sleep(0.01)
+        raise AssertionError('disk cache was not written')
+
+    def restart(self):
+        self._app.shutdown()
+        self._app = self.get_app()
+        self.http_server.request_callback = self._app
+
+    def test_survives_restart(self):
+        hash_id = self.save_grid(False)
+        page = self.fetch('/' + hash_id)
+        grid_json = self.fetch('/get/' + hash_id)
+        self.wait_for_disk(2)
+
+        self.session.query(models.PublicGrid).delete()
+        self.session.commit()
+        self.restart()
+
+        response = self.fetch('/' + hash_id)
+        assert response.code == 200
+        assert response.body == page.body
+        assert response.headers['Last-Modified'] == (
+            page.headers['Last-Modified'])
+
+        response = self.fetch('/get/' + hash_id)
+        assert response.code == 200
+        assert response.body == grid_json.body
+        assert 'application/json' in response.headers['Content-Type']
+
+        assert self._app.disk_cache.hits == 2
+
+    def test_read_off_loop(self):
+        hash_id = self.save_grid(False)
+        page = self.fetch('/' + hash_id)
+        self.wait_for_disk(1)
+        self.restart()
+
+        get = self._app.disk_cache.get
+        threads = []
+
+        def disk_get(key):
+            threads.append(threading.current_thread())
+            return get(key)
+
+        with mock.patch.object(self._app.disk_cache, 'get', disk_get), \
+                mock.patch.object(app, 'DISK_CHUNK_SIZE', 100):
+            response = self.fetch('/' + hash_id)
+
+        assert response.body == page.body
+        assert threads and threading.main_thread() not in threads
+
+    def test_not_modified(self):
+        hash_id = self.save_grid(True)
+        first = self.fetch('/get/secret/' + hash_id)
+        self.wait_for_disk(1)
+
+        response = self.fetch('/get/secret/' + hash_id, headers={
+            'If-Modified-Since': first.headers['Last-Modified']})
+        assert response.code == 304
+        assert self._app.disk_cache.hits == 1
+
+    def test_missing_not_cached(self):
+        assert self.fetch('/asdfasdf').code == 404
+        assert self.fetch('/get/asdfasdf').code == 404
+        assert self._app.disk_cache.stats()['entries'] == 0
+
+
+class TestPostAdmission(UtilBase):
+    def teardown_method(self, method):
+        tornado.options.options.max_post_bytes = None
+        tornado.options.options.max_batch_bytes = None
+        super().teardown_method(method)
+
+    def post(self, url='/post'):
+        return self.fetch(url, method='POST', body=json.dumps(request()))
+
+    def rejections(self, reason):
+        return dict(
+            ((labels[0][1], value) for _, labels, value in
+             app.metrics.POST_REJECTIONS.samples())).get(reason, 0)
+
+    def test_too_large(self):
+        tornado.options.options.max_post_bytes = 100
+        rejected = self.rejections('too_large')
+
+        assert self.post().code == 413
+        assert self.rejections('too_large') == rejected + 1
+        assert self.session.query(models.PublicGrid).count() == 0
+
+    @tornado.testing.gen_test
+    def test_bad_content_length(self):
+        for url in (b'/post', b'/post/batch'):
+            stream = tornado.iostream.IOStream(socket.socket())
+            yield stream.connect(('127.0.0.1', self.get_http_port()))
+            yield stream.write(
+                b'POST ' + url + b' HTTP/1.1\r\nContent-Length: asdf\r\n\r\n')
+            status = yield stream.read_until(b'\r\n')
+            stream.close()
+            assert status.startswith(b'HTTP/1.1 400')
+
+    def test_batch_too_large(self):
+        tornado.options.options.max_batch_bytes = 100
+        rejected = self.rejections('too_large')
+
+        assert self.post('/post/batch').code == 413
+        assert self.rejections('too_large') == rejected + 1
+
+    def test_default_batch_size(self):
+        options = tornado.options.options
+        assert app.max_batch_bytes() == min(
+            options.max_batch_grids * app.max_post_bytes(),
+            app.BATCH_MAX_DEFAULT_BYTES)
+
+    def test_default_size_fits_largest_grid(self):
+        options = tornado.options.options
+        largest = request()
+        largest['grid_data']['blocks'] = [
+            [[255, 255, 255, 100]] * options.max_grid_width
+        ] * options.max_grid_height
+
+        assert len(json.dumps(largest)) < app.max_post_bytes()
+
+    def test_no_rate_limit_by_default(self):
+        assert self._app.post_limiter is None
+
+    def test_rate_limited(self):
+        self._app.post_limiter = app.TokenBucketLimiter(rate=0.1, burst=1)
+
+        assert self.post().code == 200
+        response = self.post()
+        assert response.code == 429
+        assert response.headers['Retry-After'] == '10'
+
+        # batches share the limit
+        assert self.post('/post/batch').code == 429
+
+    def test_overloaded(self):
+        self._app.posts_in_flight = self._app.max_posts_in_flight
+
+        response = self.post()
+        assert response.code == 503
+        assert response.headers['Retry-After'] == '1'
+
+        self._app.posts_in_flight = 0
+        assert self.post().code == 200
+        assert self._app.posts_in_flight == 0
+
+
+class TestReadReplicas(UtilBase):
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.replica = PG_FACTORY()
+        engine = sa.create_engine(self.replica.url())
+        models.Base.metadata.create_all(bind=engine)
+        self.replica_session = sessionmaker(bind=engine)()
+        self.replica_engine = engine
+        tornado.options.options.db_read_urls = [self.replica.url()]
+
+    def teardown_method(self, method):
+        tornado.options.options.db_read_urls = []
+        self.replica_session.close()
+        self.replica_engine.dispose()
+        self.replica.stop()
+        super().teardown_method(method)
+
+    def retries(self, reason):
+        return dict(
+            ((labels[0][1], value) for _, labels, value in
+             app.metrics.READ_RETRIES.samples())).get(reason, 0)
+
+    def test_reads_from_replica(self):
+        # only the replica has this grid
+        hash_id = dbi.store_grid_entry(self.replica_session, request())
+        self.replica_session.commit()
+
+        assert self.fetch('/get/' + hash_id).code == 200
+        assert self.fetch('/' + hash_id).code == 200
+
+    def test_miss_retries_on_primary(self):
+        misses = self.retries('miss')
+        hash_id = self.save_grid(False)
+
+        assert self.fetch('/get/' + hash_id).code == 200
+        assert self.retries('miss') == misses + 1
+
+    def test_post_goes_to_primary(self):
+        response = self.fetch(
+            '/post', method='POST', body=json.dumps(request()))
+        assert response.code == 200
+
+        assert self.session.query(models.PublicGrid).count() == 1
+        assert self.replica_session.query(models.PublicGrid).count() == 0
+
+    def test_round_robin(self):
+        tornado.options.options.db_read_urls = ['sqlite://', 'sqlite://']
+        application = app.make_application()
+        first, second = application.read_pool_stats
+
+        assert [application.next_read_replica() for _ in range(3)] == [
+            first, second, first]
+
+        application.shutdown()
+
+
+class TestSingleFlight(UtilBase):
+    def fetch_together(self, url, count):
+        return self.io_loop.run_sync(lambda: tornado.gen.multi(
+            [self.http_client.fetch(self.get_url(url), raise_error=False)
+             for _ in range(count)]))
+
+    def slowed(self, func):
+        def slow(*args, **kwargs):
+            time.sleep(0.2)
+            return func(*args, **kwargs)
+        return mock.patch.object(dbi, func.__name__, side_effect=slow)
+
+    def test_render_coalesced(self):
+        hash_id = self.save_grid(False)
+
+        with self.slowed(dbi.get_rendered_grid_entry) as lookup:
+            responses = self.fetch_together('/' + hash_id, 5)
+
+        assert lookup.call_count == 1
+        assert [r.code for r in responses] == [200] * 5
+        assert len({r.body for r in responses}) == 1
+
+    def test_get_coalesced(self):
+        hash_id = self.save_grid(False)
+
+        with self.slowed(dbi.get_grid_json) as lookup:
+            responses = self.fetch_together('/get/' + hash_id, 5)
+
+        assert lookup.call_count == 1
+        assert [r.code for r in responses] == [200] * 5
+
+    def test_missing_coalesced(self):
+        with self.slowed(dbi.get_rendered_grid_entry) as lookup:
+            responses = self.fetch_together('/asdfasdf', 3)
+
+        assert lookup.call_count == 1
+        assert [r.code for r in responses] == [404] * 3
+
+
+class TestMakeApplication(UtilBase):
+    def test_debug_default(self):
+        assert self._app.settings['debug'] is True
+
+    def test_settings_override(self):
+        application = app.make_application(debug=False)
+
+        assert application.settings['debug'] is False
+        assert application.settings['gzip'] is True
+
+        application.shutdown()
+
+
+class TestMetrics(UtilBase):
+    def setup_method(self, method):
+        super().setup_method(method)
+        tornado.options.options.metrics = True
+        tornado.options.options.metrics_token = None
+
+    def teardown_method(self, method):
+        tornado.options.options.metrics = False
+        tornado.options.options.metrics_token = None
+        super().teardown_method(method)
+
+    def test_off_by_default(self):
+        tornado.options.options.metrics = False
+        application = app.make_application()
+
+        assert not any(
+            rule.target is app.MetricsHandler
+            for rule in application.wildcard_router.rules)
+
+        application.shutdown()
+
+    def test_handler_and_stage_metrics(self):
+        hash_id = self.save_grid(False)
+        assert self.fetch('/' + hash_id).code == 200
+        assert self.fetch(
+            '/post', method='POST', body=json.dumps(request())).code == 200
+        assert self.fetch('/random', follow_redirects=False).code == 303
+
+        response = self.fetch('/metrics')
+        assert response.code == 200
+        assert response.headers['Content-Type'].startswith('text/plain')
+
+        text = response.body.decode()
+        assert ('ipborg_requests_total{handler="RenderGridHandler",'
+                'method="GET",status="200"}') in text
+        assert ('ipborg_request_seconds_count{handler="PostHandler",'
+                'status="200"}') in text
+        assert 'ipborg_request_body_bytes_count{handler="PostHandler"}' in text
+        for stage in ('db_fetch', 'template_render', 'validate'):
+            assert 'ipborg_stage_seconds_count{{stage="{}"}}'.format(
+                stage) in text
+        assert 'ipborg_random_lookups_count' in text
+        assert 'ipborg_cache_entries{cache="page"} 1.0' in text
+        assert ('ipborg_db_pool_connections{engine="primary",state="in_use"}'
+                in text)
+
+    def test_token(self):
+        tornado.options.options.metrics_token = 'abc'
+
+        assert self.fetch('/metrics').code == 403
+        response = self.fetch(
+            '/metrics', headers={'Authorization': 'Bearer abc'})
+        assert response.code == 200
+
+
+class TestGridList(UtilBase):
+    method = 'GET'
+
+    def save_grids(self, count):
+        hash_ids = []
+        for i in range(count):
+            req = request()
+            req['code_cells'] = [str(i)]
+            hash_ids.append(dbi.store_grid_entry(self.session, req))
+        self.session.commit()
+        return hash_ids
+
+    def test_api_pages(self):
+        hash_ids = self.save_grids(3)
+
+        response = self.fetch('/api/grids?limit=2')
+        assert response.code == 200
+        body = json.loads(response.body)
+        assert [g['hash_id'] for g in body['grids']] == hash_ids[:0:-1]
+        assert body['grids'][0]['url'] == app.grid_url(hash_ids[2], False)
+        assert body['grids'][0]['width'] == 2
+        assert body['next'].startswith('/api/grids?')
+
+        response = self.fetch(body['next'])
+        body = json.loads(response.body)
+        assert [g['hash_id'] for g in body['grids']] == hash_ids[:1]
+        assert body['next'] is None
+
+    def test_api_bad_arguments(self):
+        assert self.fetch('/api/grids?limit=0').code == 400
+        assert self.fetch('/api/grids?limit=x').code == 400
+        assert self.fetch('/api/grids?cursor=asdf').code == 400
+
+    def test_gallery(self):
+        hash_ids = self.save_grids(2)
+
+        response = self.fetch('/gallery')
+        assert response.code == 200
+        for hash_id in hash_ids:
+            assert '/thumb/{}'.format(hash_id).encode() in response.body
+        assert b'Older grids' not in response.body
+
+
+class TestProduction:
+    """
+    Run the server in production mode as a supervisor would.
+
+    """
+    def start(self):
+        sock, port = tornado.testing.bind_unused_port()
+        sock.close()
+        self.port = port
+        self.server = subprocess.Popen(
+            [sys.executable, '-m', 'app.app', '--production',
+             '--processes=2', '--port={}'.format(port),
+             '--db_url=postgresql://localhost/none', '--shutdown_grace=30'],
+            cwd=os.path.join(os.path.dirname(__file__), '..', '..'),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True)
+
+        for _ in range(100):
+            try:
+                return socket.create_connection(('127.0.0.1', port))
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        raise AssertionError('server did not start')
+
+    def teardown_method(self, method):
+        if self.server.poll() is None:
+            os.killpg(os.getpgid(self.server.pid), signal.SIGKILL)
+
+    def test_sigterm_to_parent(self):
+        connection = self.start()
+        # a request still being sent when the server is told to stop
+        connection.sendall(
+            b'POST /post HTTP/1.1\r\nContent-Length: 2\r\n\r\n{')
+        time.sleep(0.5)
+
+        start = time.time()
+        self.server.send_signal(signal.SIGTERM)
+        time.sleep(0.5)
+        assert self.server.poll() is None
+
+        connection.sendall(b'}')
+        assert connection.recv(1024).startswith(b'HTTP/1.1 400')
+        connection.close()
+
+        # well inside shutdown_grace, since no requests are left open
+        assert self.server.wait(10) == 0
+        assert time.time() - start < 10
@@ -0,0 +1,149 @@
+import os
+import time
+
+from ..cache import ByteLRUCache, DiskCache
+
+
+def test_get_set():
+    cache = ByteLRUCache(100)
+    assert cache.get('a') is None
+
+    cache.set('a', b'abc')
+    assert cache.get('a') == b'abc'
+    assert cache.current_bytes == 3
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_replace_value():
+    cache = ByteLRUCache(100)
+    cache.set('a', b'abc')
+    cache.set('a', b'abcdef')
+
+    assert cache.get('a') == b'abcdef'
+    assert cache.current_bytes == 6
+    assert len(cache) == 1
+
+
+def test_evicts_least_recently_used():
+    cache = ByteLRUCache(10)
+    cache.set('a', b'aaaa')
+    cache.set('b', b'bbbb')
+    cache.get('a')
+    cache.set('c', b'cccc')
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert cache.current_bytes == 8
+    assert cache.evictions == 1
+
+
+def test_explicit_size():
+    cache = ByteLRUCache(10)
+    cache.set('a', ('page', 'extra'), size=6)
+    cache.set('b', ('page', 'extra'), size=6)
+
+    assert cache.get('b') == ('page', 'extra')
+    assert 'a' not in cache
+    assert cache.current_bytes == 6
+
+
+def test_too_large_not_stored():
+    cache = ByteLRUCache(4)
+    cache.set('a', b'aaaaa')
+
+    assert 'a' not in cache
+    assert cache.current_bytes == 0
+
+
+def test_zero_budget_disables():
+    cache = ByteLRUCache(0)
+    cache.set('a', b'a')
+
+    assert cache.get('a') is None
+
+
+def test_stats():
+    cache = ByteLRUCache(10)
+    cache.set('a', b'aaaa')
+    cache.get('a')
+    cache.get('b')
+
+    assert cache.stats() == {
+        'hits': 1,
+        'misses': 1,
+        'evictions': 0,
+        'entries': 1,
+        'bytes': 4,
+        'max_bytes': 10,
+    }
+
+
+def test_disk_get_set(tmpdir):
+    cache = DiskCache(str(tmpdir), 100)
+    assert cache.get(('a', 1)) is None
+
+    cache.set(('a', 1), b'abc')
+    with cache.get(('a', 1)) as data:
+        assert data[:] == b'abc'
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_disk_shared(tmpdir):
+    DiskCache(str(tmpdir), 100).set('a', b'abc')
+    cache = DiskCache(str(tmpdir), 100)
+
+    with cache.get('a') as data:
+        assert data[:] == b'abc'
+    assert cache.stats()['entries'] == 1
+    assert cache.stats()['bytes'] == 3
+
+
+def test_disk_replace_value(tmpdir):
+    cache = DiskCache(str(tmpdir), 100)
+    cache.set('a', b'abc')
+    old = cache.get('a')
+    cache.set('a', b'abcdef')
+
+    # readers keep the value they opened
+    assert old[:] == b'abc'
+    old.close()
+    with cache.get('a') as data:
+        assert data[:] == b'abcdef'
+
+
+def test_disk_evicts_least_recently_used(tmpdir):
+    cache = DiskCache(str(tmpdir), 10)
+    cache.set('a', b'aaaa')
+    cache.set('b', b'bbbb')
+    # a was used after b
+    now = time.time()
+    os.utime(cache._filename('a'), (now, now))
+    os.utime(cache._filename('b'), (now - 100, now - 100))
+
+    cache.set('c', b'cccc')
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    assert cache.evictions == 1
+    assert cache.stats()['bytes'] == 8
+
+
+def test_disk_too_large_not_stored(tmpdir):
+    cache = DiskCache(str(tmpdir), 4)
+    cache.set('a', b'aaaaa')
+
+    assert cache.get('a') is None
+
+
+def test_disk_removes_old_temp_files(tmpdir):
+    temp = tmpdir.join(DiskCache.TEMP_PREFIX + 'abc')
+    temp.write(b'abc')
+    old = time.time() - DiskCache.TEMP_MAX_AGE - 1
+    os.utime(str(temp), (old, old))
+
+    DiskCache(str(tmpdir), 100)
+    assert not temp.exists()
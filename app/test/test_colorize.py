@@ -0,0 +1,36 @@
+import pytest
+
+from .. import colorize
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    colorize.CODE_CACHE.clear()
+
+
+def test_colorize():
+    html = colorize.colorize('x = 1')
+    assert colorize.CSS_CLASS in html
+    assert '<span' in html
+
+
+def test_colorize_cached(monkeypatch):
+    first = colorize.colorize('x = 1')
+
+    def fail(*args):
+        raise AssertionError('highlighted twice')
+
+    monkeypatch.setattr(colorize, 'highlight', fail)
+    assert colorize.colorize('x = 1') == first
+
+
+def test_colorize_cells():
+    cells = ['x = 1', 'print(x)', 'x = 1']
+    html = colorize.colorize_cells(cells)
+
+    assert html == [colorize.colorize(c) for c in cells]
+    assert len(colorize.CODE_CACHE) == 2
+
+
+def test_colorize_cells_empty():
+    assert colorize.colorize_cells([]) == []
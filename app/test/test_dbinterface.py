@@ -1,16 +1,20 @@
+import datetime
 import hashlib
 import json
 import tempfile
 import os
 
 import ipythonblocks as ipb
+import numpy as np
 import pytest
 import sqlalchemy as sa
 import testing.postgresql
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
 
 from .. import dbinterface as dbi
 from .. import models
+from .. import render
 
 
 @pytest.fixture(scope='module')
@@ -103,3 +107,311 @@ def test_get_random_grid_entry(basic_grid, session):
     test_id = dbi.get_random_hash_id(session)
 
     assert test_id == hash_id
+
+
+def test_get_random_grid_entry_gaps(basic_grid, session):
+    data = basic_grid._construct_post_request(None, False)
+    hash_ids = []
+    for i in range(5):
+        data['code_cells'] = [str(i)]
+        hash_ids.append(dbi.store_grid_entry(session, data))
+
+    # leave holes in the id range
+    deleted = [dbi.decode_hash_id(h, False) for h in hash_ids[1:4:2]]
+    session.query(models.PublicGrid).filter(
+        models.PublicGrid.id.in_(deleted)).delete(synchronize_session=False)
+
+    found = {dbi.get_random_hash_id(session) for _ in range(50)}
+    assert found <= {hash_ids[0], hash_ids[2], hash_ids[4]}
+
+
+def test_get_random_grid_entry_fallback(basic_grid, session, monkeypatch):
+    monkeypatch.setattr(dbi, 'RANDOM_ATTEMPTS', 0)
+    data = basic_grid._construct_post_request(None, False)
+    hash_id = dbi.store_grid_entry(session, data)
+
+    assert dbi.get_random_hash_id(session) == hash_id
+
+
+def test_get_random_grid_entry_empty(session):
+    with pytest.raises(NoResultFound):
+        dbi.get_random_hash_id(session)
+
+
+@pytest.mark.parametrize('secret', [False, True])
+def test_store_grid_entry_rendered(secret, basic_grid, session):
+    data = basic_grid._construct_post_request(None, secret)
+    data['code_cells'] = ['asdf']
+    hash_id = dbi.store_grid_entry(session, data, rendered=True)
+
+    grid_inst = dbi.get_grid_entry(session, hash_id, secret=secret)
+    assert '<table' in grid_inst.grid_html
+    assert len(grid_inst.code_html) == 1
+    assert 'asdf' in grid_inst.code_html[0]
+    assert grid_inst.render_version == render.RENDERER_VERSION
+
+
+def test_store_grid_entries_too_big_to_render(basic_grid, session):
+    big = basic_grid._construct_post_request(None, False)
+    small = ipb.BlockGrid(1, 1)._construct_post_request(None, False)
+
+    hash_ids = dbi.store_grid_entries(
+        session, [big, small], rendered=True, max_rendered_cells=3)
+
+    grid_inst = dbi.get_grid_entry(session, hash_ids[0])
+    assert grid_inst.grid_html is None
+    assert grid_inst.code_html is None
+    assert grid_inst.render_version is None
+
+    grid_inst = dbi.get_grid_entry(session, hash_ids[1])
+    assert '<table' in grid_inst.grid_html
+    assert grid_inst.render_version == render.RENDERER_VERSION
+
+
+def test_get_rendered_grid_entry_stale(basic_grid, session):
+    data = basic_grid._construct_post_request(None, False)
+    hash_id = dbi.store_grid_entry(session, data)
+
+    grid_inst = dbi.get_grid_entry(session, hash_id)
+    assert grid_inst.grid_html is None
+    session.expire_all()
+
+    grid_inst = dbi.get_rendered_grid_entry(session, hash_id)
+    assert '<table' in grid_inst.grid_html
+    assert grid_inst.code_html == []
+    assert grid_inst.render_version == render.RENDERER_VERSION
+
+    session.flush()
+    session.expire_all()
+    grid_inst = dbi.get_grid_entry(session, hash_id)
+    assert grid_inst.render_version == render.RENDERER_VERSION
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_get_rendered_grid_entry_large(packed, basic_grid, session):
+    data = basic_grid._construct_post_request(None, False)
+    hash_id = dbi.store_grid_entry(
+        session, data, rendered=True, packed=packed)
+    session.flush()
+    session.expire_all()
+
+    max_cells = basic_grid.width * basic_grid.height - 1
+    grid_inst = dbi.get_rendered_grid_entry(
+        session, hash_id, max_cells=max_cells)
+
+    assert dbi.exceeds_cells(grid_inst, max_cells)
+    assert {'grid_html', 'grid_data', 'grid_blob'} <= (
+        sa.inspect(grid_inst).unloaded)
+
+
+def test_get_rendered_grid_entry_under_max_cells(basic_grid, session):
+    data = basic_grid._construct_post_request(None, False)
+    hash_id = dbi.store_grid_entry(session, data, rendered=True)
+    session.flush()
+    session.expire_all()
+
+    max_cells = basic_grid.width * basic_grid.height
+    grid_inst = dbi.get_rendered_grid_entry(
+        session, hash_id, max_cells=max_cells)
+
+    assert not dbi.exceeds_cells(grid_inst, max_cells)
+    assert '<table' in grid_inst.grid_html
+    assert not session.dirty
+
+
+def test_get_rendered_grid_entry_missing(session):
+    assert dbi.get_rendered_grid_entry(session, 'asdfasdf') is None
+
+
+@pytest.mark.parametrize('secret', [False, True])
+def test_store_grid_entry_packed(secret, basic_grid, session):
+    data = basic_grid._construct_post_request(None, secret)
+    comp_data = json.loads(json.dumps(data))
+    hash_id = dbi.store_grid_entry(session, data, packed=True)
+    session.flush()
+    session.expire_all()
+
+    grid_inst = dbi.get_grid_entry(session, hash_id, secret=secret)
+    assert grid_inst.grid_blob is not None
+    assert 'blocks' not in grid_inst.grid_data
+
+    grid_data = dbi.load_grid_data(grid_inst)
+    grid_data['blocks'] = grid_data['blocks'].tolist()
+    assert grid_data == comp_data['grid_data']
+
+
+def test_get_rendered_grid_entry_packed(basic_grid, session):
+    data = basic_grid._construct_post_request(None, False)
+    hash_id = dbi.store_grid_entry(session, data, packed=True)
+    session.flush()
+    session.expire_all()
+
+    grid_inst = dbi.get_rendered_grid_entry(session, hash_id)
+    assert grid_inst.grid_html.endswith(basic_grid._repr_html_()[-100:])
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_get_grid_json(packed, basic_grid, session):
+    data = basic_grid._construct_post_request(None, False)
+    comp_data = json.loads(json.dumps(data))
+    hash_id = dbi.store_grid_entry(session, data, packed=packed)
+
+    grid_json, created_at = dbi.get_grid_json(session, hash_id)
+    assert json.loads(grid_json) == comp_data['grid_data']
+    assert created_at is not None
+
+
+def test_packed_keeps_extra_keys(basic_grid, session):
+    data = basic_grid._construct_post_request(None, False)
+    data['grid_data']['extra'] = {'a': 1}
+    comp_data = json.loads(json.dumps(data))
+    hash_id = dbi.store_grid_entry(session, data, packed=True)
+    session.flush()
+    session.expire_all()
+
+    grid_json, _ = dbi.get_grid_json(session, hash_id)
+    assert json.loads(grid_json) == comp_data['grid_data']
+
+    grid_data, _ = dbi.get_grid_data(session, hash_id)
+    assert grid_data['extra'] == {'a': 1}
+    assert grid_data['blocks'].tolist() == comp_data['grid_data']['blocks']
+
+
+def test_get_grid_json_missing(session):
+    assert dbi.get_grid_json(session, 'asdfasdf') is None
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_get_grid_data(packed, basic_grid, session):
+    data = basic_grid._construct_post_request(None, False)
+    comp_data = json.loads(json.dumps(data))
+    hash_id = dbi.store_grid_entry(session, data, packed=packed)
+
+    grid_data, created_at = dbi.get_grid_data(session, hash_id)
+    assert grid_data['width'] == comp_data['grid_data']['width']
+    assert (np.asarray(grid_data['blocks']).tolist() ==
+            comp_data['grid_data']['blocks'])
+    assert created_at is not None
+
+
+def test_get_grid_data_missing(session):
+    assert dbi.get_grid_data(session, 'asdfasdf') is None
+
+
+def test_content_hash(basic_grid):
+    data = basic_grid._construct_post_request(None, False)
+    digest = dbi.content_hash(data)
+
+    # round tripping through JSON doesn't change the hash
+    assert dbi.content_hash(json.loads(json.dumps(data))) == digest
+
+    data['python_version'] = [0, 0, 0, 'final', 0]
+    assert dbi.content_hash(data) == digest
+
+    for key, value in [('code_cells', ['asdf']), ('ipb_class', 'ImageGrid'),
+                       ('secret', True)]:
+        changed = dict(data, **{key: value})
+        assert dbi.content_hash(changed) != digest
+
+
+@pytest.mark.parametrize('secret', [False, True])
+def test_store_grid_entry_dedup(secret, basic_grid, session):
+    data = basic_grid._construct_post_request(None, secret)
+    hash_id = dbi.store_grid_entry(session, data)
+
+    assert dbi.store_grid_entry(session, data) == hash_id
+    assert dbi.store_grid_entry(session, data, packed=True) == hash_id
+
+    data['code_cells'] = ['asdf']
+    assert dbi.store_grid_entry(session, data) != hash_id
+
+    table = models.SecretGrid if secret else models.PublicGrid
+    assert session.query(table).count() == 2
+
+
+def test_store_grid_entries(basic_grid, session):
+    public = basic_grid._construct_post_request(None, False)
+    secret = basic_grid._construct_post_request(None, True)
+    other = basic_grid._construct_post_request(None, False)
+    other['code_cells'] = ['asdf']
+    existing = dbi.store_grid_entry(session, other)
+
+    hash_ids = dbi.store_grid_entries(
+        session, [public, secret, public, other], packed=True)
+
+    assert hash_ids[0] == hash_ids[2]
+    assert hash_ids[3] == existing
+    assert dbi.decode_hash_id(hash_ids[1], True)
+    assert dbi.get_grid_entry(session, hash_ids[0]).grid_blob is not None
+    assert dbi.get_grid_entry(session, hash_ids[1], secret=True)
+    assert session.query(models.PublicGrid).count() == 2
+
+
+def test_store_grid_entries_extra_keys(basic_grid, session):
+    extra = basic_grid._construct_post_request(None, False)
+    extra['asdf'] = 'jkl;'
+    secret = basic_grid._construct_post_request(None, True)
+
+    hash_ids = dbi.store_grid_entries(session, [extra, secret])
+
+    assert dbi.get_grid_entry(session, hash_ids[0])
+    assert dbi.get_grid_entry(session, hash_ids[1], secret=True)
+
+
+def test_store_grid_entries_ignores_posted_columns(basic_grid, session):
+    forged = basic_grid._construct_post_request(None, False)
+    forged.update(
+        grid_html='<script></script>', code_html=['<script></script>'],
+        render_version='1', id=1000, created_at='2100-01-01T00:00:00Z')
+    basic_grid[0, 0].red = 1
+    plain = basic_grid._construct_post_request(None, False)
+
+    hash_ids = dbi.store_grid_entries(session, [forged, plain])
+
+    grid_id = dbi.decode_hash_id(hash_ids[0], secret=False)
+    grid_spec = dbi.get_grid_entry(session, hash_ids[0])
+    assert grid_id != 1000
+    assert grid_spec.grid_html is None
+    assert grid_spec.code_html is None
+    assert grid_spec.render_version is None
+    assert grid_spec.created_at.year < 2100
+    assert dbi.get_grid_entry(session, hash_ids[1])
+
+
+def test_cursor_roundtrip():
+    created_at = datetime.datetime(
+        2017, 6, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc)
+    cursor = dbi.encode_cursor(created_at, 42)
+
+    assert dbi.decode_cursor(cursor) == (created_at, 42)
+    assert dbi.decode_cursor('asdf') is None
+    assert dbi.decode_cursor(dbi.encode_grid_id(42, False)) is None
+
+
+def test_list_public_grids(basic_grid, session):
+    data = basic_grid._construct_post_request(None, False)
+    hash_ids = []
+    for i in range(5):
+        data['code_cells'] = [str(i)]
+        hash_ids.append(dbi.store_grid_entry(session, data))
+    data['secret'] = True
+    dbi.store_grid_entry(session, data)
+
+    listed = []
+    cursor = None
+    for page_size in (2, 2, 1):
+        grids, cursor = dbi.list_public_grids(session, 2, cursor)
+        assert len(grids) == page_size
+        listed.extend(grids)
+
+    assert cursor is None
+    # all posted in one transaction so newest first is by id
+    assert [g['hash_id'] for g in listed] == hash_ids[::-1]
+    assert listed[0]['width'] == data['grid_data']['width']
+    assert listed[0]['height'] == data['grid_data']['height']
+    assert listed[0]['ipb_class'] == 'BlockGrid'
+
+
+def test_list_public_grids_bad_cursor(session):
+    with pytest.raises(ValueError):
+        dbi.list_public_grids(session, 10, 'asdf')
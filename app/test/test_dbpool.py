@@ -0,0 +1,74 @@
+import pytest
+import sqlalchemy as sa
+
+from .. import dbpool
+
+
+@pytest.fixture
+def db_url(tmpdir):
+    return 'sqlite:///' + str(tmpdir.join('pool.db'))
+
+
+def test_connect_records_checkout(db_url):
+    engine, stats = dbpool.make_engine(db_url, pool_size=2, max_overflow=0)
+
+    with stats.connect() as connection:
+        assert connection.execute(sa.text('SELECT 1')).scalar() == 1
+        assert stats.pool_status()['in_use'] == 1
+
+    result = stats.stats()
+    assert result['checkouts'] == 1
+    assert result['checkout_seconds'] >= 0
+    assert result['in_use'] == 0
+    assert result['idle'] == 1
+    assert result['timeouts'] == 0
+
+
+def test_connect_timeout(db_url):
+    engine, stats = dbpool.make_engine(
+        db_url, pool_size=1, max_overflow=0, pool_timeout=0.01)
+
+    with stats.connect():
+        with pytest.raises(sa.exc.TimeoutError):
+            stats.connect()
+
+    assert stats.timeouts == 1
+    assert stats.checkouts == 1
+
+
+def test_overflow(db_url):
+    engine, stats = dbpool.make_engine(db_url, pool_size=1, max_overflow=1)
+
+    with stats.connect(), stats.connect():
+        status = stats.pool_status()
+        assert status['in_use'] == 2
+        assert status['overflow'] == 1
+
+
+def test_pre_ping_replaces_stale(db_url):
+    engine, stats = dbpool.make_engine(db_url, pool_size=1, max_overflow=0)
+
+    with stats.connect() as connection:
+        dbapi_connection = connection.connection.connection
+
+    # simulate the server closing the connection while it's pooled
+    dbapi_connection.close()
+
+    with stats.connect() as connection:
+        assert connection.execute(sa.text('SELECT 1')).scalar() == 1
+
+    assert stats.disconnects == 1
+
+
+def test_no_pre_ping(db_url):
+    engine, stats = dbpool.make_engine(
+        db_url, pool_size=1, max_overflow=0, pre_ping=False)
+
+    with stats.connect() as connection:
+        dbapi_connection = connection.connection.connection
+
+    dbapi_connection.close()
+
+    with stats.connect() as connection:
+        with pytest.raises(sa.exc.DBAPIError):
+            connection.execute(sa.text('SELECT 1'))
@@ -0,0 +1,74 @@
+import pytest
+
+from .. import gridpack
+
+
+def grid_data(blocks):
+    return {
+        'lines_on': False,
+        'width': len(blocks[0]),
+        'height': len(blocks),
+        'blocks': blocks
+    }
+
+
+@pytest.fixture
+def data_2x3():
+    return grid_data([[[1, 2, 3, 4], [5, 6, 7, 8], [9, 10, 11, 12]],
+                      [[13, 14, 15, 16], [17, 18, 19, 20], [0, 0, 0, 0]]])
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_round_trip(data_2x3, compress):
+    gd = gridpack.unpack(gridpack.pack(data_2x3, compress=compress))
+
+    assert gd['lines_on'] is False
+    assert gd['width'] == 3
+    assert gd['height'] == 2
+    assert gd['blocks'].tolist() == data_2x3['blocks']
+
+
+@pytest.mark.parametrize('high, itemsize', [
+    (255, 1), (256, 2), (2 ** 16, 4), (2 ** 32 - 1, 4)])
+def test_smallest_dtype(data_2x3, high, itemsize):
+    data_2x3['blocks'][1][2][3] = high
+    blob = gridpack.pack(data_2x3, compress=False)
+
+    assert len(blob) == gridpack.HEADER.size + 24 * itemsize
+    assert gridpack.unpack(blob)['blocks'][1, 2, 3] == high
+
+
+@pytest.mark.parametrize('value', [2 ** 32, 2 ** 70, -1])
+def test_unpackable(data_2x3, value):
+    data_2x3['blocks'][0][0][0] = value
+    assert gridpack.pack(data_2x3) is None
+
+
+def test_wrong_shape(data_2x3):
+    data_2x3['width'] = 2
+    assert gridpack.pack(data_2x3) is None
+
+
+def test_ragged(data_2x3):
+    data_2x3['blocks'][1].pop()
+    assert gridpack.pack(data_2x3) is None
+
+
+def test_unpack_no_copy(data_2x3):
+    blob = gridpack.pack(data_2x3, compress=False)
+    blocks = gridpack.unpack(memoryview(blob))['blocks']
+
+    assert not blocks.flags.owndata
+    assert not blocks.flags.writeable
+
+
+def test_compresses():
+    blocks = [[[255, 255, 255, 20]] * 100] * 100
+    blob = gridpack.pack(grid_data(blocks))
+    assert len(blob) < 1000
+
+
+def test_bad_magic(data_2x3):
+    blob = gridpack.pack(data_2x3)
+    with pytest.raises(ValueError):
+        gridpack.unpack(b'XXXX' + blob[4:])
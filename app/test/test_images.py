@@ -0,0 +1,132 @@
+import gzip
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from .. import images
+
+
+def decode_png(data):
+    """
+    Read back an RGB PNG written by images.encode_png.
+
+    """
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    pos = 8
+    chunks = {}
+    while pos < len(data):
+        length, = struct.unpack('>I', data[pos:pos + 4])
+        tag = data[pos + 4:pos + 8]
+        body = data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack('>I', data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(tag + body) & 0xffffffff
+        chunks[tag] = body
+        pos += 12 + length
+
+    width, height, depth, color_type = struct.unpack(
+        '>IIBB', chunks[b'IHDR'][:10])
+    assert (depth, color_type) == (8, 2)
+
+    raw = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8)
+    raw = raw.reshape(height, width * 3 + 1)
+    assert (raw[:, 0] == 2).all()
+    rows = np.cumsum(raw[:, 1:], axis=0, dtype=np.uint8)
+    return rows.reshape(height, width, 3)
+
+
+def grid_data(lines_on=False, size=3):
+    return {
+        'lines_on': lines_on,
+        'width': 3,
+        'height': 2,
+        'blocks': [[[255, 0, 0, size], [255, 0, 0, size], [0, 0, 255, size]],
+                   [[0, 255, 0, size], [10, 20, 30, size], [0, 0, 0, size]]]
+    }
+
+
+def test_encode_png_roundtrip():
+    pixels = np.random.RandomState(0).randint(
+        0, 256, size=(7, 5, 3)).astype(np.uint8)
+
+    np.testing.assert_array_equal(
+        decode_png(images.encode_png(pixels)), pixels)
+
+
+def test_grid_pixels():
+    colors = np.array([[[1, 1, 1], [2, 2, 2]]], dtype=np.uint8)
+    pixels = images.grid_pixels(colors, 2, 1)
+
+    assert pixels.shape == (4, 7, 3)
+    np.testing.assert_array_equal(pixels[:, :, 0], [
+        [255, 255, 255, 255, 255, 255, 255],
+        [255, 1, 1, 255, 2, 2, 255],
+        [255, 1, 1, 255, 2, 2, 255],
+        [255, 255, 255, 255, 255, 255, 255]])
+
+
+@pytest.mark.parametrize('lines_on', [False, True])
+def test_encode_png(lines_on):
+    pixels = decode_png(images.encode(grid_data(lines_on), 'png'))
+
+    line = 1 if lines_on else 0
+    assert pixels.shape == (2 * (3 + line) + line, 3 * (3 + line) + line, 3)
+    assert tuple(pixels[line, line]) == (255, 0, 0)
+    assert tuple(pixels[-1 - line, -1 - line]) == (0, 0, 0)
+    assert tuple(pixels[line + 4, line + 4]) == (10, 20, 30)
+
+
+def test_encode_png_fits():
+    data = grid_data(lines_on=True, size=10 ** 6)
+    pixels = decode_png(images.encode(data, 'png'))
+
+    assert max(pixels.shape[:2]) <= images.MAX_IMAGE_SIDE
+
+
+def test_shrink():
+    colors = np.zeros((5, 4, 3), dtype=np.uint8)
+    colors[:2, :2] = 100
+
+    shrunk = images._shrink(colors, 3)
+
+    assert shrunk.shape == (3, 2, 3)
+    assert tuple(shrunk[0, 0]) == (100, 100, 100)
+    assert tuple(shrunk[2, 1]) == (0, 0, 0)
+
+
+def test_encode_thumb():
+    pixels = decode_png(images.encode(grid_data(lines_on=True), 'thumb'))
+
+    side = images.THUMB_SIDE // 3
+    assert pixels.shape == (2 * side, 3 * side, 3)
+    assert tuple(pixels[0, 0]) == (255, 0, 0)
+
+
+def test_encode_svg():
+    svg = images.encode(grid_data(lines_on=True), 'svg').decode('utf-8')
+
+    assert svg.startswith('<svg xmlns="http://www.w3.org/2000/svg" '
+                          'width="13" height="9"')
+    # the two red blocks of the first row are one rectangle
+    assert '<rect x="1" y="1" width="7" height="3" fill="#ff0000"/>' in svg
+    assert svg.count('<rect') == 5
+    assert '<path d="M0.5 0V9' in svg
+    assert svg.endswith('</svg>')
+
+
+def test_encode_raw():
+    raw = gzip.decompress(images.encode(grid_data(lines_on=True), 'raw'))
+
+    header = images.RAW_HEADER.unpack_from(raw)
+    assert header == (images.RAW_MAGIC, 3, 2, 3, 1)
+
+    colors = np.frombuffer(raw[images.RAW_HEADER.size:], dtype=np.uint8)
+    np.testing.assert_array_equal(
+        colors.reshape(2, 3, 3),
+        np.array(grid_data()['blocks'])[..., :3])
+
+
+def test_encode_unknown():
+    with pytest.raises(ValueError):
+        images.encode(grid_data(), 'gif')
@@ -0,0 +1,75 @@
+import pytest
+
+from .. import metrics
+
+
+def test_counter():
+    counter = metrics.Counter('test_total', 'A test.', ['kind'])
+    counter.inc(kind='a')
+    counter.inc(2, kind='a')
+    counter.inc(kind='b')
+
+    assert counter.exposition() == (
+        '# HELP test_total A test.\n'
+        '# TYPE test_total counter\n'
+        'test_total{kind="a"} 3.0\n'
+        'test_total{kind="b"} 1.0\n')
+
+
+def test_wrong_labels():
+    counter = metrics.Counter('test_total', 'A test.', ['kind'])
+
+    with pytest.raises(ValueError):
+        counter.inc(other='a')
+
+
+def test_label_escaping():
+    gauge = metrics.Gauge('test', 'A test.', ['kind'])
+    gauge.set(1, kind='a "b"\\\n')
+
+    assert 'test{kind="a \\"b\\"\\\\\\n"} 1.0' in gauge.exposition()
+
+
+def test_histogram():
+    histogram = metrics.Histogram('test_seconds', 'A test.', buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+
+    assert histogram.exposition() == (
+        '# HELP test_seconds A test.\n'
+        '# TYPE test_seconds histogram\n'
+        'test_seconds_bucket{le="1.0"} 2.0\n'
+        'test_seconds_bucket{le="5.0"} 3.0\n'
+        'test_seconds_bucket{le="+Inf"} 4.0\n'
+        'test_seconds_sum 14.5\n'
+        'test_seconds_count 4.0\n')
+
+
+def test_histogram_time():
+    histogram = metrics.Histogram('test_seconds', 'A test.', ['stage'])
+    with histogram.time(stage='a'):
+        pass
+
+    samples = {(name, tuple(labels)): value
+               for name, labels, value in histogram.samples()}
+    assert samples[('test_seconds_count', (('stage', 'a'),))] == 1
+
+
+def test_registry():
+    registry = metrics.Registry()
+    registry.register(metrics.Counter('a_total', 'A.')).inc()
+    registry.register(metrics.Gauge('b', 'B.')).set(2)
+
+    text = registry.exposition()
+    assert 'a_total 1.0\n' in text
+    assert 'b 2.0\n' in text
+
+
+def test_record_cache_stats():
+    metrics.record_cache_stats('test', {
+        'hits': 3, 'misses': 2, 'evictions': 1, 'entries': 4, 'bytes': 100,
+        'max_bytes': 1000})
+
+    text = metrics.REGISTRY.exposition()
+    assert 'ipborg_cache_events_total{cache="test",event="hits"} 3.0' in text
+    assert 'ipborg_cache_bytes{cache="test"} 100.0' in text
@@ -0,0 +1,126 @@
+import copy
+import json
+
+import jsonschema
+import pytest
+
+from .. import postvalidate
+
+
+def request():
+    return json.loads(json.dumps({
+        'python_version': (3, 6, 1, 'final', 0),
+        'ipb_version': '1.7.0',
+        'ipb_class': 'ImageGrid',
+        'code_cells': ['asdf', 'jkl;'],
+        'secret': False,
+        'grid_data': {
+            'lines_on': True,
+            'width': 3,
+            'height': 2,
+            'blocks': [[[1, 2, 3, 20], [4, 5, 6, 20], [7, 8, 9, 20]],
+                       [[0, 0, 0, 0], [255, 255, 255, 1], [999, 0, 2, 3]]]
+        }
+    }))
+
+
+def modified(path, value):
+    """
+    Make a request with the item at `path` replaced by `value`,
+    or deleted if `value` is DELETE.
+
+    """
+    req = request()
+    target = req
+    for key in path[:-1]:
+        target = target[key]
+
+    if value is DELETE:
+        del target[path[-1]]
+    else:
+        target[path[-1]] = value
+
+    return req
+
+
+DELETE = object()
+BLOCK = ('grid_data', 'blocks', 1, 2)
+ROW = ('grid_data', 'blocks', 0)
+
+CORPUS = [
+    request(),
+    modified(('code_cells',), None),
+    modified(('code_cells',), []),
+    modified(('ipb_version',), '1.6'),
+    modified(('ipb_version',), 'one'),
+    modified(('ipb_class',), 'Grid'),
+    modified(('python_version',), [3, 6]),
+    modified(('secret',), 'yes'),
+    modified(('secret',), DELETE),
+    modified(('grid_data', 'lines_on'), 1),
+    modified(('grid_data', 'blocks'), []),
+    modified(('grid_data', 'blocks'), {'a': 1}),
+    modified(('grid_data', 'blocks', 1), 'row'),
+    modified(BLOCK, [1, 2, 3]),
+    modified(BLOCK, [1, 2, 3, 4, 5]),
+    modified(BLOCK, [1, 2, 3, -4]),
+    modified(BLOCK, [1, 2, 3.0, 4]),
+    modified(BLOCK, [1, 2, 3.5, 4]),
+    modified(BLOCK, [1, 2, True, 4]),
+    modified(BLOCK, [1, 2, '3', 4]),
+    modified(BLOCK, [1, 2, None, 4]),
+    modified(BLOCK, [1, 2, 2 ** 70, 4]),
+    modified(BLOCK, {'r': 1}),
+    modified(BLOCK, 7),
+    modified(BLOCK + (0,), [1]),
+    modified(('grid_data', 'width'), 0),
+    modified(('grid_data', 'width'), 3.0),
+    modified(('grid_data', 'height'), '2'),
+    modified(('grid_data', 'height'), DELETE),
+    [],
+    'grid',
+    {},
+]
+
+
+@pytest.mark.parametrize('req', CORPUS)
+def test_matches_schema(req):
+    expected = jsonschema.Draft4Validator(postvalidate.schema).is_valid(req)
+
+    try:
+        postvalidate.validate(copy.deepcopy(req))
+    except jsonschema.ValidationError:
+        valid = False
+    else:
+        valid = True
+
+    assert valid == expected
+
+
+@pytest.mark.parametrize('path, value', [
+    (('grid_data', 'width'), 2),
+    (('grid_data', 'height'), 3),
+    (ROW, [[1, 2, 3, 4], [1, 2, 3, 4]]),
+])
+def test_shape_mismatch(path, value):
+    req = modified(path, value)
+    jsonschema.validate(req, postvalidate.schema)
+
+    with pytest.raises(jsonschema.ValidationError):
+        postvalidate.validate(req)
+
+
+@pytest.mark.parametrize('max_width, max_height, valid', [
+    (None, None, True),
+    (3, 2, True),
+    (2, None, False),
+    (None, 1, False),
+])
+def test_max_dimensions(max_width, max_height, valid):
+    req = request()
+
+    if valid:
+        postvalidate.validate(req, max_width, max_height)
+    else:
+        with pytest.raises(jsonschema.ValidationError):
+            postvalidate.validate(req, max_width, max_height)
@@ -0,0 +1,40 @@
+import pytest
+
+from ..ratelimit import TokenBucketLimiter
+
+
+def test_burst_then_wait():
+    limiter = TokenBucketLimiter(rate=2, burst=3)
+
+    assert [limiter.take('a', now=0) for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('a', now=0) == pytest.approx(0.5)
+
+
+def test_refills_over_time():
+    limiter = TokenBucketLimiter(rate=2, burst=3)
+    for _ in range(3):
+        limiter.take('a', now=0)
+
+    assert limiter.take('a', now=0.5) == 0
+    assert limiter.take('a', now=0.5) == pytest.approx(0.5)
+    # never more than burst
+    assert [limiter.take('a', now=100) for _ in range(4)][-1] > 0
+
+
+def test_clients_are_separate():
+    limiter = TokenBucketLimiter(rate=1, burst=1)
+
+    assert limiter.take('a', now=0) == 0
+    assert limiter.take('a', now=0) > 0
+    assert limiter.take('b', now=0) == 0
+
+
+def test_forgets_oldest_clients():
+    limiter = TokenBucketLimiter(rate=1, burst=1, max_clients=2)
+    limiter.take('a', now=0)
+    limiter.take('b', now=0)
+    limiter.take('c', now=0)
+
+    assert len(limiter) == 2
+    assert limiter.take('a', now=0) == 0
+    assert limiter.take('c', now=0) > 0
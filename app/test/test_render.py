@@ -0,0 +1,97 @@
+import random
+from unittest import mock
+
+import ipythonblocks as ipb
+import numpy as np
+import pytest
+
+from .. import render
+
+TABLE_ID = 'f00d'
+
+
+def random_grid_data(width, height, lines_on=True, max_value=255, seed=0):
+    rand = random.Random(seed)
+    blocks = [[[rand.randint(0, max_value) for _ in range(4)]
+               for _ in range(width)]
+              for _ in range(height)]
+    return {
+        'lines_on': lines_on,
+        'width': width,
+        'height': height,
+        'blocks': blocks
+    }
+
+
+def block_grid_html(grid_data):
+    grid = ipb.BlockGrid(
+        grid_data['width'], grid_data['height'],
+        lines_on=grid_data['lines_on'])
+    grid._load_simple_grid(grid_data['blocks'])
+
+    with mock.patch('uuid.uuid4', return_value=TABLE_ID):
+        return grid._repr_html_()
+
+
+@pytest.mark.parametrize('width, height', [
+    (1, 1), (1, 7), (7, 1), (2, 2), (10, 10), (13, 70), (100, 3)])
+@pytest.mark.parametrize('lines_on', [True, False])
+def test_matches_block_grid(width, height, lines_on):
+    gd = random_grid_data(width, height, lines_on)
+    assert render.render_grid_html(gd, TABLE_ID) == block_grid_html(gd)
+
+
+def test_matches_block_grid_out_of_range():
+    # colors above 255 are clamped and sizes below 1 are raised to 1
+    gd = random_grid_data(5, 5, max_value=1000)
+    gd['blocks'][0][0] = [0, 0, 0, 0]
+    gd['blocks'][1][1] = [2 ** 70, 300, 256, 2 ** 70]
+    assert render.render_grid_html(gd, TABLE_ID) == block_grid_html(gd)
+
+
+def test_matches_block_grid_array_input():
+    gd = random_grid_data(9, 4)
+    expected = block_grid_html(gd)
+    gd['blocks'] = np.array(gd['blocks'], dtype=np.uint8)
+    assert render.render_grid_html(gd, TABLE_ID) == expected
+
+
+def test_chunked_rows(monkeypatch):
+    monkeypatch.setattr(render, 'CHUNK_ROWS', 3)
+    gd = random_grid_data(4, 10)
+    assert render.render_grid_html(gd, TABLE_ID) == block_grid_html(gd)
+
+
+def test_random_table_id():
+    gd = random_grid_data(2, 2)
+    assert render.render_grid_html(gd) != render.render_grid_html(gd)
+
+
+def partial_block_grid_html(grid_data):
+    # a BlockGrid with only the given blocks loaded, the rest left default
+    grid = ipb.BlockGrid(
+        grid_data['width'], grid_data['height'],
+        lines_on=grid_data['lines_on'])
+    for r, row in enumerate(grid_data['blocks'][:grid.height]):
+        for c, block in enumerate(row[:grid.width]):
+            grid[r, c].rgb = block[:3]
+            grid[r, c].size = block[3]
+
+    with mock.patch('uuid.uuid4', return_value=TABLE_ID):
+        return grid._repr_html_()
+
+
+def test_short_blocks():
+    gd = random_grid_data(3, 3)
+    gd['width'] = 5
+    gd['height'] = 4
+    gd['blocks'][1] = gd['blocks'][1][:1]
+    assert render.render_grid_html(gd, TABLE_ID) == partial_block_grid_html(gd)
+
+
+def test_long_blocks():
+    gd = random_grid_data(6, 5)
+    gd['width'] = 4
+    gd['height'] = 2
+    gd['blocks'][0].append([1, 2, 3, 4])
+    assert render.render_grid_html(gd, TABLE_ID) == partial_block_grid_html(gd)
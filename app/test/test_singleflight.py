@@ -0,0 +1,72 @@
+import pytest
+import tornado.gen
+import tornado.testing
+from tornado.concurrent import Future
+
+from ..singleflight import SingleFlight
+
+
+class TestSingleFlight(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_followers_share_result(self):
+        flights = SingleFlight()
+        started = []
+        gate = Future()
+
+        @tornado.gen.coroutine
+        def work():
+            started.append(1)
+            result = yield gate
+            return result
+
+        futures = [flights.do('a', work, kind='test') for _ in range(3)]
+        assert len(flights) == 1
+
+        gate.set_result('done')
+        results = yield futures
+
+        assert results == ['done'] * 3
+        assert len(started) == 1
+        assert len(flights) == 0
+
+    @tornado.testing.gen_test
+    def test_errors_propagate(self):
+        flights = SingleFlight()
+        gate = Future()
+
+        futures = [flights.do('a', lambda: gate, kind='test')
+                   for _ in range(2)]
+        gate.set_exception(KeyError('a'))
+
+        for future in futures:
+            with pytest.raises(KeyError):
+                yield future
+        assert len(flights) == 0
+
+    @tornado.testing.gen_test
+    def test_keys_separate(self):
+        flights = SingleFlight()
+        gates = {'a': Future(), 'b': Future()}
+
+        a = flights.do('a', lambda: gates['a'], kind='test')
+        b = flights.do('b', lambda: gates['b'], kind='test')
+        assert len(flights) == 2
+
+        gates['a'].set_result(1)
+        gates['b'].set_result(2)
+        assert (yield a) == 1
+        assert (yield b) == 2
+
+    @tornado.testing.gen_test
+    def test_new_call_after_finish(self):
+        flights = SingleFlight()
+        calls = []
+
+        @tornado.gen.coroutine
+        def work():
+            calls.append(1)
+            yield tornado.gen.moment
+            return len(calls)
+
+        assert (yield flights.do('a', work, kind='test')) == 1
+        assert (yield flights.do('a', work, kind='test')) == 2
@@ -0,0 +1,111 @@
+"""
+Script for filling in the width and height columns of stored grids,
+which let the gallery list grids without reading their grid_data.
+
+Adds the columns, and the index the gallery pages through public grids
+with, if the tables predate them. The dimensions are then copied out of
+grid_data by Postgres in batches of ids, each committed on its own so
+the script can be stopped and run again without losing progress.
+
+"""
+import argparse
+import contextlib
+import os
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+# The module in the ipythonblocks.org application code that contains
+# table definitions
+from app import models
+
+DBURL = os.environ['DATABASE_URL']  # could be local or remote server
+PSQL_ENGINE = sa.create_engine(DBURL)
+SESSION = sessionmaker(bind=PSQL_ENGINE)
+
+ADD_COLUMNS = """
+ALTER TABLE {table}
+    ADD COLUMN IF NOT EXISTS width integer,
+    ADD COLUMN IF NOT EXISTS height integer
+"""
+
+# built without locking the table against new posts,
+# which means it can't be done inside a transaction
+ADD_INDEX = """
+CREATE INDEX CONCURRENTLY IF NOT EXISTS public_grids_created_at_id_idx
+    ON public_grids (created_at, id)
+"""
+
+COPY_DIMENSIONS = """
+UPDATE {table}
+SET width = (grid_data->>'width')::integer,
+    height = (grid_data->>'height')::integer
+WHERE id > :start AND id <= :stop AND width IS NULL
+"""
+
+
+@contextlib.contextmanager
+def session_context():
+    session = SESSION()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def add_columns():
+    """
+    Add the dimension columns and gallery index to grid tables
+    created before they existed.
+
+    """
+    with session_context() as session:
+        for sa_cls in (models.PublicGrid, models.SecretGrid):
+            session.execute(sa.text(
+                ADD_COLUMNS.format(table=sa_cls.__tablename__)))
+
+    with PSQL_ENGINE.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(sa.text(ADD_INDEX))
+
+
+def backfill_table(sa_cls, batch_size):
+    """
+    Copy the dimensions of every grid in the table of sa_cls out of
+    grid_data, committing after every batch_size ids.
+
+    """
+    with session_context() as session:
+        max_id = session.query(sa.func.max(sa_cls.id)).scalar() or 0
+
+    update = sa.text(COPY_DIMENSIONS.format(table=sa_cls.__tablename__))
+    total = 0
+
+    for start in range(0, max_id, batch_size):
+        stop = start + batch_size
+        with session_context() as session:
+            total += session.execute(
+                update, {'start': start, 'stop': stop}).rowcount
+
+        print(f'{sa_cls.__tablename__}: updated {total} grids '
+              f'(through id {min(stop, max_id)} of {max_id})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--batch-size', type=int, default=5000,
+        help='Number of ids to update per transaction.')
+    args = parser.parse_args()
+
+    add_columns()
+    backfill_table(models.PublicGrid, args.batch_size)
+    backfill_table(models.SecretGrid, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
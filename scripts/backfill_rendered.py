@@ -0,0 +1,122 @@
+"""
+Script for rendering stored grids to HTML and saving the results in the
+grid_html, code_html, and render_version columns.
+
+Adds the columns if the tables predate them, then works through both
+grid tables in batches, rendering any grid whose stored rendering is
+missing or was made by an older renderer. Grids bigger than the server
+sends as rendered tables are skipped, their pages don't use the stored
+HTML. Each batch is committed on its own so the script can be stopped
+and run again without losing progress.
+
+"""
+import argparse
+import contextlib
+import os
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+# The modules in the ipythonblocks.org application code that contain
+# table definitions, stored grid loading, and the grid renderer
+from app import dbinterface as dbi
+from app import models
+from app import render
+
+DBURL = os.environ['DATABASE_URL']  # could be local or remote server
+PSQL_ENGINE = sa.create_engine(DBURL)
+SESSION = sessionmaker(bind=PSQL_ENGINE)
+
+ADD_COLUMNS = """
+ALTER TABLE {table}
+    ADD COLUMN IF NOT EXISTS grid_html text,
+    ADD COLUMN IF NOT EXISTS code_html jsonb,
+    ADD COLUMN IF NOT EXISTS render_version text
+"""
+
+
+@contextlib.contextmanager
+def session_context():
+    session = SESSION()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def add_columns():
+    """
+    Add the rendered HTML columns to grid tables created before they existed.
+
+    """
+    with session_context() as session:
+        for sa_cls in (models.PublicGrid, models.SecretGrid):
+            session.execute(sa.text(
+                ADD_COLUMNS.format(table=sa_cls.__tablename__)))
+
+
+def backfill_table(sa_cls, batch_size, max_cells):
+    """
+    Render every grid in the table of sa_cls with a missing or
+    stale rendering and at most max_cells blocks (0 for no limit),
+    committing after every batch_size grids.
+
+    """
+    last_id = 0
+    total = 0
+
+    filters = [
+        sa_cls.render_version.is_distinct_from(render.RENDERER_VERSION)]
+    if max_cells:
+        # from grid_data since the width and height columns
+        # may not have been filled in yet
+        filters.append(
+            sa_cls.grid_data['width'].astext.cast(sa.Integer) *
+            sa_cls.grid_data['height'].astext.cast(sa.Integer) <= max_cells)
+
+    while True:
+        with session_context() as session:
+            rows = session.query(
+                sa_cls.id, sa_cls.grid_data, sa_cls.grid_blob,
+                sa_cls.code_cells).filter(
+                    sa_cls.id > last_id, *filters).order_by(
+                        sa_cls.id).limit(batch_size).all()
+
+            if not rows:
+                break
+
+            session.bulk_update_mappings(sa_cls, [
+                dict(id=row.id,
+                     **render.render_columns(
+                         dbi.load_grid_data(row), row.code_cells))
+                for row in rows])
+
+        last_id = rows[-1].id
+        total += len(rows)
+        print(f'{sa_cls.__tablename__}: rendered {total} grids '
+              f'(through id {last_id})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--batch-size', type=int, default=50,
+        help='Number of grids to render per transaction, '
+             'all of which are held in memory at once.')
+    parser.add_argument(
+        '--max-cells', type=int, default=10000,
+        help="Largest grid, in blocks, to render (0: no limit). "
+             "Match the server's canvas_grid_cells option.")
+    args = parser.parse_args()
+
+    add_columns()
+    backfill_table(models.PublicGrid, args.batch_size, args.max_cells)
+    backfill_table(models.SecretGrid, args.batch_size, args.max_cells)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark storing grids with one request to /post/batch against one
+request per grid to /post, using a throwaway local Postgres server.
+
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+import sqlalchemy as sa
+import testing.postgresql
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.options
+
+# The modules in the ipythonblocks.org application code that contain
+# the application and table definitions
+from app import app
+from app import models
+
+
+def make_post(size):
+    """
+    Make a grid post with random colors so no two posts are deduplicated.
+
+    """
+    blocks = [[[random.randint(0, 255) for _ in range(3)] + [20]
+               for _ in range(size)]
+              for _ in range(size)]
+    return {
+        'python_version': [3, 6, 1, 'final', 0],
+        'ipb_version': '1.7.0',
+        'ipb_class': 'BlockGrid',
+        'code_cells': None,
+        'secret': False,
+        'grid_data': {
+            'lines_on': True,
+            'width': size,
+            'height': size,
+            'blocks': blocks
+        }
+    }
+
+
+@tornado.gen.coroutine
+def bench(base_url, count, size, concurrency):
+    """
+    Time posting `count` grids singly and as one batch.
+    Returns the elapsed seconds for each.
+
+    """
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+
+    posts = [json.dumps(make_post(size)) for _ in range(count)]
+    start = time.perf_counter()
+    yield [client.fetch(base_url + '/post', method='POST', body=body)
+           for body in posts]
+    single = time.perf_counter() - start
+
+    batch = json.dumps([make_post(size) for _ in range(count)])
+    start = time.perf_counter()
+    response = yield client.fetch(
+        base_url + '/post/batch', method='POST', body=batch,
+        request_timeout=600)
+    elapsed = time.perf_counter() - start
+
+    results = json.loads(response.body)['results']
+    assert all('url' in r for r in results)
+
+    return single, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--count', type=int, default=200, help='Grids to post.')
+    parser.add_argument(
+        '--size', type=int, default=10, help='Side length of the grids.')
+    parser.add_argument(
+        '--concurrency', type=int, default=10,
+        help='Single posts in flight at once.')
+    args = parser.parse_args()
+
+    os.environ.setdefault('HASHIDS_PUBLIC_SALT', 'public')
+    os.environ.setdefault('HASHIDS_SECRET_SALT', 'secret')
+
+    with testing.postgresql.Postgresql() as postgresql:
+        engine = sa.create_engine(postgresql.url())
+        models.Base.metadata.create_all(bind=engine)
+        engine.dispose()
+
+        tornado.options.options.db_url = postgresql.url()
+        # measure the server, not post admission control
+        tornado.options.options.post_rate = 0.0
+        tornado.options.options.max_posts_in_flight = 1000000
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        server = tornado.httpserver.HTTPServer(app.make_application())
+        server.add_sockets(sockets)
+        base_url = 'http://127.0.0.1:{}'.format(sockets[0].getsockname()[1])
+
+        single, batch = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: bench(base_url, args.count, args.size, args.concurrency))
+        server.stop()
+
+    print(f'{args.count} single posts: {single:.3f} s '
+          f'({args.count / single:.1f} grids/s)')
+    print(f'1 batch of {args.count}: {batch:.3f} s '
+          f'({args.count / batch:.1f} grids/s)')
+    print(f'speedup: {single / batch:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
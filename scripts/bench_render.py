@@ -0,0 +1,71 @@
+"""
+Benchmark rendering grid HTML with app.render against ipythonblocks'
+BlockGrid._repr_html_ for a range of grid sizes.
+
+"""
+import argparse
+import random
+import time
+
+from ipythonblocks import BlockGrid
+
+# The module in the ipythonblocks.org application code that renders grids
+from app import render
+
+SIZES = [10, 50, 100, 300, 1000]
+
+
+def make_grid_data(size):
+    """
+    Make square grid data with random colors, like a posted ImageGrid.
+
+    """
+    blocks = [[[random.randint(0, 255) for _ in range(3)] + [20]
+               for _ in range(size)]
+              for _ in range(size)]
+    return {'lines_on': True, 'width': size, 'height': size, 'blocks': blocks}
+
+
+def render_block_grid(grid_data):
+    grid = BlockGrid(
+        grid_data['width'], grid_data['height'],
+        lines_on=grid_data['lines_on'])
+    grid._load_simple_grid(grid_data['blocks'])
+    return grid._repr_html_()
+
+
+def best_time(func, arg, repeat):
+    """
+    Return the best wall time in seconds of `repeat` calls of ``func(arg)``.
+
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=SIZES,
+        help='Side lengths of the square grids to render.')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Renders per size, the best time is reported.')
+    args = parser.parse_args()
+
+    print('{:>12} {:>14} {:>14} {:>9}'.format(
+        'grid', 'BlockGrid (s)', 'render (s)', 'speedup'))
+    for size in args.sizes:
+        gd = make_grid_data(size)
+        old = best_time(render_block_grid, gd, args.repeat)
+        new = best_time(render.render_grid_html, gd, args.repeat)
+        print('{:>12} {:>14.4f} {:>14.4f} {:>8.1f}x'.format(
+            '{0}x{0}'.format(size), old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
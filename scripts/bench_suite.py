@@ -0,0 +1,373 @@
+"""
+Benchmark the web application under concurrent load and time the pieces
+of work behind each request, saving the results as JSON.
+
+A throwaway local Postgres server is seeded with a mix of grid sizes and
+code cell counts, then concurrent clients make requests to /post,
+/<hash_id>, /get/<hash_id>, and /random on an in-process server.
+Throughput and p50/p95/p99 latency are reported for each, followed by
+micro-benchmarks of post validation, code highlighting, grid rendering,
+and hash ID encoding. Use --compare with the output of an earlier run
+to see how much each result changed.
+
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+
+import sqlalchemy as sa
+import testing.postgresql
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.options
+from ipythonblocks import BlockGrid
+from sqlalchemy.orm import sessionmaker
+
+# The modules in the ipythonblocks.org application code that contain
+# the application, table definitions, and the work done per request
+from app import app
+from app import colorize
+from app import dbinterface as dbi
+from app import models
+from app import postvalidate
+from app import render
+
+# (side length, weight) of the grids posted, most grids are small
+GRID_SIZES = [(5, 30), (10, 35), (30, 20), (100, 12), (300, 3)]
+MAX_CODE_CELLS = 5
+
+CODE_CELL = """\
+from ipythonblocks import BlockGrid
+
+grid = BlockGrid({size}, {size}, fill=(123, 234, 123))
+for block in grid:
+    if block.row % 2 == 0:
+        block.red = {value}
+grid.show()
+"""
+
+ENDPOINTS = ['post', 'grid', 'get', 'random']
+
+
+def make_post(size=None, code_cells=None, secret=False):
+    """
+    Make a grid post with random colors so no two posts are deduplicated.
+    The grid size and number of code cells are drawn from `GRID_SIZES`
+    and up to `MAX_CODE_CELLS` if not given.
+
+    """
+    if size is None:
+        sizes, weights = zip(*GRID_SIZES)
+        size, = random.choices(sizes, weights)
+    if code_cells is None:
+        code_cells = random.randint(0, MAX_CODE_CELLS)
+
+    blocks = [[[random.randint(0, 255) for _ in range(3)] + [20]
+               for _ in range(size)]
+              for _ in range(size)]
+    return {
+        'python_version': [3, 6, 1, 'final', 0],
+        'ipb_version': '1.7.0',
+        'ipb_class': 'BlockGrid',
+        'code_cells': [
+            CODE_CELL.format(size=size, value=random.randint(0, 255))
+            for _ in range(code_cells)] or None,
+        'secret': secret,
+        'grid_data': {
+            'lines_on': random.random() < 0.5,
+            'width': size,
+            'height': size,
+            'blocks': blocks
+        }
+    }
+
+
+def seed(url, count, batch_size=100):
+    """
+    Store `count` public grids and return their hash IDs.
+
+    """
+    engine = sa.create_engine(url)
+    models.Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+
+    hash_ids = []
+    try:
+        for start in range(0, count, batch_size):
+            posts = [make_post()
+                     for _ in range(min(batch_size, count - start))]
+            hash_ids.extend(dbi.store_grid_entries(
+                session, posts, rendered=True))
+            session.commit()
+    finally:
+        session.close()
+        engine.dispose()
+
+    return hash_ids
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a sorted list.
+
+    """
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(latencies, elapsed, errors):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+@tornado.gen.coroutine
+def drive(client, make_request, count, concurrency):
+    """
+    Make `count` requests with `concurrency` in flight at once,
+    getting each request from ``make_request()``.
+
+    """
+    remaining = iter(range(count))
+    latencies = []
+    errors = 0
+
+    @tornado.gen.coroutine
+    def worker():
+        nonlocal errors
+        for _ in remaining:
+            request = make_request()
+            start = time.perf_counter()
+            response = yield client.fetch(request, raise_error=False)
+            latencies.append(time.perf_counter() - start)
+            if response.code >= 400 or response.code == 599:
+                errors += 1
+
+    start = time.perf_counter()
+    yield [worker() for _ in range(concurrency)]
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+@tornado.gen.coroutine
+def load_test(base_url, hash_ids, endpoints, count, concurrency):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+
+    # bodies are made up front so making them isn't timed
+    posts = [json.dumps(make_post()) for _ in range(count)]
+
+    requests = {
+        'post': lambda: tornado.httpclient.HTTPRequest(
+            base_url + '/post', method='POST', body=posts.pop()),
+        'grid': lambda: tornado.httpclient.HTTPRequest(
+            base_url + '/' + random.choice(hash_ids)),
+        'get': lambda: tornado.httpclient.HTTPRequest(
+            base_url + '/get/' + random.choice(hash_ids)),
+        'random': lambda: tornado.httpclient.HTTPRequest(
+            base_url + '/random', follow_redirects=False),
+    }
+
+    results = {}
+    for name in endpoints:
+        results[name] = yield drive(
+            client, requests[name], count, concurrency)
+        print_load_result(name, results[name])
+    return results
+
+
+def print_load_result(name, result):
+    print(f'{name:>8}: {result["requests_per_second"]:8.1f} req/s  '
+          f'p50 {result["p50_ms"]:7.2f} ms  p95 {result["p95_ms"]:7.2f} ms  '
+          f'p99 {result["p99_ms"]:7.2f} ms  errors {result["errors"]}')
+
+
+def time_calls(func, args, repeat):
+    """
+    Call ``func(arg)`` for each of `args` `repeat` times over and return
+    the best mean seconds per call of the repeats.
+
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            func(arg)
+        best = min(best, (time.perf_counter() - start) / len(args))
+    return best
+
+
+def render_block_grid(grid_data):
+    grid = BlockGrid(
+        grid_data['width'], grid_data['height'],
+        lines_on=grid_data['lines_on'])
+    grid._load_simple_grid(grid_data['blocks'])
+    return grid._repr_html_()
+
+
+def uncached_colorize(code):
+    colorize.CODE_CACHE.clear()
+    return colorize.colorize(code)
+
+
+def micro_benchmarks(repeat):
+    """
+    Time the work done for requests outside of the server.
+    Returns a dict of microseconds per call.
+
+    """
+    results = {}
+
+    def record(name, func, args):
+        results[name] = time_calls(func, args, repeat) * 1e6
+        print(f'{name:>28}: {results[name]:12.1f} us/call')
+
+    posts = [make_post() for _ in range(50)]
+    record('postvalidate', postvalidate.validate, posts)
+
+    cells = [CODE_CELL.format(size=i, value=i) for i in range(50)]
+    record('colorize', uncached_colorize, cells)
+    colorize.colorize_cells(cells)
+    record('colorize_cached', colorize.colorize, cells)
+
+    for size in (10, 100, 300):
+        grids = [make_post(size=size)['grid_data'] for _ in range(3)]
+        record(f'render_grid_html_{size}', render.render_grid_html, grids)
+        record(f'blockgrid_repr_html_{size}', render_block_grid, grids)
+
+    ids = list(range(1, 1001))
+    record('hashids_encode',
+           lambda i: dbi.encode_grid_id(i, secret=False), ids)
+    hash_ids = [dbi.encode_grid_id(i, secret=False) for i in ids]
+    record('hashids_decode',
+           lambda h: dbi.decode_hash_id(h, secret=False), hash_ids)
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """
+    Print the change from an earlier run's results to this run's.
+
+    """
+    print(f'\nchange since {old.get("commit") or "previous run"}:')
+    for name, result in new['load'].items():
+        before = old.get('load', {}).get(name)
+        if before:
+            throughput = percent_change(
+                before['requests_per_second'], result['requests_per_second'])
+            p95 = percent_change(before['p95_ms'], result['p95_ms'])
+            print(f'{name:>28}: {throughput} req/s  {p95} p95')
+    for name, micros in new['micro'].items():
+        before = old.get('micro', {}).get(name)
+        if before:
+            print(f'{name:>28}: {percent_change(before, micros)} us/call')
+
+
+def percent_change(before, after):
+    return f'{(after - before) / before * 100:+7.1f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--grids', type=int, default=500,
+        help='Grids to seed the database with.')
+    parser.add_argument(
+        '--requests', type=int, default=500,
+        help='Requests to make to each endpoint.')
+    parser.add_argument(
+        '--concurrency', type=int, default=20,
+        help='Requests in flight at once.')
+    parser.add_argument(
+        '--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS,
+        help='Endpoints to load test.')
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Repeats of each micro-benchmark, the best time is reported.')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Turn off the page and code caches for the load tests.')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Random seed for the grids and requests made.')
+    parser.add_argument(
+        '--output', default='bench_results.json',
+        help='File to save results to.')
+    parser.add_argument(
+        '--compare', help='Results file of an earlier run to compare with.')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    os.environ.setdefault('HASHIDS_PUBLIC_SALT', 'public')
+    os.environ.setdefault('HASHIDS_SECRET_SALT', 'secret')
+
+    options = tornado.options.options
+    # measure the server, not post admission control
+    options.post_rate = 0.0
+    options.max_posts_in_flight = 1000000
+    if args.no_cache:
+        options.page_cache_bytes = 0
+        options.code_cache_bytes = 0
+
+    with testing.postgresql.Postgresql() as postgresql:
+        print(f'seeding {args.grids} grids')
+        hash_ids = seed(postgresql.url(), args.grids)
+
+        options.db_url = postgresql.url()
+        application = app.make_application(debug=False)
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(sockets)
+        base_url = 'http://127.0.0.1:{}'.format(sockets[0].getsockname()[1])
+
+        load = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: load_test(
+                base_url, hash_ids, args.endpoints, args.requests,
+                args.concurrency))
+        server.stop()
+        application.shutdown()
+
+    micro = micro_benchmarks(args.repeat)
+
+    results = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'args': vars(args),
+        'load': load,
+        'micro': micro,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results saved to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
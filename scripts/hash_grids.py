@@ -0,0 +1,123 @@
+"""
+Script for filling in the content_hash column of stored grids so new posts
+of the same content are deduplicated against them.
+
+Adds the column and its unique index if the tables predate them, then
+works through both grid tables in batches. Only the first of any
+existing duplicates gets a hash, later copies are left as they are so
+their URLs keep working. Each batch is committed on its own so the
+script can be stopped and run again without losing progress.
+
+"""
+import argparse
+import contextlib
+import os
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+# The modules in the ipythonblocks.org application code that contain
+# table definitions and the content hash
+from app import dbinterface as dbi
+from app import models
+
+DBURL = os.environ['DATABASE_URL']  # could be local or remote server
+PSQL_ENGINE = sa.create_engine(DBURL)
+SESSION = sessionmaker(bind=PSQL_ENGINE)
+
+ADD_COLUMN = """
+ALTER TABLE {table} ADD COLUMN IF NOT EXISTS content_hash text;
+CREATE UNIQUE INDEX IF NOT EXISTS {table}_content_hash_key
+    ON {table} (content_hash)
+"""
+
+
+@contextlib.contextmanager
+def session_context():
+    session = SESSION()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def add_column():
+    """
+    Add the content_hash column to grid tables created before it existed.
+
+    """
+    with session_context() as session:
+        for sa_cls in (models.PublicGrid, models.SecretGrid):
+            session.execute(sa.text(
+                ADD_COLUMN.format(table=sa_cls.__tablename__)))
+
+
+def hash_table(sa_cls, batch_size):
+    """
+    Hash every unhashed grid in the table of sa_cls,
+    committing after every batch_size grids.
+
+    """
+    last_id = 0
+    total = 0
+    duplicates = 0
+
+    while True:
+        with session_context() as session:
+            rows = session.query(
+                sa_cls.id, sa_cls.grid_data, sa_cls.grid_blob,
+                sa_cls.code_cells, sa_cls.ipb_class, sa_cls.secret).filter(
+                    sa_cls.id > last_id,
+                    sa_cls.content_hash.is_(None)).order_by(
+                        sa_cls.id).limit(batch_size).all()
+
+            if not rows:
+                break
+
+            digests = {}
+            for row in rows:
+                grid_spec = row._asdict()
+                grid_spec['grid_data'] = dbi.load_grid_data(row)
+                if row.grid_blob is not None:
+                    blocks = grid_spec['grid_data']['blocks']
+                    grid_spec['grid_data']['blocks'] = blocks.tolist()
+
+                digest = dbi.content_hash(grid_spec)
+                digests.setdefault(digest, row.id)
+
+            existing = {
+                digest for digest, in session.query(
+                    sa_cls.content_hash).filter(
+                        sa_cls.content_hash.in_(digests))}
+
+            updates = [
+                {'id': grid_id, 'content_hash': digest}
+                for digest, grid_id in digests.items()
+                if digest not in existing]
+            session.bulk_update_mappings(sa_cls, updates)
+
+        last_id = rows[-1].id
+        total += len(rows)
+        duplicates += len(rows) - len(updates)
+        print(f'{sa_cls.__tablename__}: hashed {total - duplicates} grids, '
+              f'found {duplicates} duplicates (through id {last_id})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help='Number of grids to hash per transaction.')
+    args = parser.parse_args()
+
+    add_column()
+    hash_table(models.PublicGrid, args.batch_size)
+    hash_table(models.SecretGrid, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
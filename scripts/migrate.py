@@ -1,7 +1,26 @@
-"""Script for migrating ipythonblocks grid data from SQLite to Postgres"""
+"""
+Script for migrating ipythonblocks grid data from SQLite to Postgres.
+
+Rows are read from SQLite in chunks of ids, their JSON is decoded and
+checked in a pool of worker processes, and each chunk is written to
+Postgres with COPY in its own transaction. Chunks are written in id
+order, so the largest id already in a Postgres table marks how far that
+table got and running the script again picks up from there.
+public_grids and secret_grids are migrated at the same time.
+
+Grids are copied without content hashes or rendered HTML, run
+hash_grids.py and backfill_rendered.py afterward to fill those in.
+
+"""
+import argparse
+import collections
+import concurrent.futures
 import contextlib
+import io
 import json
 import os
+import threading
+import time
 from pathlib import Path
 
 import sqlalchemy as sa
@@ -13,8 +32,6 @@ from app import models
 
 # SQLite DB related variables
 SQLITEDB = 'sqlite:///' + str(Path.home() / 'ipborg.db')
-SQLITE_ENGINE = sa.create_engine(str(SQLITEDB))
-SQLITE_META = sa.MetaData(bind=SQLITE_ENGINE)
 
 # Postgres DB related variables
 DBURL = os.environ['DATABASE_URL']  # could be local or remote server
@@ -24,61 +41,157 @@ SESSION = sessionmaker(bind=PSQL_ENGINE)
 # columns that are serialized JSON in the SQLite DB
 JSONIZE_KEYS = {'python_version', 'code_cells', 'grid_data'}
 
-# drop and recreate tables in the destination DB so we're always
-# starting fresh
-models.Base.metadata.drop_all(bind=PSQL_ENGINE)
-models.Base.metadata.create_all(bind=PSQL_ENGINE)
+TABLES = [
+    ('public_grids', models.PublicGrid),
+    ('secret_grids', models.SecretGrid),
+]
+
+# characters that must be escaped in Postgres' COPY text format
+_COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+@contextlib.contextmanager
+def session_context():
+    session = SESSION()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def copy_value(value):
+    """
+    Format a value for Postgres' COPY text format.
+
+    """
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).translate(_COPY_ESCAPES)
 
 
-def sqlite_row_to_sa_row(row, sa_cls):
+def rows_to_copy_text(columns, rows):
     """
-    Convert a row from the SQLite DB (a SQLAlchemy RowProxy instance)
-    into an ORM instance such as PublicGrid or SecretGrid
-    (exact class provided by the sa_cls argument). This takes care of
-    de-serializing the JSON data stored in the SQLite DB.
+    Turn a chunk of SQLite rows into COPY text for the same `columns`
+    followed by width and height. Runs in a worker process.
+
+    JSON columns are decoded to make sure they're valid and the JSON
+    text is passed on as is, Postgres parses it again into jsonb.
 
     """
-    d = dict(row)
-    for key in JSONIZE_KEYS:
-        d[key] = json.loads(d[key]) if d[key] else None
+    json_indexes = [i for i, c in enumerate(columns) if c in JSONIZE_KEYS]
+    grid_index = columns.index('grid_data')
+
+    lines = []
+    for row in rows:
+        row = list(row)
+        grid_data = {}
+        for i in json_indexes:
+            if row[i]:
+                decoded = json.loads(row[i])
+                if i == grid_index:
+                    grid_data = decoded
+            else:
+                row[i] = None
 
-    return sa_cls(**d)
+        row.extend([grid_data.get('width'), grid_data.get('height')])
+        lines.append('\t'.join(copy_value(v) for v in row))
 
+    return ''.join(line + '\n' for line in lines)
 
-def sqlite_table_to_sa_rows(table_name, sa_cls):
+
+def read_chunks(sqlite_engine, table_name, start_id, chunk_size):
     """
-    Yields SQLAlchemy ORM instances of sa_cls from a SQLite table
-    specified by table_name.
+    Yields lists of rows from a SQLite table in id order,
+    starting after `start_id`.
 
     """
-    table = sa.Table(table_name, SQLITE_META, autoload=True)
-    results = SQLITE_ENGINE.execute(table.select())
-    for row in results:
-        yield sqlite_row_to_sa_row(row, sa_cls)
+    table = sa.Table(
+        table_name, sa.MetaData(), autoload=True, autoload_with=sqlite_engine)
+    last_id = start_id
 
+    while True:
+        rows = sqlite_engine.execute(
+            table.select().where(table.c.id > last_id).order_by(
+                table.c.id).limit(chunk_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield [tuple(row) for row in rows]
 
-@contextlib.contextmanager
-def session_context():
-    session = SESSION()
+
+def copy_chunk(table_name, columns, copy_text):
+    """
+    Write one chunk of COPY text to a Postgres table in its own transaction.
+
+    """
+    connection = PSQL_ENGINE.raw_connection()
     try:
-        yield session
-        session.commit()
+        cursor = connection.cursor()
+        cursor.copy_expert(
+            'COPY public.{} ({}) FROM STDIN'.format(
+                table_name, ', '.join(columns + ['width', 'height'])),
+            io.StringIO(copy_text))
+        connection.commit()
     except:
-        session.rollback()
+        connection.rollback()
         raise
     finally:
-        session.close()
+        connection.close()
 
-def migrate():
+
+def migrate_table(table_name, sa_cls, sqlite_engine, pool, chunk_size,
+                  max_pending):
     """
-    Trigger the reading from SQLite, transformation of JSON data,
-    and writing to Postgres.
+    Copy the rows of a SQLite table that aren't yet in Postgres,
+    decoding up to `max_pending` chunks ahead of the one being written.
 
     """
     with session_context() as session:
-        session.add_all(sqlite_table_to_sa_rows('public_grids', models.PublicGrid))
-        session.add_all(sqlite_table_to_sa_rows('secret_grids', models.SecretGrid))
+        start_id = session.query(sa.func.max(sa_cls.id)).scalar() or 0
+    if start_id:
+        print(f'{table_name}: resuming after id {start_id}')
+
+    columns = [c.name for c in sa.Table(
+        table_name, sa.MetaData(), autoload=True,
+        autoload_with=sqlite_engine).columns]
 
+    pending = collections.deque()
+    total = 0
+    start = time.perf_counter()
+
+    def write_oldest():
+        nonlocal total
+        future, count, last_id = pending.popleft()
+        copy_chunk(table_name, columns, future.result())
+        total += count
+        rate = total / (time.perf_counter() - start)
+        print(f'{table_name}: copied {total} rows, {rate:.0f} rows/s '
+              f'(through id {last_id})')
+
+    for rows in read_chunks(sqlite_engine, table_name, start_id, chunk_size):
+        future = pool.submit(rows_to_copy_text, columns, rows)
+        pending.append((future, len(rows), rows[-1][columns.index('id')]))
+        if len(pending) > max_pending:
+            write_oldest()
+
+    while pending:
+        write_oldest()
+
+
+def fix_sequences():
+    """
+    Advance the sequences behind the table primary keys past the
+    migrated ids.
+
+    """
+    with session_context() as session:
         # Because all the grids added so far already had IDs, the sequences
         # backing the id columns in the grid tables haven't been advanced
         # at all. When trying to add a new table the sequence would provide
@@ -86,14 +199,74 @@ def migrate():
         # We need to manually set the sequences behind the table primary keys
         # so that when new grids are added with no IDs the automatically
         # generated IDs are actually available.
-        max_public_id = session.query(sa.func.max(models.PublicGrid.id)).scalar()
-        max_secret_id = session.query(sa.func.max(models.SecretGrid.id)).scalar()
+        for table_name, sa_cls in TABLES:
+            max_id = session.query(sa.func.max(sa_cls.id)).scalar()
+            if max_id is not None:
+                session.execute(sa.text(
+                    f'select setval(\'{table_name}_id_seq\', {max_id})'))
+
+
+def migrate(sqlite_url, chunk_size, workers, fresh):
+    """
+    Trigger the reading from SQLite, transformation of JSON data,
+    and writing to Postgres.
+
+    """
+    if fresh:
+        # drop and recreate tables in the destination DB
+        # so we're starting over
+        models.Base.metadata.drop_all(bind=PSQL_ENGINE)
+    models.Base.metadata.create_all(bind=PSQL_ENGINE)
+
+    sqlite_engine = sa.create_engine(sqlite_url)
+    start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        errors = []
+
+        def run(table_name, sa_cls):
+            try:
+                migrate_table(
+                    table_name, sa_cls, sqlite_engine, pool, chunk_size,
+                    max_pending=2 * (workers or os.cpu_count()))
+            except Exception as e:
+                errors.append(e)
+                raise
+
+        threads = [threading.Thread(target=run, args=table)
+                   for table in TABLES]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise SystemExit(
+            'Migration stopped early, run again to resume: {}'.format(
+                errors[0]))
+
+    fix_sequences()
+    print(f'done in {time.perf_counter() - start:.1f} s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--sqlite-url', default=SQLITEDB,
+        help='SQLAlchemy URL of the SQLite database to migrate from.')
+    parser.add_argument(
+        '--chunk-size', type=int, default=2000,
+        help='Rows read, decoded, and written at a time.')
+    parser.add_argument(
+        '--workers', type=int,
+        help='Processes decoding JSON (default: one per CPU).')
+    parser.add_argument(
+        '--fresh', action='store_true',
+        help='Drop the Postgres tables and start over instead of resuming.')
+    args = parser.parse_args()
 
-        session.execute(sa.text(
-            f'select setval(\'public_grids_id_seq\', {max_public_id})'))
-        session.execute(sa.text(
-            f'select setval(\'secret_grids_id_seq\', {max_secret_id})'))
+    migrate(args.sqlite_url, args.chunk_size, args.workers, args.fresh)
 
 
 if __name__ == '__main__':
-    migrate()
+    main()
@@ -0,0 +1,107 @@
+"""
+Script for converting stored grids to the packed block format
+from app.gridpack.
+
+Adds the grid_blob column if the tables predate it, then works through
+both grid tables in batches, moving the blocks of every unpacked grid
+out of grid_data and into grid_blob. Each batch is committed on its own
+so the script can be stopped and run again without losing progress.
+
+"""
+import argparse
+import contextlib
+import os
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+# The modules in the ipythonblocks.org application code that contain
+# table definitions and the block packing format
+from app import gridpack
+from app import models
+
+DBURL = os.environ['DATABASE_URL']  # could be local or remote server
+PSQL_ENGINE = sa.create_engine(DBURL)
+SESSION = sessionmaker(bind=PSQL_ENGINE)
+
+ADD_COLUMN = 'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS grid_blob bytea'
+
+
+@contextlib.contextmanager
+def session_context():
+    session = SESSION()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def add_column():
+    """
+    Add the grid_blob column to grid tables created before it existed.
+
+    """
+    with session_context() as session:
+        for sa_cls in (models.PublicGrid, models.SecretGrid):
+            session.execute(sa.text(
+                ADD_COLUMN.format(table=sa_cls.__tablename__)))
+
+
+def pack_table(sa_cls, batch_size):
+    """
+    Pack the blocks of every unpacked grid in the table of sa_cls,
+    committing after every batch_size grids.
+
+    """
+    last_id = 0
+    total = 0
+    skipped = 0
+
+    while True:
+        with session_context() as session:
+            rows = session.query(sa_cls.id, sa_cls.grid_data).filter(
+                sa_cls.id > last_id,
+                sa_cls.grid_blob.is_(None)).order_by(
+                    sa_cls.id).limit(batch_size).all()
+
+            if not rows:
+                break
+
+            updates = []
+            for row in rows:
+                blob = gridpack.pack(row.grid_data)
+                if blob is None:
+                    skipped += 1
+                    continue
+
+                grid_data = {
+                    k: v for k, v in row.grid_data.items() if k != 'blocks'}
+                updates.append(
+                    {'id': row.id, 'grid_data': grid_data, 'grid_blob': blob})
+
+            session.bulk_update_mappings(sa_cls, updates)
+
+        last_id = rows[-1].id
+        total += len(rows)
+        print(f'{sa_cls.__tablename__}: packed {total - skipped} grids, '
+              f'skipped {skipped} (through id {last_id})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help='Number of grids to pack per transaction.')
+    args = parser.parse_args()
+
+    add_column()
+    pack_table(models.PublicGrid, args.batch_size)
+    pack_table(models.SecretGrid, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()